@@ -1,42 +1,211 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import (Blueprint, Flask, Response, current_app, render_template,
+                   request, flash, redirect, session, g, stream_with_context,
+                   url_for, jsonify, send_file, abort)
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import Unauthorized
 from sqlalchemy import and_
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Like
+from models import (db, connect_db, User, Message, Like, MessageTag, Mention,
+                    DataExport)
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+# Blueprints whose responses set their own long-lived cache headers
+CACHED_BLUEPRINTS = ('assets', 'images')
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+bp = Blueprint('warbler', __name__)
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-# toolbar = DebugToolbarExtension(app)
 
-connect_db(app)
+def create_app(config=None):
+    """Build and configure a Warbler app.
+
+    `config` is a mapping of settings applied over the defaults, e.g.
+    `create_app({'SQLALCHEMY_DATABASE_URI': 'postgresql:///warbler_test'})`.
+    Optional extensions are only imported when they are switched on, so
+    workers and CLI tools that never use them don't pay for the import.
+    """
+
+    _import_features()
+
+    app = Flask(__name__)
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_ENABLED'] = bool(os.environ.get('DEBUG_TB_ENABLED'))
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+    app.config['STREAM_TEMPLATES'] = True
+    # Usernames allowed to see /admin pages, comma-separated
+    app.config['ADMIN_USERS'] = [
+        name for name in os.environ.get('ADMIN_USERS', '').split(',') if name]
+
+    # Local fault injection: delay every query this long (shedding.py)
+    if os.environ.get('FAULT_DB_LATENCY_MS'):
+        app.config['FAULT_DB_LATENCY_MS'] = int(
+            os.environ['FAULT_DB_LATENCY_MS'])
+
+    # Where workers keep counters and cache versions they share
+    # (shared.py); off if unset
+    app.config['SHARED_STATE_PATH'] = os.environ.get('SHARED_STATE_PATH')
+
+    # Where export files are written (exports.py); instance/exports if unset
+    app.config['EXPORT_DIR'] = os.environ.get('EXPORT_DIR')
+
+    # Green-thread workers (green.py) keep many requests, and so many
+    # connections, in flight at once
+    if os.environ.get('DB_POOL_SIZE'):
+        app.config['SQLALCHEMY_POOL_SIZE'] = int(os.environ['DB_POOL_SIZE'])
+
+    if config:
+        app.config.update(config)
+
+    connect_db(app)
+
+    # First, so shed requests never reach the other hooks
+    shedding.init_app(app)
+
+    if app.config['DEBUG_TB_ENABLED']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    import jobs
+    app.cli.add_command(jobs.jobs_cli)
+    app.cli.add_command(suggestions.suggestions_cli)
+    app.cli.add_command(deletion.deletion_cli)
+    app.cli.add_command(exports.export_cli)
+    app.cli.add_command(imports.import_cli)
+    app.cli.add_command(partitions.partitions_cli)
+
+    import schema
+    app.cli.add_command(schema.schema_cli)
+
+    import assets
+    assets.init_app(app)
+
+    import images
+    images.init_app(app)
+
+    tags.init_app(app)
+
+    app.register_blueprint(bp)
+
+    return app
+
+
+def _import_features():
+    """Import the feature modules the views use, as globals of this module.
+
+    Done on the first create_app() rather than at the top, so importing
+    this module (`from app import CURR_USER_KEY`, `flask --help`) doesn't
+    load them all.
+    """
+
+    global caching, connections, deletion, exports, graph, hotkeys
+    global imports, membership, partitions, rows, shedding, suggestions
+    global tags, threads, timelines, trending
+
+    import caching
+    import connections
+    import deletion
+    import exports
+    import graph
+    import hotkeys
+    import imports
+    import membership
+    import partitions
+    import rows
+    import shedding
+    import suggestions
+    import tags
+    import threads
+    import timelines
+    import trending
+
+
+def __getattr__(name):
+    """Build the default app the first time `app.app` is asked for.
+
+    Keeps `from app import app` (tests, `flask run`) working without
+    building an app for every module that merely imports this one. The
+    default app is also the one the models use outside an app context
+    (scripts, tests); other apps need their own context pushed.
+    """
+
+    if name == 'app':
+        global app
+        app = create_app()
+        db.app = app
+        return app
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+##############################################################################
+# Streaming
+
+
+# Rows fetched per round trip when streaming long lists from the DB
+STREAM_BATCH_SIZE = 100
+
+# Jinja emits many tiny strings; send them to the client in chunks this big
+STREAM_CHUNK_SIZE = 8192
+
+
+def _chunked(fragments, size=STREAM_CHUNK_SIZE):
+    """Join small template fragments into chunks of about `size` chars."""
+
+    buf = []
+    buffered = 0
+
+    for fragment in fragments:
+        buf.append(fragment)
+        buffered += len(fragment)
+
+        if buffered >= size:
+            yield ''.join(buf)
+            buf = []
+            buffered = 0
+
+    if buf:
+        yield ''.join(buf)
+
+
+def stream_template(template_name, **context):
+    """Render template as a streamed response.
+
+    The page is sent as it renders, so lists passed in as `yield_per`
+    queries go from DB cursor to client without ever being held in memory
+    all at once. With STREAM_TEMPLATES off, renders normally.
+    """
+
+    if not current_app.config['STREAM_TEMPLATES']:
+        return render_template(template_name, **context)
+
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+
+    return Response(
+        stream_with_context(_chunked(template.generate(context))))
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = caching.user(session[CURR_USER_KEY])
         # g.likes = Like.query.filter(Like.user_id == g.user.id).all()
         # g.likes_id = [like.message_id for like in g.likes]
 
@@ -44,6 +213,13 @@ def add_user_to_g():
         g.user = None
 
 
+@bp.before_app_request
+def count_hot_keys():
+    """Count this page view towards hot-key tracking (needs g.user)."""
+
+    hotkeys.record_request()
+
+
 def do_login(user):
     """Log in user."""
 
@@ -60,7 +236,7 @@ def do_logout():
         return redirect('/login')
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -89,6 +265,7 @@ def signup():
             return render_template('users/signup.html', form=form)
 
         do_login(user)
+        timelines.prewarm(user.id)
 
         return redirect("/")
 
@@ -96,7 +273,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -108,6 +285,7 @@ def login():
 
         if user:
             do_login(user)
+            timelines.prewarm(user.id)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
 
@@ -117,7 +295,7 @@ def login():
 
 
 # WHY SEPARATE TO TWO FUNCTIONS?
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Handle logout of user."""
     # IMPLEMENT THIS
@@ -128,7 +306,7 @@ def logout():
 # General user routes:
 
 
-@app.route('/users')
+@bp.route('/users')
 def list_users():
     """Page with listing of users.
 
@@ -137,24 +315,35 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = rows.user_cards_query().order_by(User.id)
+
+    if search:
+        users = users.filter(User.username.like(f"%{search}%"))
 
-    return render_template('users/index.html', users=users)
+    return stream_template(
+        'users/index.html',
+        users=rows.user_cards(users.yield_per(STREAM_BATCH_SIZE)))
 
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
-    count = Like.query.filter(Like.user_id == user.id).count()
-    return render_template('users/show.html', user=user, count=count)
+    user = caching.user_or_404(user_id)
+    count = len(caching.liked_message_ids(user.id))
+    messages = rows.message_rows(rows
+                                 .messages_query()
+                                 .filter(Message.user_id == user.id)
+                                 .order_by(Message.id.desc())
+                                 .yield_per(STREAM_BATCH_SIZE))
 
+    return stream_template('users/show.html', user=caching.profile(user),
+                           count=count,
+                           messages=messages,
+                           connections=connections.for_profile(g.user, user))
 
-@app.route('/users/<int:user_id>/following')
+
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -162,11 +351,13 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = caching.user_or_404(user_id)
+    return render_template('users/following.html',
+                           user=caching.profile(user),
+                           connections=connections.for_profile(g.user, user))
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -174,12 +365,14 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = caching.user_or_404(user_id)
 
-    return render_template('users/followers.html', user=user)
+    return render_template('users/followers.html',
+                           user=caching.profile(user),
+                           connections=connections.for_profile(g.user, user))
 
 
-@app.route('/users/<int:user_id>/likes')
+@bp.route('/users/<int:user_id>/likes')
 def users_likes(user_id):
     """Show list of likes of this user."""
 
@@ -188,11 +381,12 @@ def users_likes(user_id):
         return redirect("/")
 
     # Removed likes/likes_id from g; refactored to pull just message_id from likes table
-    likes_id = db.session.query(Like.message_id).filter(
-        Like.user_id == user_id).all()
-    user = User.query.get_or_404(user_id)
-    messages = Message.query.filter(Message.id.in_(likes_id)).all()
-    return render_template('users/likes.html', user=user, messages=messages)
+    likes_id = caching.liked_message_ids(user_id)
+    user = caching.user_or_404(user_id)
+    messages = list(rows.message_rows(
+        rows.messages_query().filter(Message.id.in_(likes_id))))
+    return render_template('users/likes.html', user=caching.profile(user),
+                           messages=messages)
 
 #####################
 # CUSTOM DECORATORS #
@@ -253,7 +447,7 @@ def users_likes(user_id):
 #################
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -261,14 +455,18 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followee = User.query.get_or_404(follow_id)
+    followee = User.active().filter_by(id=follow_id).first_or_404()
     g.user.following.append(followee)
+    suggestions.mark_stale(g.user.id)
     db.session.commit()
+    graph.record_follow(g.user.id, followee.id)
+    connections.forget_follow(g.user.id, followee.id)
+    caching.forget_follow(g.user.id, followee.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -278,12 +476,16 @@ def stop_following(follow_id):
 
     followee = User.query.get(follow_id)
     g.user.following.remove(followee)
+    suggestions.mark_stale(g.user.id)
     db.session.commit()
+    graph.record_unfollow(g.user.id, followee.id)
+    connections.forget_follow(g.user.id, followee.id)
+    caching.forget_follow(g.user.id, followee.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -304,6 +506,7 @@ def profile():
                 user.header_image_url = form.data['header_image_url']
                 user.bio = form.data['bio']
                 db.session.commit()
+                caching.forget_user(user.id)
                 return redirect(f'/users/{user.id}')
             else:
                 flash('Username or password invalid! :(')
@@ -314,7 +517,7 @@ def profile():
         raise Unauthorized()
 
 
-@app.route('/users/delete', methods=["POST"])
+@bp.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -324,16 +527,166 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # Hidden now; messages, likes and follows are purged by a background job
+    deletion.tombstone(g.user)
     db.session.commit()
+    graph.record_user_deleted(g.user.id)
+    caching.forget_user(g.user.id)
 
     return redirect("/signup")
 
 
+@bp.route('/users/export')
+def export_page():
+    """Offer the current user their data, and list their export files."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    files = (DataExport
+             .query
+             .filter_by(user_id=g.user.id)
+             .order_by(DataExport.requested_at.desc())
+             .all())
+
+    # Whether the account is small enough to download directly is only
+    # counted when a download is asked for
+    return render_template('users/export.html', exports=files)
+
+
+@bp.route('/users/export/download')
+def export_download():
+    """Stream the current user's data as NDJSON or a zip archive."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    format = request.args.get('format', 'ndjson')
+    if format not in exports.FORMATS:
+        abort(404)
+
+    max_rows = current_app.config.get('EXPORT_STREAM_MAX_ROWS',
+                                      exports.EXPORT_STREAM_MAX_ROWS)
+    if exports.row_count(g.user.id) > max_rows:
+        flash("Your account is too big to download directly; "
+              "request an export file instead.", "warning")
+        return redirect(url_for('warbler.export_page'))
+
+    name = exports.filename(g.user.username, format)
+    return Response(
+        stream_with_context(exports.chunks(g.user.id, format)),
+        mimetype=exports.FORMATS[format],
+        headers={'Content-Disposition': f'attachment; filename="{name}"'})
+
+
+@bp.route('/users/export', methods=["POST"])
+def export_request():
+    """Queue an export of the current user's data to a file."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    format = request.form.get('format', 'zip')
+    if format not in exports.FORMATS:
+        abort(404)
+
+    exports.request_export(g.user, format)
+    db.session.commit()
+
+    flash("We're preparing your export; it will be listed here when it's "
+          "ready.", "success")
+    return redirect(url_for('warbler.export_page'))
+
+
+@bp.route('/users/export/<int:export_id>')
+def export_file(export_id):
+    """Download a finished export file of the current user's."""
+
+    export = DataExport.query.get_or_404(export_id)
+
+    if not g.user or export.user_id != g.user.id:
+        abort(404)
+    if export.status != exports.DONE:
+        flash("That export isn't ready yet.", "warning")
+        return redirect(url_for('warbler.export_page'))
+
+    path = exports.path_of(export)
+    # Pruned, or written on a server with a different EXPORT_DIR
+    if not os.path.exists(path):
+        flash("That export file is gone; prepare a new one.", "warning")
+        return redirect(url_for('warbler.export_page'))
+
+    return send_file(path,
+                     mimetype=exports.FORMATS[export.format],
+                     as_attachment=True,
+                     attachment_filename=exports.filename(g.user.username,
+                                                          export.format))
+
+
+@bp.route('/users/import')
+def import_page():
+    """Show forms for importing follows and messages in bulk."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return render_template('users/import.html')
+
+
+def _import(importer, columns):
+    """Run `importer` on the posted rows: a JSON list, an uploaded CSV
+    file or pasted CSV. Answers JSON requests with JSON."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if request.is_json:
+        items = request.get_json()
+        if not isinstance(items, list):
+            abort(400)
+        rows = imports.json_rows(items, columns)
+    elif request.files.get('file'):
+        try:
+            rows = imports.text_rows(request.files['file'].stream, columns)
+        except UnicodeDecodeError:
+            flash("Upload a CSV file saved as UTF-8.", "danger")
+            return redirect(url_for('warbler.import_page'))
+    else:
+        rows = imports.csv_rows(
+            request.form.get('csv', '').splitlines(), columns)
+
+    max_rows = current_app.config.get('IMPORT_MAX_ROWS',
+                                      imports.IMPORT_MAX_ROWS)
+    report = importer(g.user, rows, max_rows=max_rows)
+
+    if request.is_json:
+        return jsonify(report.to_dict())
+    return render_template('users/import.html', report=report)
+
+
+@bp.route('/users/import/follows', methods=["POST"])
+def import_follows():
+    """Follow a list of users at once."""
+
+    return _import(imports.import_follows, imports.FOLLOW_COLUMNS)
+
+
+@bp.route('/users/import/messages', methods=["POST"])
+def import_messages():
+    """Post a list of messages at once."""
+
+    return _import(imports.import_messages, imports.MESSAGE_COLUMNS)
+
+
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -349,22 +702,58 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.data['text'])
         g.user.messages.append(msg)
+        db.session.flush()
+        threads.place(msg)
+        tags.index_message(msg)
         db.session.commit()
+        caching.forget_messages(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@bp.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message and the conversation under it."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = caching.message_or_404(message_id)
 
+    replies = [(reply, threads.depth(reply) - threads.depth(msg))
+               for reply in threads.conversation(msg)
+               if reply.id != msg.id]
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+    return render_template('messages/show.html', message=msg,
+                           replies=replies, form=MessageForm())
+
+
+@bp.route('/messages/<int:message_id>/reply', methods=["POST"])
+def messages_reply(message_id):
+    """Reply to a message, then show its conversation."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    parent = Message.visible().filter(Message.id == message_id).first_or_404()
+    form = MessageForm()
+
+    if form.validate_on_submit():
+        msg = Message(text=form.data['text'])
+        g.user.messages.append(msg)
+        db.session.flush()
+        threads.place(msg, parent)
+        tags.index_message(msg)
+        db.session.commit()
+        caching.forget_messages(g.user.id)
+        caching.forget_message(*threads.ancestor_ids(msg))
+    else:
+        flash("Your reply was empty.", "danger")
+
+    return redirect(f"/messages/{message_id}")
+
+
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -373,8 +762,20 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    author_id = msg.user_id
+    changed = [msg.id, *threads.ancestor_ids(msg)]
+    threads.remove(msg)
+    # No foreign key cascade once messages is partitioned
+    msg.likes.delete(synchronize_session=False)
+    for model in (MessageTag, Mention):
+        (model
+         .query
+         .filter(model.message_id == msg.id)
+         .delete(synchronize_session=False))
     db.session.delete(msg)
     db.session.commit()
+    caching.forget_messages(author_id)
+    caching.forget_message(*changed)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -382,33 +783,37 @@ def messages_destroy(message_id):
 ##############################################################################
 # Homepage and error pages
 
-
-@app.route('/')
+@bp.route('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followees
+    - logged in: 100 most recent messages of followees; `before` (a
+      message id) pages back through older ones
     """
 
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
-
-        # FILTER(TABLENAME.COLUMNNAME.IN_(ARRAY))
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        # Refactor to pull message_id as tuples in likes table and pass into Jinja
-        # Use list comprehension to unpack tuples before passing to Jinja - more efficient
-        # COULD use secondary relationship between users and messages through likes -- about the same?
-        likes_tuple = db.session.query(Like.message_id).filter(
-            Like.user_id == g.user.id).all()
-        likes_id = [like[0] for like in likes_tuple]
-        return render_template('home.html', messages=messages, likes_id=likes_id)
+        before = request.args.get('before', type=int)
+
+        # The first visit after logging in was built ahead of time
+        warm = timelines.take(g.user.id) if before is None else None
+        if warm is not None:
+            messages = warm['messages']
+            who_to_follow = caching.user_cards(warm['suggested'])
+        else:
+            messages = timelines.page(g.user.id, before)
+            who_to_follow = suggestions.for_user(g.user.id)
+
+        older = (messages[-1].id if len(messages) == timelines.PAGE_SIZE
+                 else None)
+
+        # Only ask about the messages on the page; the user's like filter
+        # answers most of them without a query
+        likes_id = membership.liked_among(g.user.id,
+                                          [msg.id for msg in messages])
+        return render_template('home.html', messages=messages, likes_id=likes_id,
+                               who_to_follow=who_to_follow, older=older,
+                               profile=caching.profile(g.user))
 
     else:
         return render_template('home-anon.html')
@@ -416,11 +821,15 @@ def homepage():
 # Refactored like and unlike routes to one app route
 
 
-@app.route('/like/<action>', methods=["POST"])
+@bp.route('/like/<action>', methods=["POST"])
 def handle_like(action):
     """Handle liked message"""
-    message_id = request.form.get('message_id')
+    message_id = request.form.get('message_id', type=int)
+    if message_id is None:
+        abort(400)
     user_id = g.user.id
+    # Before the change, so warming it up doesn't count this like twice
+    tracker = trending.current_tracker(current_app)
     if action == 'add':
         like = Like(message_id=message_id, user_id=user_id)
         db.session.add(like)
@@ -429,10 +838,138 @@ def handle_like(action):
             and_(Like.user_id == user_id, Like.message_id == message_id)).first()
         db.session.delete(like)
     db.session.commit()
+
+    tracker.record(message_id, 1 if action == 'add' else -1)
+
+    # Also how other workers' like filters (membership.py) hear of it
+    caching.forget_likes(user_id)
+
     return redirect('/')
 
 
-@app.errorhandler(404)
+@bp.route('/trending')
+def trending_messages():
+    """Show messages with the most like activity lately, hottest first."""
+
+    tracker = trending.current_tracker(current_app)
+    top_ids = tracker.top()
+
+    by_id = ({msg.id: msg for msg in
+              Message.visible().filter(Message.id.in_(top_ids))}
+             if top_ids else {})
+    messages = [by_id[msg_id] for msg_id in top_ids if msg_id in by_id]
+
+    likes_id = set()
+    if g.user:
+        likes_id = membership.liked_among(g.user.id, top_ids)
+
+    return render_template('messages/trending.html', messages=messages,
+                           likes_id=likes_id)
+
+
+@bp.route('/tags/<tag>')
+def tag_timeline(tag):
+    """Show messages tagged #tag, newest first, paged by `before`."""
+
+    messages = tags.tagged(tag, before=request.args.get('before', type=int))
+    return _timeline(f"#{tag.lower()}", messages,
+                     lambda before: url_for('warbler.tag_timeline', tag=tag,
+                                            before=before))
+
+
+@bp.route('/mentions')
+def mentions_timeline():
+    """Show messages @mentioning the logged-in user, paged by `before`."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    messages = tags.mentioning(g.user.id,
+                               before=request.args.get('before', type=int))
+    return _timeline("Mentions", messages,
+                     lambda before: url_for('warbler.mentions_timeline',
+                                            before=before))
+
+
+def _timeline(heading, messages, older_url):
+    """Render a page of an index timeline, linking to the next if full."""
+
+    likes_id = set()
+    if g.user:
+        likes_id = membership.liked_among(g.user.id,
+                                          [msg.id for msg in messages])
+
+    older = None
+    if len(messages) == tags.PAGE_SIZE:
+        older = older_url(messages[-1].id)
+
+    return render_template('messages/timeline.html', heading=heading,
+                           messages=messages, likes_id=likes_id, older=older)
+
+
+##############################################################################
+# Admin
+
+
+def require_admin():
+    """Raise Unauthorized unless the user is listed in ADMIN_USERS."""
+
+    if not g.user or g.user.username not in current_app.config['ADMIN_USERS']:
+        raise Unauthorized()
+
+
+@bp.route('/admin/hot-keys')
+def admin_hot_keys():
+    """Hottest pages and query cache stats, as JSON (this worker's, or the
+    host's with SHARED_STATE_PATH)."""
+
+    require_admin()
+
+    tracker = hotkeys.current_tracker()
+    cache = caching.current_cache()
+
+    hot_keys = []
+    if tracker is not None:
+        hot_keys = [{'key': key, 'count': count, 'hot': tracker.is_hot(key)}
+                    for key, count in tracker.hottest()]
+
+    return jsonify(hot_keys=hot_keys,
+                   tracker=tracker.stats() if tracker else None,
+                   cache=cache.stats() if cache else None)
+
+
+@bp.route('/admin/prewarm')
+def admin_prewarm():
+    """Timeline prewarm and warm-hit counts, as JSON (this worker's, or the
+    host's with SHARED_STATE_PATH)."""
+
+    require_admin()
+
+    prewarmer = timelines.current_prewarmer()
+    return jsonify(prewarm=prewarmer.stats() if prewarmer else None)
+
+
+@bp.route('/admin/membership')
+def admin_membership():
+    """This worker's like and follow filter stats, as JSON."""
+
+    require_admin()
+
+    filters = membership.current_filters()
+    return jsonify(membership=filters.stats() if filters else None)
+
+
+@bp.route('/admin/shedding')
+def admin_shedding():
+    """This worker's concurrency limits and shedding counts, as JSON."""
+
+    require_admin()
+
+    return jsonify(current_app.extensions['shedding'].stats())
+
+
+@bp.app_errorhandler(404)
 def page_not_found(e):
     """404 NOT FOUND page."""
 
@@ -446,9 +983,17 @@ def page_not_found(e):
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@bp.after_app_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Fingerprinted assets and image thumbnails are the exception: their URLs
+    identify their content, so they keep the long-lived cache headers they
+    were served with.
+    """
+
+    if request.blueprint in CACHED_BLUEPRINTS:
+        return req
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
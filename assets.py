@@ -0,0 +1,272 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask assets build` copies everything under `static/` into `static/dist/`
+with a content hash in each filename (`style.css` -> `style.1a2b3c4d5e6f.css`),
+writes gzip (and brotli, if the `brotli` package is installed) variants of
+text assets next to them, and records the mapping in `manifest.json`.
+
+Templates link assets with `asset_url('stylesheets/style.css')`. Once a
+build exists, that points at the hashed file, which is served from
+`/assets/` with a one-year immutable cache header -- a new build changes the
+filename, so browsers never see a stale copy. Without a build it falls back
+to the plain `static` URL.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+
+import click
+from flask import (Blueprint, abort, current_app, request, send_from_directory,
+                   url_for)
+from flask.cli import with_appcontext
+
+try:
+    import brotli
+except ImportError:  # optional: without it only gzip variants are built
+    brotli = None
+
+MANIFEST_NAME = 'manifest.json'
+
+HASH_LENGTH = 12
+
+# Images are already compressed; only these are worth precompressing
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.ico', '.json', '.txt'}
+
+ASSETS_URL_PREFIX = '/assets/'
+
+STATIC_URL_PREFIX = '/static/'
+
+CSS_URL = re.compile(r"""url\((['"]?)([^'")]+)\1\)""")
+
+# Absolute URLs, data: URIs and fragments are left as they are
+CSS_URL_EXTERNAL = re.compile(r'^([a-z][a-z0-9+.-]*:|/|#)', re.IGNORECASE)
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+bp = Blueprint('assets', __name__)
+
+
+def content_hash(data):
+    """Return a short hex digest of `data`."""
+
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def fingerprinted_name(rel_path, digest):
+    """'stylesheets/style.css' -> 'stylesheets/style.<digest>.css'"""
+
+    root, ext = os.path.splitext(rel_path)
+    return f"{root}.{digest}{ext}"
+
+
+def css_url_target(url, css_path):
+    """Logical path `url` refers to from stylesheet `css_path`, or None.
+
+    Handles `/static/...` and URLs relative to the stylesheet (such as
+    `../images/hero.jpg`); anything else isn't one of our assets.
+    """
+
+    if url.startswith(STATIC_URL_PREFIX):
+        return url[len(STATIC_URL_PREFIX):]
+
+    if not url or CSS_URL_EXTERNAL.match(url):
+        return None
+
+    path = posixpath.normpath(
+        posixpath.join(posixpath.dirname(css_path), url))
+    return None if path.startswith('..') else path
+
+
+def rewrite_css_urls(css, manifest, css_path=''):
+    """Point `url()` references in stylesheet `css_path` at fingerprinted
+    files.
+
+    Built stylesheets are served from /assets/, so a relative URL to a
+    file that wasn't built is pointed back at /static/ instead.
+    """
+
+    def replace(match):
+        quote, url = match.groups()
+        # Keep any ?query or #fragment (font files often have one)
+        path, suffix = re.match(r'([^?#]*)(.*)', url).groups()
+        target = css_url_target(path, css_path)
+        if target is None:
+            return match.group(0)
+
+        hashed = manifest.get(target)
+        if hashed is not None:
+            new_url = ASSETS_URL_PREFIX + hashed
+        elif path.startswith(STATIC_URL_PREFIX):
+            return match.group(0)
+        else:
+            new_url = STATIC_URL_PREFIX + target
+        return f"url({quote}{new_url}{suffix}{quote})"
+
+    return CSS_URL.sub(replace, css)
+
+
+def write_asset(build_dir, hashed, data):
+    """Write `data` as `hashed` in `build_dir`, precompressing text assets.
+
+    Fingerprinted files never change, so existing ones are left alone.
+    """
+
+    dest = os.path.join(build_dir, hashed)
+
+    if os.path.exists(dest):
+        return
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with open(dest, 'wb') as f:
+        f.write(data)
+
+    if os.path.splitext(hashed)[1] in COMPRESSIBLE_EXTENSIONS:
+        with gzip.open(dest + '.gz', 'wb', compresslevel=9) as f:
+            f.write(data)
+
+        if brotli is not None:
+            with open(dest + '.br', 'wb') as f:
+                f.write(brotli.compress(data))
+
+
+def build(source_dir, build_dir):
+    """Fingerprint and precompress every file in `source_dir`.
+
+    Returns the manifest, a dict of logical path -> fingerprinted path (both
+    relative, with forward slashes), which is also written to `build_dir`.
+    Stylesheets are built last so their `url()` references, to /static/
+    or relative to the stylesheet, can be rewritten to the fingerprinted
+    images.
+    """
+
+    source_dir = os.path.abspath(source_dir)
+    build_dir = os.path.abspath(build_dir)
+    manifest = {}
+    stylesheets = []
+
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        # Never fingerprint our own output
+        dirnames[:] = [d for d in dirnames
+                       if os.path.join(dirpath, d) != build_dir]
+
+        for filename in filenames:
+            if filename.startswith('.'):
+                continue
+
+            src = os.path.join(dirpath, filename)
+            rel_path = os.path.relpath(src, source_dir).replace(os.sep, '/')
+
+            if filename.endswith('.css'):
+                stylesheets.append((rel_path, src))
+                continue
+
+            with open(src, 'rb') as f:
+                data = f.read()
+
+            hashed = fingerprinted_name(rel_path, content_hash(data))
+            write_asset(build_dir, hashed, data)
+            manifest[rel_path] = hashed
+
+    for rel_path, src in stylesheets:
+        with open(src) as f:
+            data = rewrite_css_urls(f.read(), manifest,
+                                    rel_path).encode('utf-8')
+
+        hashed = fingerprinted_name(rel_path, content_hash(data))
+        write_asset(build_dir, hashed, data)
+        manifest[rel_path] = hashed
+
+    os.makedirs(build_dir, exist_ok=True)
+    with open(os.path.join(build_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def load_manifest(build_dir):
+    """Return manifest from `build_dir`, or {} if assets were never built."""
+
+    try:
+        with open(os.path.join(build_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def build_dir_for(app):
+    """Directory holding `app`'s built assets and manifest."""
+
+    return app.config.get('ASSETS_BUILD_DIR') or os.path.join(
+        app.static_folder, 'dist')
+
+
+def asset_url(path):
+    """URL for static asset `path`, fingerprinted if a build exists."""
+
+    hashed = current_app.extensions['assets'].get(path)
+
+    if hashed is None:
+        return url_for('static', filename=path)
+
+    return url_for('assets.serve', filename=hashed)
+
+
+@bp.route(ASSETS_URL_PREFIX + '<path:filename>')
+def serve(filename):
+    """Serve a fingerprinted asset, precompressed when the client allows."""
+
+    build_dir = build_dir_for(current_app)
+    path = os.path.join(build_dir, filename)
+
+    if not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    accepted = request.headers.get('Accept-Encoding', '')
+    encoding = None
+
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if candidate in accepted and os.path.isfile(path + suffix):
+            encoding = candidate
+            filename += suffix
+            break
+
+    resp = send_from_directory(build_dir, filename, mimetype=mimetype)
+
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    resp.headers['Vary'] = 'Accept-Encoding'
+    resp.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+
+    return resp
+
+
+@click.group('assets')
+def assets_cli():
+    """Manage fingerprinted static assets."""
+
+
+@assets_cli.command('build')
+@with_appcontext
+def build_command():
+    """Fingerprint and precompress everything under static/."""
+
+    app = current_app._get_current_object()
+    manifest = build(app.static_folder, build_dir_for(app))
+    app.extensions['assets'] = manifest
+
+    click.echo(f"Built {len(manifest)} asset(s)")
+
+
+def init_app(app):
+    """Register asset serving, `asset_url` and the CLI on `app`."""
+
+    app.extensions['assets'] = load_manifest(build_dir_for(app))
+    app.add_template_global(asset_url)
+    app.register_blueprint(bp)
+    app.cli.add_command(assets_cli)
@@ -0,0 +1,119 @@
+"""Benchmark: list pages read as ORM objects vs plain rows (rows.py).
+
+Times the users list and a 100-message timeline both ways, and measures
+the memory each holds (tracemalloc peak while the list is built and
+kept). The ORM path loads every column into a tracked model instance;
+rows load only what the templates show.
+
+Test data is inserted inside a transaction that is rolled back at the end,
+so any database will do:
+
+    DATABASE_URL=postgresql:///warbler_test python bench_rows.py
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from app import create_app
+from models import db, User, Message, FollowersFollowee
+import rows
+import timelines
+
+REPEATS = 5
+
+
+def add_data(users, messages, bio_length):
+    """Users with long bios, each following the first 50, and messages."""
+
+    db.session.bulk_insert_mappings(User, [
+        {'username': f'bench{n}', 'email': f'bench{n}@test.com',
+         'password': 'x' * 60, 'bio': 'b' * bio_length}
+        for n in range(users)])
+    ids = [user_id for (user_id,) in db.session.query(User.id)
+           .filter(User.username.like('bench%')).order_by(User.id)]
+
+    db.session.bulk_insert_mappings(FollowersFollowee, [
+        {'follower_id': ids[0], 'followee_id': followee_id}
+        for followee_id in ids[1:51]])
+    db.session.bulk_insert_mappings(Message, [
+        {'text': 'm' * 140, 'user_id': ids[n % 51]}
+        for n in range(messages)])
+
+    return ids[0]
+
+
+def measure(load):
+    """(best ms, peak KiB) over REPEATS runs of `load()`."""
+
+    best = float('inf')
+    peak = 0
+
+    for _ in range(REPEATS):
+        db.session.expunge_all()
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = load()
+        elapsed = time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        best = min(best, elapsed)
+        del result
+
+    return best * 1000, peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--bio-length', type=int, default=500)
+    args = parser.parse_args()
+
+    app = create_app({'QUERY_CACHE': False})
+
+    with app.app_context():
+        try:
+            user_id = add_data(args.users, args.messages, args.bio_length)
+            following = [user_id] + [followee_id for (followee_id,) in
+                                     db.session.query(
+                                         FollowersFollowee.followee_id)
+                                     .filter_by(follower_id=user_id)]
+
+            def users_orm():
+                return User.active().order_by(User.id).all()
+
+            def users_rows():
+                return list(rows.user_cards(
+                    rows.user_cards_query().order_by(User.id)))
+
+            def timeline_orm():
+                page = (Message.visible()
+                        .filter(Message.user_id.in_(following))
+                        .order_by(Message.id.desc())
+                        .limit(timelines.PAGE_SIZE)
+                        .all())
+                # What the template touches
+                return [(msg.user.username, msg.text) for msg in page], page
+
+            def timeline_rows():
+                page = list(rows.message_rows(
+                    rows.messages_query()
+                    .filter(Message.user_id.in_(following))
+                    .order_by(Message.id.desc())
+                    .limit(timelines.PAGE_SIZE)))
+                return [(msg.user.username, msg.text) for msg in page], page
+
+            print(f"{'page':<10} {'path':<5} {'ms':>8} {'peak KiB':>10}")
+            for name, orm, plain in [('users', users_orm, users_rows),
+                                     ('timeline', timeline_orm,
+                                      timeline_rows)]:
+                for path, load in [('orm', orm), ('rows', plain)]:
+                    ms, kib = measure(load)
+                    print(f"{name:<10} {path:<5} {ms:>8.2f} {kib:>10.0f}")
+        finally:
+            db.session.rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""Benchmark: sync vs green-thread (green.py) workers under concurrent load.
+
+Starts gunicorn with the same number of workers in each mode and fetches
+profile and message pages with rising numbers of concurrent clients,
+reporting throughput and latency. Sync workers top out at one request per
+worker; green workers keep overlapping requests while they wait on the
+database.
+
+Postgres on localhost answers in well under a millisecond, which hides
+the waiting that matters in production, so every query is delayed by
+--latency-ms (default 5) to stand in for a network round trip.
+
+Needs a database with users and messages in it (see seed.py):
+
+    DATABASE_URL=postgresql:///warbler python bench_serving.py --workers 2
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, text
+
+CONCURRENCY = [1, 8, 32, 64]
+REQUESTS = 256
+
+
+def slow_app(latency_ms):
+    """The app, with `latency_ms` added to every database round trip.
+
+    Load shedding is off, so every request is served however slow.
+    """
+
+    from app import create_app
+
+    return create_app({'FAULT_DB_LATENCY_MS': latency_ms,
+                       'LOAD_SHEDDING': False})
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, workers, latency_ms):
+    port = free_port()
+    command = [sys.executable, '-m', 'gunicorn',
+               '--workers', str(workers),
+               '--bind', f'127.0.0.1:{port}',
+               '--timeout', '120',
+               '--log-level', 'warning']
+    if mode == 'green':
+        command += ['--config', 'green.py']
+    command.append(f'bench_serving:slow_app({latency_ms})')
+
+    server = subprocess.Popen(command,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    base = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(base + '/', timeout=1).read()
+            return server, base
+        except OSError:
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError(f"{mode} server didn't start")
+
+
+def fetch(url):
+    start = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=120) as resp:
+        resp.read()
+    return time.perf_counter() - start
+
+
+def run(base, paths, concurrency):
+    urls = [base + paths[n % len(paths)] for n in range(REQUESTS)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = sorted(pool.map(fetch, urls))
+    elapsed = time.perf_counter() - start
+
+    return (REQUESTS / elapsed,
+            statistics.median(latencies) * 1000,
+            latencies[int(len(latencies) * 0.95)] * 1000)
+
+
+def sample_paths(database_url):
+    engine = create_engine(database_url)
+    with engine.connect() as conn:
+        user_ids = [row[0] for row in conn.execute(text(
+            "SELECT id FROM users WHERE deleted_at IS NULL "
+            "ORDER BY id LIMIT 20"))]
+        message_ids = [row[0] for row in conn.execute(text(
+            "SELECT id FROM messages ORDER BY id DESC LIMIT 20"))]
+    engine.dispose()
+
+    if not user_ids:
+        raise SystemExit("No users to fetch; seed the database first")
+
+    return ([f'/users/{user_id}' for user_id in user_ids] +
+            [f'/messages/{message_id}' for message_id in message_ids])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--latency-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    paths = sample_paths(os.environ.get('DATABASE_URL',
+                                        'postgresql:///warbler'))
+
+    print(f"{args.workers} worker(s), {args.latency_ms}ms per query, "
+          f"{REQUESTS} requests per row")
+    print(f"{'mode':>6} {'clients':>8} {'req/s':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8}")
+
+    for mode in ['sync', 'green']:
+        server, base = start_server(mode, args.workers, args.latency_ms)
+        try:
+            run(base, paths, 4)  # warm up
+            for concurrency in CONCURRENCY:
+                rate, p50, p95 = run(base, paths, concurrency)
+                print(f"{mode:>6} {concurrency:>8} {rate:>8.1f} "
+                      f"{p50:>8.1f} {p95:>8.1f}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
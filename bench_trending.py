@@ -0,0 +1,59 @@
+"""Benchmark: trending reads stay flat as like events pile up.
+
+Feeds a TrendingTracker a stream of like/unlike events over a growing pool
+of messages (skewed so some are hot), and times top-K reads after each
+stage. Read time should not grow with the number of events or messages.
+
+    python bench_trending.py
+"""
+
+import random
+import time
+
+from trending import TrendingTracker
+
+STAGES = [1000, 10000, 100000, 1000000]
+READS = 10000
+
+
+class SimulatedClock:
+    """One like event per simulated 10ms."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def main():
+    random.seed(0)
+    clock = SimulatedClock()
+    tracker = TrendingTracker(clock=clock)
+    events = 0
+
+    print(f"{'events':>10} {'messages':>9} {'tracked':>8} "
+          f"{'record us':>10} {'top() us':>9}")
+
+    for stage in STAGES:
+        messages = max(stage // 10, 100)
+
+        start = time.perf_counter()
+        for _ in range(stage - events):
+            clock.now += 0.01
+            message_id = int(random.paretovariate(1.2) * 10) % messages
+            tracker.record(message_id, 1 if random.random() < 0.9 else -1)
+        record_us = (time.perf_counter() - start) / (stage - events) * 1e6
+        events = stage
+
+        start = time.perf_counter()
+        for _ in range(READS):
+            tracker.top(20)
+        read_us = (time.perf_counter() - start) / READS * 1e6
+
+        print(f"{events:>10} {messages:>9} {len(tracker.scores):>8} "
+              f"{record_us:>10.2f} {read_us:>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,822 @@
+"""Versioned cache regions for users and their follows and likes.
+
+Data is cached in named regions, each with its own TTL (REGIONS, or the
+CACHE_TTLS setting):
+
+- `users`: user rows by id, for `g.user` and profile lookups, and the
+  lighter user cards (rows.py) that follow lists show
+- `follows`: ids a user follows, and ids following them
+- `likes`: ids of the messages a user has liked
+- `messages`: messages by id, and how many messages each user has posted
+- `timelines`: first homepage pages built ahead of time (timelines.py)
+
+Every entry is keyed on the version of the entity it was built from, e.g.
+a user's follow lists on version ('follows', user_id). Write routes call
+`forget_user()`, `forget_follow()` or `forget_likes()` after committing.
+These change that version, so the old entries are never read again and
+simply age out; nothing has to find and delete them. Versions are read
+before the data is loaded, so a write that lands in between leaves the
+new entry under a version that's already dead, never the other way round.
+
+Invalidation only works if every worker sees the same versions, so the
+cache only runs when they do:
+
+- With CACHE_REDIS_URL set (and the `redis` package installed), entries
+  and versions go to Redis.
+- With SHARED_STATE_PATH set (shared.py), entries stay in each worker's
+  own LRU but versions go to a shared table, so a change made through
+  one worker retires every worker's copies straight away.
+- Otherwise it is off. A single process (`flask run`, tests) can turn it
+  on anyway with QUERY_CACHE set to True.
+
+Users and messages are cached as their column values, without the
+password hash, and rebuilt as detached rows that are merged into the
+session without a query. Other values are pickled as they are. Templates
+keep using `user.following` and `user.followers`: views pass
+`profile(user)`, which answers those from the cache.
+
+Misses are coalesced. When several requests in a worker miss on the same
+entry at once (a popular profile just got linked), one of them loads it
+and the rest wait for and share its result, so the database sees one query
+instead of hundreds. With a shared backend, workers also coalesce with
+each other through Postgres advisory locks: a worker that finds another
+loading an entry waits, up to LOCK_WAIT, for it to appear in the cache.
+Set CACHE_LOCKS to False to only coalesce within each worker.
+
+Set QUERY_CACHE to False to switch caching off.
+"""
+
+import hashlib
+import os
+import pickle
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import abort, current_app, has_app_context
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import make_transient_to_detached
+
+import hotkeys
+import rows
+import shared
+from models import db, User, Message, FollowersFollowee, Like
+
+# Seconds entries in each region live for
+REGIONS = {
+    'users': 300,
+    'follows': 120,
+    'likes': 120,
+    'messages': 60,
+    'timelines': 30,
+}
+
+# Most entries (values and versions) the in-process backend holds
+MAX_ENTRIES = 50000
+
+# Versions outlive anything cached under them; losing one early only
+# costs misses, since it comes back as a fresh version
+VERSION_TTL = 24 * 60 * 60
+
+KEY_PREFIX = 'warbler:'
+
+# Longest a worker waits on another worker's load (ms) before doing its own
+LOCK_WAIT = 2000
+
+
+def _new_version():
+    return uuid.uuid4().hex
+
+
+class MemoryBackend:
+    """In-process LRU of bytes values with per-entry expiry.
+
+    Versions are kept in the same LRU, unless `versions` (SharedVersions)
+    is given to keep them where every worker sees them.
+    """
+
+    # Entries are this process's alone
+    shared_entries = False
+
+    def __init__(self, max_entries=MAX_ENTRIES, versions=None):
+        self.max_entries = max_entries
+        self.shared_versions = versions
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < now:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def _set(self, key, value, ttl, now):
+        self._data[key] = (now + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            return [self._get(key, now) for key in keys]
+
+    def set_many(self, values, ttl):
+        now = time.monotonic()
+        with self._lock:
+            for key, value in values.items():
+                self._set(key, value, ttl, now)
+
+    def versions(self, keys):
+        if self.shared_versions is not None:
+            return self.shared_versions.versions(keys)
+
+        now = time.monotonic()
+        with self._lock:
+            found = []
+            for key in keys:
+                version = self._get(key, now)
+                if version is None:
+                    version = _new_version()
+                    self._set(key, version, VERSION_TTL, now)
+                found.append(version)
+            return found
+
+    def bump(self, keys):
+        if self.shared_versions is not None:
+            self.shared_versions.bump(keys)
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                self._set(key, _new_version(), VERSION_TTL, now)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SharedVersions:
+    """Versions in a shared table (shared.py), seen by every worker.
+
+    A version is a random number rather than a count: one that is evicted
+    from the full table comes back as a new version, which only costs
+    misses and can never bring old entries back.
+    """
+
+    def __init__(self, table):
+        self._table = table
+
+    @property
+    def table(self):
+        # A table opened before a fork has the parent's locks
+        if self._table.pid != os.getpid():
+            self._table = shared.SharedTable(self._table.path,
+                                             self._table.slots,
+                                             self._table.stripes)
+        return self._table
+
+    @staticmethod
+    def _fresh(current=None):
+        return float(random.getrandbits(52) + 1)
+
+    def versions(self, keys):
+        table = self.table
+        return ['%d' % table.update(key[len(KEY_PREFIX):],
+                                    lambda version: version or self._fresh(),
+                                    evict=True)
+                for key in keys]
+
+    def bump(self, keys):
+        table = self.table
+        for key in keys:
+            table.update(key[len(KEY_PREFIX):], self._fresh, evict=True)
+
+
+class RedisBackend:
+    """Shared backend: the same calls, against a Redis server."""
+
+    shared_entries = True
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def get_many(self, keys):
+        return self.client.mget(keys) if keys else []
+
+    def set_many(self, values, ttl):
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipe.set(key, value, ex=ttl)
+        pipe.execute()
+
+    def versions(self, keys):
+        if not keys:
+            return []
+
+        found = self.client.mget(keys)
+        missing = [key for key, version in zip(keys, found) if version is None]
+        if missing:
+            # Another process may be creating the same ones; first one wins
+            pipe = self.client.pipeline(transaction=False)
+            for key in missing:
+                pipe.set(key, _new_version(), ex=VERSION_TTL, nx=True)
+            pipe.execute()
+            found = self.client.mget(keys)
+
+        return [version.decode() for version in found]
+
+    def bump(self, keys):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.set(key, _new_version(), ex=VERSION_TTL)
+        pipe.execute()
+
+    def clear(self):
+        keys = list(self.client.scan_iter(f'{KEY_PREFIX}*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+def _version_key(entity, entity_id):
+    return f"{KEY_PREFIX}v:{entity}:{entity_id}"
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.results = {}
+        self.error = None
+
+
+class SingleFlight:
+    """Lets one caller at a time load each key; others wait and share.
+
+    `begin(keys)` splits keys into those the caller must load (it is now
+    their leader) and flights already under way for the rest. The leader
+    passes its results to `finish()`, which wakes the waiters.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def begin(self, keys):
+        leading = _Flight()
+        waiting = {}
+
+        with self._lock:
+            for key in keys:
+                flight = self._flights.get(key)
+                if flight is None:
+                    self._flights[key] = leading
+                else:
+                    waiting[key] = flight
+
+        led = [key for key in keys if key not in waiting]
+        return (leading if led else None), led, waiting
+
+    def finish(self, flight, keys, results=None, error=None):
+        flight.results = results or {}
+        flight.error = error
+
+        with self._lock:
+            for key in keys:
+                del self._flights[key]
+
+        flight.done.set()
+
+    @staticmethod
+    def wait(flight, key):
+        """The leader's result for `key` (None if it found nothing)."""
+
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.results.get(key)
+
+
+class AdvisoryLocks:
+    """Named locks shared by every worker, held in Postgres."""
+
+    def __init__(self, wait_ms=LOCK_WAIT):
+        self.wait_ms = wait_ms
+
+    @staticmethod
+    def lock_id(name):
+        digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big', signed=True)
+
+    @contextmanager
+    def hold(self, name):
+        """Hold lock `name`, waiting up to `wait_ms` for it.
+
+        Yields whether the lock was got; after waiting that long, carries
+        on without it rather than stall the request.
+        """
+
+        lock_id = self.lock_id(name)
+
+        # A connection of its own, so the lock outlives neither this block
+        # nor the caller's transaction
+        with db.engine.connect() as conn:
+            acquired = False
+            try:
+                with conn.begin():
+                    conn.execute(text(
+                        f"SET LOCAL lock_timeout = {int(self.wait_ms)}"))
+                    conn.execute(text("SELECT pg_advisory_lock(:id)"),
+                                 id=lock_id)
+                acquired = True
+            except OperationalError:
+                pass
+
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    conn.execute(text("SELECT pg_advisory_unlock(:id)"),
+                                 id=lock_id)
+
+
+class Cache:
+    """Named regions over one backend, with hit and miss counts.
+
+    With `locks` (AdvisoryLocks), single-entry misses are coalesced
+    across workers as well as within this one. `ttl_factor(region, key)`
+    can stretch the TTL of particular entries (see hotkeys.py). Hits and
+    misses go to `counters` (see shared.py), this process's own by default.
+    `shared_versions` says whether every worker sees the backend's
+    versions.
+    """
+
+    def __init__(self, backend, ttls=None, locks=None, ttl_factor=None,
+                 counters=None, shared_versions=False):
+        self.backend = backend
+        self.shared_versions = shared_versions
+        self.ttls = dict(REGIONS, **(ttls or {}))
+        self.locks = locks
+        self.ttl_factor = ttl_factor or (lambda region, key: 1)
+        self.counters = counters or shared.LocalCounters()
+        self.flights = SingleFlight()
+
+    def get_many(self, region, keys, entities, create):
+        """{key: value} for `keys`, each cached under its entity's version.
+
+        `entities` gives the (entity, id) each key's value depends on.
+        `create(missing_keys)` loads the misses as a dict; keys it leaves
+        out aren't cached.
+        """
+
+        versions = self.backend.versions(
+            [_version_key(*entity) for entity in entities])
+        full_keys = {key: f"{KEY_PREFIX}{region}:{key}@{version}"
+                     for key, version in zip(keys, versions)}
+
+        found = {}
+        missing = []
+        raw_values = self.backend.get_many([full_keys[key] for key in keys])
+        for key, raw in zip(keys, raw_values):
+            if raw is None:
+                missing.append(key)
+            else:
+                found[key] = pickle.loads(raw)
+
+        self.counters.add(f'hits:{region}', len(found))
+        self.counters.add(f'misses:{region}', len(missing))
+
+        if missing:
+            found.update(self._fill(region, missing, full_keys, create))
+
+        return found
+
+    def _fill(self, region, keys, full_keys, create):
+        """Load missing `keys`, coalescing with other loads of them."""
+
+        names = [full_keys[key] for key in keys]
+        flight, led, waiting = self.flights.begin(names)
+        self.counters.add(f'coalesced:{region}', len(waiting))
+
+        made = {}
+        if flight is not None:
+            led_keys = [key for key in keys if full_keys[key] in led]
+            try:
+                made, raw = self._load(region, led_keys, full_keys, create)
+            except BaseException as error:
+                self.flights.finish(flight, led, error=error)
+                raise
+            self.flights.finish(flight, led, raw)
+
+        for key in keys:
+            name = full_keys[key]
+            if name in waiting:
+                # Each waiter unpickles its own copy
+                raw = SingleFlight.wait(waiting[name], name)
+                if raw is not None:
+                    made[key] = pickle.loads(raw)
+
+        return made
+
+    def _load(self, region, keys, full_keys, create):
+        """(values, {full key: pickled value}) for `keys`, from `create`.
+
+        A single key is loaded under a cross-worker lock, if there are
+        locks; whoever gets it second finds the first one's result.
+        """
+
+        if self.locks is None or len(keys) != 1:
+            return self._create(region, keys, full_keys, create)
+
+        name = full_keys[keys[0]]
+        with self.locks.hold(name):
+            raw = self.backend.get_many([name])[0]
+            if raw is not None:
+                self.counters.add(f'coalesced:{region}')
+                return {keys[0]: pickle.loads(raw)}, {name: raw}
+            return self._create(region, keys, full_keys, create)
+
+    def _create(self, region, keys, full_keys, create):
+        made = create(keys)
+        raw = {full_keys[key]: pickle.dumps(value)
+               for key, value in made.items()}
+
+        by_ttl = {}
+        for key in made:
+            ttl = self.ttls[region] * self.ttl_factor(region, key)
+            by_ttl.setdefault(ttl, {})[full_keys[key]] = raw[full_keys[key]]
+        for ttl, values in by_ttl.items():
+            self.backend.set_many(values, ttl)
+
+        return made, raw
+
+    def get(self, region, key, entity, create):
+        """Cached value of `key`, or `create()`'s (not cached if None)."""
+
+        def create_one(keys):
+            value = create()
+            return {} if value is None else {key: value}
+
+        return self.get_many(region, [key], [entity], create_one).get(key)
+
+    def version(self, entity):
+        """Current version of an (entity, id) pair."""
+
+        return self.backend.versions([_version_key(*entity)])[0]
+
+    def bump(self, *entities):
+        """Retire everything cached from these (entity, id) pairs."""
+
+        self.backend.bump([_version_key(*entity) for entity in entities])
+
+    def stats(self):
+        return {region: {name: self.counters.get(f'{name}:{region}')
+                         for name in ('hits', 'misses', 'coalesced')}
+                for region in self.ttls}
+
+    def clear(self):
+        self.backend.clear()
+
+
+_init_lock = threading.Lock()
+
+
+def current_cache():
+    """The app's cache, or None if it's off.
+
+    It's off if QUERY_CACHE is False, or if workers wouldn't share its
+    versions (no CACHE_REDIS_URL or SHARED_STATE_PATH) and QUERY_CACHE
+    isn't True.
+    """
+
+    if not has_app_context():
+        return None
+
+    config = current_app.config
+    setting = config.get('QUERY_CACHE')
+    if setting is False or (setting is not True and
+                            not config.get('CACHE_REDIS_URL') and
+                            not config.get('SHARED_STATE_PATH')):
+        return None
+
+    app = current_app._get_current_object()
+    cache = app.extensions.get('query_cache')
+
+    if cache is None:
+        with _init_lock:
+            cache = app.extensions.get('query_cache')
+            if cache is None:
+                cache = _make_cache(app)
+                app.extensions['query_cache'] = cache
+
+    return cache
+
+
+def _make_cache(app):
+    url = app.config.get('CACHE_REDIS_URL')
+    if url:
+        backend = RedisBackend(url)
+    else:
+        table = shared.current_table('versions')
+        backend = MemoryBackend(
+            versions=SharedVersions(table) if table is not None else None)
+    is_shared = bool(url) or backend.shared_versions is not None
+
+    # Only worth it when workers can see each other's results
+    locks = None
+    if url and app.config.get('CACHE_LOCKS', True):
+        locks = AdvisoryLocks()
+
+    # Hot entries may only outlive their TTL if a write through any worker
+    # retires them
+    ttl_factor = hotkeys.cache_ttl_factor if is_shared else None
+
+    return Cache(backend, app.config.get('CACHE_TTLS'), locks, ttl_factor,
+                 shared.counters('cache'), shared_versions=is_shared)
+
+
+##############################################################################
+# Lookups
+
+
+def _fields(model, leave_out=()):
+    return [attr.key for attr in inspect(model).column_attrs
+            if attr.key not in leave_out]
+
+
+# What's cached of users and messages
+USER_FIELDS = _fields(User, leave_out={'password'})
+MESSAGE_FIELDS = _fields(Message)
+
+
+def _values(row, fields):
+    return {field: getattr(row, field) for field in fields}
+
+
+def _attach(model, values):
+    """A `model` row with cached `values`, merged into the session without
+    a query. Columns that weren't cached load when first used."""
+
+    row = model(**values)
+    make_transient_to_detached(row)
+    return db.session.merge(row, load=False)
+
+
+def _load_users(user_ids):
+    return {user.id: _values(user, USER_FIELDS)
+            for user in User.active().filter(User.id.in_(user_ids))}
+
+
+def user(user_id):
+    """Active user with id `user_id`, or None."""
+
+    cache = current_cache()
+    if cache is None:
+        return User.active().filter_by(id=user_id).first()
+
+    found = cache.get_many('users', [user_id], [('user', user_id)],
+                           _load_users).get(user_id)
+    return _attach(User, found) if found is not None else None
+
+
+def user_or_404(user_id):
+    """Active user with id `user_id`; 404 if there isn't one."""
+
+    found = user(user_id)
+    if found is None:
+        abort(404)
+    return found
+
+
+def users(user_ids):
+    """Active users with these ids, in the same order."""
+
+    cache = current_cache()
+    if cache is None:
+        found = _load_users(user_ids)
+    else:
+        found = cache.get_many('users', user_ids,
+                               [('user', user_id) for user_id in user_ids],
+                               _load_users)
+        found = {user_id: _attach(User, values)
+                 for user_id, values in found.items()}
+
+    return [found[user_id] for user_id in user_ids if user_id in found]
+
+
+def user_cards(user_ids):
+    """Cards (rows.UserCard) of the active users among `user_ids`, in the
+    same order."""
+
+    cache = current_cache()
+    if cache is None:
+        found = rows.user_cards_by_id(user_ids)
+    else:
+        found = cache.get_many('users', [f'card:{user_id}'
+                                         for user_id in user_ids],
+                               [('user', user_id) for user_id in user_ids],
+                               _load_cards)
+        found = {card.id: card for card in found.values()}
+
+    return [found[user_id] for user_id in user_ids if user_id in found]
+
+
+def _load_cards(keys):
+    cards = rows.user_cards_by_id([int(key[len('card:'):]) for key in keys])
+    return {f'card:{user_id}': card for user_id, card in cards.items()}
+
+
+def _ids(region, key, entity, query):
+    cache = current_cache()
+    if cache is None:
+        return [row[0] for row in query]
+    return cache.get(region, key, entity, lambda: [row[0] for row in query])
+
+
+def following_ids(user_id):
+    """Ids of the users `user_id` follows (deleted ones included)."""
+
+    return _ids('follows', f'following:{user_id}', ('follows', user_id),
+                db.session
+                .query(FollowersFollowee.followee_id)
+                .filter(FollowersFollowee.follower_id == user_id)
+                .order_by(FollowersFollowee.followee_id))
+
+
+def follower_ids(user_id):
+    """Ids of the users following `user_id` (deleted ones included)."""
+
+    return _ids('follows', f'followers:{user_id}', ('follows', user_id),
+                db.session
+                .query(FollowersFollowee.follower_id)
+                .filter(FollowersFollowee.followee_id == user_id)
+                .order_by(FollowersFollowee.follower_id))
+
+
+def liked_message_ids(user_id):
+    """Ids of the messages `user_id` has liked."""
+
+    return _ids('likes', user_id, ('likes', user_id),
+                db.session
+                .query(Like.message_id)
+                .filter(Like.user_id == user_id))
+
+
+def message(message_id):
+    """Message `message_id`, or None if it or its author is gone."""
+
+    cache = current_cache()
+    if cache is None:
+        return Message.visible().filter(Message.id == message_id).first()
+
+    def load():
+        found = Message.query.get(message_id)
+        return _values(found, MESSAGE_FIELDS) if found is not None else None
+
+    found = cache.get('messages', message_id, ('message', message_id), load)
+    # Deleted authors are forgotten at once, and their messages with them
+    if found is None or user(found['user_id']) is None:
+        return None
+    return _attach(Message, found)
+
+
+def message_or_404(message_id):
+    """Message `message_id`; 404 if it or its author is gone."""
+
+    found = message(message_id)
+    if found is None:
+        abort(404)
+    return found
+
+
+def message_count(user_id):
+    """How many messages `user_id` has posted."""
+
+    def count():
+        return Message.query.filter(Message.user_id == user_id).count()
+
+    cache = current_cache()
+    if cache is None:
+        return count()
+    return cache.get('messages', f'count:{user_id}', ('messages', user_id),
+                     count)
+
+
+##############################################################################
+# Templates
+
+
+class UserList(list):
+    """Users in a list that also answers `.count()`, like a query."""
+
+    def count(self, *args):
+        if args:
+            return super().count(*args)
+        return len(self)
+
+
+class CountedQuery:
+    """A query whose `.count()` comes from the cache."""
+
+    def __init__(self, query, count):
+        self._query = query
+        self._count = count
+
+    def count(self):
+        return self._count()
+
+    def __iter__(self):
+        return iter(self._query)
+
+    def __getattr__(self, name):
+        return getattr(self._query, name)
+
+
+class CachedProfile:
+    """Stands in for a User in templates, with follow lists (as user
+    cards) and message count from the cache.
+
+    Anything else is passed through to the user.
+    """
+
+    def __init__(self, user):
+        self._user = user
+
+    def __getattr__(self, name):
+        return getattr(self._user, name)
+
+    @property
+    def messages(self):
+        return CountedQuery(self._user.messages,
+                            lambda: message_count(self._user.id))
+
+    @property
+    def following(self):
+        return UserList(user_cards(following_ids(self._user.id)))
+
+    @property
+    def followers(self):
+        return UserList(user_cards(follower_ids(self._user.id)))
+
+
+def profile(user):
+    """`user` for a template; follow lists and counts come from the cache."""
+
+    if current_cache() is None:
+        return user
+    return CachedProfile(user)
+
+
+##############################################################################
+# Invalidation; call these after committing
+
+
+def forget_user(user_id):
+    """The user's row changed (profile edit, deletion)."""
+
+    cache = current_cache()
+    if cache is not None:
+        cache.bump(('user', user_id))
+
+
+def forget_follow(follower_id, followee_id):
+    """`follower_id` followed or unfollowed `followee_id`."""
+
+    cache = current_cache()
+    if cache is not None:
+        cache.bump(('follows', follower_id), ('follows', followee_id),
+                   ('timeline', follower_id))
+
+
+def forget_message(*message_ids):
+    """These messages changed (deleted, or replied to)."""
+
+    cache = current_cache()
+    if cache is not None and message_ids:
+        cache.bump(*(('message', message_id) for message_id in message_ids))
+
+
+def forget_messages(user_id):
+    """The user posted or deleted a message."""
+
+    cache = current_cache()
+    if cache is not None:
+        cache.bump(('messages', user_id), ('timeline', user_id))
+
+
+def forget_likes(user_id):
+    """The user liked or unliked something."""
+
+    cache = current_cache()
+    if cache is not None:
+        cache.bump(('likes', user_id))
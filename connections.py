@@ -0,0 +1,169 @@
+"""Mutual-connection info for profile pages.
+
+For a viewer looking at a profile, works out:
+
+- which accounts the viewer follows that also follow the profile
+  ("Followed by @a, @b and 3 others you follow")
+- whether the viewer follows the profile, and whether it follows them back
+
+The "followed by" list is a single join that starts from the accounts the
+viewer follows and probes the follows primary key for each, so its cost
+depends on how many people the viewer follows, not on how many followers
+the profile has. When the in-memory follow graph is on, the same
+intersection runs against it instead of the DB.
+
+The "followed by" list is cached briefly per (viewer, profile) pair, in
+each worker; a viewer's own follows and unfollows clear their entries in
+the worker that handles them, and other workers' copies expire within
+CACHE_TTL. Whether the two follow each other is never cached here: it
+comes from `User.is_following()` on every view, since it decides the
+Follow / Unfollow button.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import and_, func
+from sqlalchemy.orm import aliased
+
+import graph
+from models import db, User, FollowersFollowee
+
+# How many "followed by" names to show
+SHOWN = 3
+
+CACHE_TTL = 60
+
+CACHE_SIZE = 10000
+
+
+class Connections(namedtuple('Connections', ['followed_by', 'total',
+                                             'you_follow', 'follows_you'])):
+    """Mutual-connection info of a profile for a viewer.
+
+    `followed_by` is up to SHOWN (id, username) pairs out of `total`
+    accounts the viewer follows that follow the profile.
+    """
+
+    __slots__ = ()
+
+    @property
+    def mutual(self):
+        return self.you_follow and self.follows_you
+
+
+class _TTLCache:
+    """Small LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def discard_where(self, predicate):
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_cache = _TTLCache(CACHE_SIZE, CACHE_TTL)
+
+
+def _followed_by_from_db(viewer_id, profile_id):
+    via = aliased(FollowersFollowee)
+    back = aliased(FollowersFollowee)
+
+    rows = (db.session
+            .query(User.id, User.username, func.count().over())
+            .join(via, and_(via.followee_id == User.id,
+                            via.follower_id == viewer_id))
+            .join(back, and_(back.follower_id == User.id,
+                             back.followee_id == profile_id))
+            .filter(User.deleted_at.is_(None))
+            .order_by(User.username)
+            .limit(SHOWN)
+            .all())
+
+    return [(row[0], row[1]) for row in rows], rows[0][2] if rows else 0
+
+
+def _followed_by_from_graph(index, viewer_id, profile_id):
+    in_common = [user_id for user_id in index.following(viewer_id)
+                 if index.is_following(user_id, profile_id)]
+
+    names = []
+    if in_common:
+        names = (db.session
+                 .query(User.id, User.username)
+                 .filter(User.id.in_(in_common),
+                         User.deleted_at.is_(None))
+                 .order_by(User.username)
+                 .limit(SHOWN)
+                 .all())
+
+    return [(row[0], row[1]) for row in names], len(in_common)
+
+
+def for_profile(viewer, profile):
+    """Connections between `viewer` and `profile` users, or None.
+
+    None when nobody is logged in or users are looking at themselves.
+    """
+
+    if viewer is None or viewer.id == profile.id:
+        return None
+
+    key = (viewer.id, profile.id)
+    followed_by = _cache.get(key)
+
+    if followed_by is None:
+        index = graph.current_graph()
+        if index is not None:
+            followed_by = _followed_by_from_graph(index, viewer.id,
+                                                  profile.id)
+        else:
+            followed_by = _followed_by_from_db(viewer.id, profile.id)
+        _cache.set(key, followed_by)
+
+    return Connections(followed_by=followed_by[0],
+                       total=followed_by[1],
+                       you_follow=viewer.is_following(profile),
+                       follows_you=viewer.is_followed_by(profile))
+
+
+def forget_follow(follower_id, followee_id):
+    """Drop cached lists made stale by a follow or unfollow: everything
+    the follower has viewed."""
+
+    _cache.discard_where(lambda key: key[0] == follower_id)
+
+
+def clear_cache():
+    """Forget every cached result."""
+
+    _cache.clear()
@@ -0,0 +1,207 @@
+"""Account deletion: hide the account now, purge its rows in the background.
+
+Deleting a user through the ORM loads their messages, likes and follows to
+cascade them, all in one transaction. For a busy account that takes seconds
+and holds locks on the hottest tables while the user waits.
+
+Instead, `tombstone()` sets `User.deleted_at`, which hides the account from
+every page straight away, and queues a `purge_account` job. The job deletes
+the account's rows PURGE_BATCH_SIZE at a time, one short transaction per
+batch, and records how far it got in `account_purges` in the same
+transaction as each batch's deletes. After a crash the job is requeued
+(see `jobs.requeue_stale()`) and carries on from the recorded stage. A job
+that has done MAX_BATCHES_PER_JOB batches queues a fresh one and returns,
+so one huge account doesn't tie up a worker.
+
+Each batch of messages is also taken out of the reply counts of the
+threads they were replies in (see `threads.remove()`), in the same
+transaction, so other users' messages don't go on counting purged replies.
+
+    flask deletion status     # progress of unfinished purges
+    flask deletion resume     # requeue purges whose job gave up
+"""
+
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import or_, select, tuple_
+
+import threads
+from jobs import enqueue, task
+from models import (db, User, Message, Like, FollowersFollowee, Suggestion,
+                    MessageTag, Mention, AccountPurge)
+
+PURGE_BATCH_SIZE = 1000
+
+MAX_BATCHES_PER_JOB = 100
+
+DONE = 'done'
+
+
+def _delete_batch(model, where, limit, returning=None):
+    """Delete up to `limit` rows of `model` matching `where`; return count.
+
+    With a `returning` column, return that column of each deleted row.
+    """
+
+    keys = list(model.__table__.primary_key.columns)
+    batch = select(keys).where(where).limit(limit).correlate(None)
+
+    if len(keys) == 1:
+        in_batch = keys[0].in_(batch)
+    else:
+        in_batch = tuple_(*keys).in_(batch)
+
+    delete = model.__table__.delete().where(in_batch)
+
+    if returning is not None:
+        return [value for (value,) in
+                db.session.execute(delete.returning(returning))]
+
+    return db.session.execute(delete).rowcount
+
+
+# (stage, model, AccountPurge counter or None, rows to delete for a user).
+# Likes, tags and mentions of the account's messages go before the
+# messages, so deleting a message never cascades to more than a few rows.
+STAGES = [
+    ('follows', FollowersFollowee, 'follows',
+     lambda user_id: FollowersFollowee.follower_id == user_id),
+    ('followers', FollowersFollowee, 'follows',
+     lambda user_id: FollowersFollowee.followee_id == user_id),
+    ('likes', Like, 'likes',
+     lambda user_id: Like.user_id == user_id),
+    ('message_likes', Like, 'likes',
+     lambda user_id: Like.message_id.in_(
+         select([Message.id]).where(Message.user_id == user_id))),
+    ('message_tags', MessageTag, None,
+     lambda user_id: MessageTag.message_id.in_(
+         select([Message.id]).where(Message.user_id == user_id))),
+    ('message_mentions', Mention, None,
+     lambda user_id: Mention.message_id.in_(
+         select([Message.id]).where(Message.user_id == user_id))),
+    ('mentioned', Mention, None,
+     lambda user_id: Mention.user_id == user_id),
+    ('messages', Message, 'messages',
+     lambda user_id: Message.user_id == user_id),
+    ('suggestions', Suggestion, None,
+     lambda user_id: or_(Suggestion.user_id == user_id,
+                         Suggestion.suggested_id == user_id)),
+]
+
+# Last stage: delete the user row itself
+ACCOUNT = 'account'
+
+
+def tombstone(user):
+    """Hide `user` everywhere and queue the purge of their rows.
+
+    Caller is responsible for committing.
+    """
+
+    user.deleted_at = datetime.utcnow()
+    db.session.add(AccountPurge(user_id=user.id, stage=STAGES[0][0]))
+    enqueue('purge_account', user_id=user.id)
+
+
+def purge_step(user_id, batch_size=PURGE_BATCH_SIZE):
+    """Delete one batch of `user_id`'s rows and commit; False once done."""
+
+    # Locked, so two jobs for one account take turns rather than race
+    purge = (AccountPurge
+             .query
+             .filter_by(user_id=user_id)
+             .with_for_update()
+             .first())
+
+    if purge is None or purge.stage == DONE:
+        db.session.commit()
+        return False
+
+    names = [stage[0] for stage in STAGES]
+
+    if purge.stage != ACCOUNT:
+        position = names.index(purge.stage)
+        _, model, counter, where = STAGES[position]
+
+        if model is Message:
+            paths = _delete_batch(model, where(user_id), batch_size,
+                                  returning=Message.__table__.c.path)
+            threads.remove_paths(paths)
+            deleted = len(paths)
+        else:
+            deleted = _delete_batch(model, where(user_id), batch_size)
+
+        if counter:
+            setattr(purge, counter, getattr(purge, counter) + deleted)
+
+        if deleted < batch_size:
+            purge.stage = (names[position + 1] if position + 1 < len(names)
+                           else ACCOUNT)
+
+    else:
+        # Whatever little is left goes with the user row by cascade
+        User.query.filter_by(id=user_id).delete(synchronize_session=False)
+        purge.stage = DONE
+        purge.finished_at = datetime.utcnow()
+
+    db.session.commit()
+    return purge.stage != DONE
+
+
+@task
+def purge_account(user_id, max_batches=MAX_BATCHES_PER_JOB):
+    """Purge a tombstoned account, a bounded number of batches at a time."""
+
+    for _ in range(max_batches):
+        if not purge_step(user_id):
+            return
+
+    enqueue('purge_account', user_id=user_id, max_batches=max_batches)
+
+
+##############################################################################
+# CLI
+
+
+@click.group('deletion')
+def deletion_cli():
+    """Inspect and resume account purges."""
+
+
+@deletion_cli.command('status')
+@with_appcontext
+def status_command():
+    """Show progress of unfinished account purges."""
+
+    purges = (AccountPurge
+              .query
+              .filter(AccountPurge.stage != DONE)
+              .order_by(AccountPurge.requested_at))
+
+    for purge in purges:
+        click.echo(f"user {purge.user_id}: {purge.stage} "
+                   f"({purge.messages} messages, {purge.likes} likes, "
+                   f"{purge.follows} follows deleted) "
+                   f"since {purge.requested_at:%Y-%m-%d %H:%M}")
+
+
+@deletion_cli.command('resume')
+@with_appcontext
+def resume_command():
+    """Queue a purge job for every unfinished purge.
+
+    Safe to run while purges are in progress: jobs for the same account
+    take turns, and a finished purge's job does nothing.
+    """
+
+    user_ids = [user_id for (user_id,) in
+                db.session.query(AccountPurge.user_id)
+                .filter(AccountPurge.stage != DONE)]
+
+    for user_id in user_ids:
+        enqueue('purge_account', user_id=user_id)
+    db.session.commit()
+
+    click.echo(f"Queued {len(user_ids)} purge(s)")
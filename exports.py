@@ -0,0 +1,373 @@
+"""Account data exports: a user's profile, messages, likes and follows.
+
+Going through `User.messages`, `User.likes` and the follow relationships
+would load a big account into a worker as ORM objects. Exports instead
+read plain columns with `yield_per(EXPORT_BATCH_SIZE)`, which on Postgres
+uses a server-side cursor, and write each row out as soon as it arrives,
+so memory stays flat however big the account is.
+
+Two formats:
+
+- `ndjson`: one JSON object per line, each with a `type` (profile,
+  message, like, follower, following).
+- `zip`: profile.json plus messages, likes, followers and following as
+  .ndjson files. The archive is written as a stream (sizes go after each
+  entry), so it is never held in memory or on disk either.
+
+Accounts up to EXPORT_STREAM_MAX_ROWS rows (counted when a download is
+asked for) are downloaded straight from /users/export. Bigger ones would tie up a worker and a connection for the
+whole download, so they are written to a file in EXPORT_DIR by an
+`export_account` job and downloaded from there once done. Files are kept
+for EXPORT_MAX_AGE.
+
+    flask export user alice --format zip --output alice.zip
+    flask export prune        # remove old export files
+"""
+
+import json
+import os
+import secrets
+import sys
+import time
+import zipfile
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from jobs import enqueue, gave_up, task
+from models import db, User, Message, Like, FollowersFollowee, DataExport
+
+# Rows fetched per round trip from the server-side cursor
+EXPORT_BATCH_SIZE = 1000
+
+# Bytes sent to the client (or file) at a time
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# Accounts with more rows than this are exported by a background job
+EXPORT_STREAM_MAX_ROWS = 50000
+
+EXPORT_MAX_AGE = timedelta(days=7)
+
+PROFILE_COLUMNS = (User.id, User.username, User.email, User.image_url,
+                   User.header_image_url, User.bio, User.location)
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'zip': 'application/zip',
+}
+
+QUEUED = 'queued'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def _query(*columns):
+    return db.session.query(*columns).yield_per(EXPORT_BATCH_SIZE)
+
+
+def _profile(user_id):
+    row = db.session.query(*PROFILE_COLUMNS).filter(User.id == user_id).one()
+    return {column.key: value for column, value in zip(PROFILE_COLUMNS, row)}
+
+
+def _messages(user_id):
+    return (_query(Message.id, Message.text, Message.timestamp,
+                   Message.reply_to_id)
+            .filter(Message.user_id == user_id)
+            .order_by(Message.id))
+
+
+def _message_record(row):
+    message_id, text, timestamp, reply_to_id = row
+    return {'id': message_id, 'text': text,
+            'timestamp': timestamp.isoformat(), 'reply_to_id': reply_to_id}
+
+
+def _likes(user_id):
+    return (_query(Message.id, User.username, Message.text,
+                   Message.timestamp)
+            .select_from(Like)
+            .join(Message, Like.message_id == Message.id)
+            .join(User, Message.user_id == User.id)
+            .filter(Like.user_id == user_id, User.deleted_at.is_(None))
+            .order_by(Message.id))
+
+
+def _like_record(row):
+    message_id, author, text, timestamp = row
+    return {'message_id': message_id, 'author': author, 'text': text,
+            'timestamp': timestamp.isoformat()}
+
+
+def _follows(user_id, followers):
+    mine, theirs = (FollowersFollowee.followee_id,
+                    FollowersFollowee.follower_id)
+    if not followers:
+        mine, theirs = theirs, mine
+
+    return (_query(User.id, User.username)
+            .select_from(FollowersFollowee)
+            .join(User, theirs == User.id)
+            .filter(mine == user_id, User.deleted_at.is_(None))
+            .order_by(User.id))
+
+
+def _user_record(row):
+    return {'id': row[0], 'username': row[1]}
+
+
+# (record type, zip entry, query of a user's rows, row -> record) for each
+# part of an export after the profile
+SECTIONS = [
+    ('message', 'messages.ndjson', _messages, _message_record),
+    ('like', 'likes.ndjson', _likes, _like_record),
+    ('follower', 'followers.ndjson',
+     lambda user_id: _follows(user_id, True), _user_record),
+    ('following', 'following.ndjson',
+     lambda user_id: _follows(user_id, False), _user_record),
+]
+
+
+def row_count(user_id):
+    """How many rows an export of `user_id` has, profile aside."""
+
+    return sum(rows(user_id).order_by(None).count()
+               for _, _, rows, _ in SECTIONS)
+
+
+def _line(record):
+    return json.dumps(record).encode() + b'\n'
+
+
+def _ndjson(user_id):
+    yield _line(dict(type='profile', **_profile(user_id)))
+
+    for kind, _, rows, record in SECTIONS:
+        for row in rows(user_id):
+            yield _line(dict(type=kind, **record(row)))
+
+
+class _Sink:
+    """Write-only file that keeps what's written until it's drained.
+
+    It can't seek, so zipfile writes the archive as a stream.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+
+def _zip(user_id):
+    sink = _Sink()
+
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('profile.json',
+                         json.dumps(_profile(user_id), indent=2))
+
+        for _, name, rows, record in SECTIONS:
+            with archive.open(name, 'w', force_zip64=True) as entry:
+                for row in rows(user_id):
+                    entry.write(_line(record(row)))
+                    if sink.size >= EXPORT_CHUNK_SIZE:
+                        yield sink.drain()
+
+    yield sink.drain()
+
+
+def _chunked(parts, size=EXPORT_CHUNK_SIZE):
+    buf = []
+    buffered = 0
+
+    for part in parts:
+        buf.append(part)
+        buffered += len(part)
+        if buffered >= size:
+            yield b''.join(buf)
+            buf = []
+            buffered = 0
+
+    if buf:
+        yield b''.join(buf)
+
+
+def chunks(user_id, format):
+    """The export of `user_id` in `format`, as chunks of bytes."""
+
+    if format == 'zip':
+        return _chunked(_zip(user_id))
+    return _chunked(_ndjson(user_id))
+
+
+def filename(username, format):
+    """Name offered to the browser for a download."""
+
+    return f"warbler-{username}.{format}"
+
+
+def export_dir():
+    """Folder export files are written to (EXPORT_DIR, or the instance
+    folder's exports/)."""
+
+    path = (current_app.config.get('EXPORT_DIR') or
+            os.path.join(current_app.instance_path, 'exports'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def write_file(user_id, format, path):
+    """Write the export of `user_id` to `path`, atomically."""
+
+    partial = f'{path}.part'
+    try:
+        with open(partial, 'wb') as out:
+            for chunk in chunks(user_id, format):
+                out.write(chunk)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def request_export(user, format):
+    """Queue an export of `user` to a file, unless one is already queued.
+
+    Returns the DataExport. Caller is responsible for committing.
+    """
+
+    export = (DataExport
+              .query
+              .filter_by(user_id=user.id, format=format, status=QUEUED)
+              .first())
+
+    if export is None:
+        export = DataExport(user_id=user.id, format=format, status=QUEUED)
+        db.session.add(export)
+        db.session.flush()
+        enqueue('export_account', max_attempts=3, export_id=export.id)
+
+    return export
+
+
+def path_of(export):
+    return os.path.join(export_dir(), export.filename)
+
+
+@task
+def export_account(export_id):
+    """Write a queued export to a file in the exports folder."""
+
+    export = DataExport.query.get(export_id)
+    if export is None or export.status != QUEUED:
+        return
+
+    name = f"{export.id}-{secrets.token_hex(8)}.{export.format}"
+    write_file(export.user_id, export.format,
+               os.path.join(export_dir(), name))
+
+    export.filename = name
+    export.rows = row_count(export.user_id)
+    export.status = DONE
+    export.finished_at = datetime.utcnow()
+
+
+@gave_up('export_account')
+def export_failed(export_id):
+    """Mark an export whose job gave up as failed, so it can be asked for
+    again."""
+
+    export = DataExport.query.get(export_id)
+    if export is not None and export.status == QUEUED:
+        export.status = FAILED
+        export.finished_at = datetime.utcnow()
+
+
+def prune(max_age=EXPORT_MAX_AGE):
+    """Remove finished or failed exports older than `max_age`, and files
+    whose export is gone (e.g. with a deleted account). Returns files
+    removed."""
+
+    cutoff = datetime.utcnow() - max_age
+    old = (DataExport
+           .query
+           .filter(DataExport.status.in_([DONE, FAILED]),
+                   DataExport.finished_at < cutoff))
+
+    for export in old:
+        db.session.delete(export)
+    db.session.commit()
+
+    kept = {name for (name,) in
+            db.session.query(DataExport.filename)
+            .filter(DataExport.filename.isnot(None))}
+
+    # Unknown files are left alone for a while: their export may not have
+    # been committed yet
+    file_cutoff = time.time() - max_age.total_seconds()
+    removed = 0
+    folder = export_dir()
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name not in kept and os.path.getmtime(path) < file_cutoff:
+            os.remove(path)
+            removed += 1
+
+    return removed
+
+
+##############################################################################
+# CLI
+
+
+@click.group('export')
+def export_cli():
+    """Export account data."""
+
+
+@export_cli.command('user')
+@click.argument('username')
+@click.option('--format', 'format', type=click.Choice(sorted(FORMATS)),
+              default='ndjson')
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='File to write to (default: standard output).')
+@with_appcontext
+def user_command(username, format, output):
+    """Export USERNAME's profile, messages, likes and follows."""
+
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user {username}")
+
+    if output:
+        write_file(user.id, format, output)
+        click.echo(f"Wrote {output}", err=True)
+        return
+
+    out = sys.stdout.buffer
+    for chunk in chunks(user.id, format):
+        out.write(chunk)
+    out.flush()
+
+
+@export_cli.command('prune')
+@with_appcontext
+def prune_command():
+    """Remove export files past EXPORT_MAX_AGE."""
+
+    click.echo(f"Removed {prune()} file(s)")
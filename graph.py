@@ -0,0 +1,346 @@
+"""In-memory index of the follow graph.
+
+Answers "does A follow B?", "who does A follow?" and "who follows A?"
+without touching the `follows` table. Both directions are kept as CSR
+adjacency: an int32 offset array indexed by user id, and an int32 array of
+neighbor ids, sorted per user, so membership is a binary search. That is
+about 8 bytes per follow plus 8 bytes per user id.
+
+CSR arrays can't be cheaply edited, so follows and unfollows made through
+the app go into small per-user add/remove sets layered over them, which
+are folded back into fresh arrays once they grow large.
+
+The index is per process and off by default (GRAPH_INDEX config). It is
+loaded from the DB on first use and reloaded in the background every
+GRAPH_INDEX_MAX_AGE seconds, which is how changes made by other worker
+processes show up. Until then it can be behind by whatever those workers
+changed, so it's for bulk reads (timelines, suggestions, mutuals) only;
+checks like `User.is_following` go to the DB (or membership.py) instead.
+"""
+
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from flask import current_app, has_app_context
+
+# Fold pending changes into the CSR arrays once there are this many
+COMPACT_THRESHOLD = 10000
+
+DEFAULT_MAX_AGE = 300
+
+_load_lock = threading.Lock()
+
+
+class Adjacency:
+    """Immutable CSR adjacency lists keyed by user id."""
+
+    def __init__(self, pairs):
+        """Build from (user_id, neighbor_id) pairs."""
+
+        pairs = sorted(set(pairs))
+        size = pairs[-1][0] + 2 if pairs else 1
+
+        self.indptr = array('i', bytes(4 * size))
+        self.indices = array('i', (neighbor for _, neighbor in pairs))
+
+        for user_id, _ in pairs:
+            self.indptr[user_id + 1] += 1
+        for i in range(1, size):
+            self.indptr[i] += self.indptr[i - 1]
+
+    def bounds(self, user_id):
+        if user_id + 1 >= len(self.indptr) or user_id < 0:
+            return 0, 0
+        return self.indptr[user_id], self.indptr[user_id + 1]
+
+    def neighbors(self, user_id):
+        lo, hi = self.bounds(user_id)
+        return self.indices[lo:hi]
+
+    def contains(self, user_id, neighbor_id):
+        lo, hi = self.bounds(user_id)
+        i = bisect_left(self.indices, neighbor_id, lo, hi)
+        return i < hi and self.indices[i] == neighbor_id
+
+    def pairs(self):
+        for user_id in range(len(self.indptr) - 1):
+            for neighbor_id in self.neighbors(user_id):
+                yield user_id, neighbor_id
+
+    def nbytes(self):
+        return (len(self.indptr) + len(self.indices)) * 4
+
+
+class _Direction:
+    """One direction of the graph: CSR base plus pending changes."""
+
+    def __init__(self, pairs):
+        self.base = Adjacency(pairs)
+        self.added = {}
+        self.removed = {}
+
+    def has(self, user_id, neighbor_id):
+        if neighbor_id in self.added.get(user_id, ()):
+            return True
+        if neighbor_id in self.removed.get(user_id, ()):
+            return False
+        return self.base.contains(user_id, neighbor_id)
+
+    def pending(self, user_id):
+        """The base and copies of `user_id`'s pending changes, so they can
+        be merged without holding the graph's lock."""
+
+        return (self.base, set(self.added.get(user_id, ())),
+                set(self.removed.get(user_id, ())))
+
+    @staticmethod
+    def merge(user_id, base, added, removed):
+        base = base.neighbors(user_id)
+
+        if not added and not removed:
+            return base.tolist()
+
+        return sorted((set(base) - removed) | added)
+
+    def copy(self):
+        """A copy sharing the (immutable) base, with its own change sets."""
+
+        other = _Direction.__new__(_Direction)
+        other.base = self.base
+        other.added = {user_id: set(ids) for user_id, ids in self.added.items()}
+        other.removed = {user_id: set(ids)
+                         for user_id, ids in self.removed.items()}
+        return other
+
+    def add(self, user_id, neighbor_id):
+        self.removed.get(user_id, set()).discard(neighbor_id)
+        if not self.base.contains(user_id, neighbor_id):
+            self.added.setdefault(user_id, set()).add(neighbor_id)
+
+    def remove(self, user_id, neighbor_id):
+        self.added.get(user_id, set()).discard(neighbor_id)
+        if self.base.contains(user_id, neighbor_id):
+            self.removed.setdefault(user_id, set()).add(neighbor_id)
+
+    def pairs(self):
+        for user_id, neighbor_id in self.base.pairs():
+            if neighbor_id not in self.removed.get(user_id, ()):
+                yield user_id, neighbor_id
+        for user_id, neighbors in self.added.items():
+            for neighbor_id in neighbors:
+                yield user_id, neighbor_id
+
+
+class FollowGraph:
+    """Follow graph index: who follows whom, in both directions."""
+
+    def __init__(self, edges=()):
+        """Build from (follower_id, followee_id) pairs."""
+
+        edges = list(edges)
+        self._lock = threading.Lock()
+        self._following = _Direction(edges)
+        self._followers = _Direction((b, a) for a, b in edges)
+        self.loaded_at = time.monotonic()
+        self._changes = 0
+
+        # Changes made while a reload is running, replayed onto its result
+        self._journal = None
+
+        # Likewise for a compaction
+        self._compacting = None
+
+    @classmethod
+    def from_db(cls):
+        """Load the whole graph from the follows table.
+
+        Follows of deleted accounts that haven't been purged yet are
+        left out.
+        """
+
+        from models import db, FollowersFollowee, User
+
+        deleted = db.session.query(User.id).filter(User.deleted_at.isnot(None))
+
+        return cls(db.session.query(FollowersFollowee.follower_id,
+                                    FollowersFollowee.followee_id)
+                   .filter(~FollowersFollowee.follower_id.in_(deleted),
+                           ~FollowersFollowee.followee_id.in_(deleted)))
+
+    def is_following(self, follower_id, followee_id):
+        return self._following.has(follower_id, followee_id)
+
+    def following(self, user_id):
+        """Sorted ids of users `user_id` follows."""
+
+        with self._lock:
+            pending = self._following.pending(user_id)
+        return _Direction.merge(user_id, *pending)
+
+    def followers(self, user_id):
+        """Sorted ids of users following `user_id`."""
+
+        with self._lock:
+            pending = self._followers.pending(user_id)
+        return _Direction.merge(user_id, *pending)
+
+    def add(self, follower_id, followee_id):
+        with self._lock:
+            self._following.add(follower_id, followee_id)
+            self._followers.add(followee_id, follower_id)
+            due = self._after_change(('add', follower_id, followee_id))
+        if due:
+            self._compact()
+
+    def remove(self, follower_id, followee_id):
+        with self._lock:
+            self._following.remove(follower_id, followee_id)
+            self._followers.remove(followee_id, follower_id)
+            due = self._after_change(('remove', follower_id, followee_id))
+        if due:
+            self._compact()
+
+    def remove_user(self, user_id):
+        """Drop every follow to or from `user_id`."""
+
+        for followee_id in self.following(user_id):
+            self.remove(user_id, followee_id)
+        for follower_id in self.followers(user_id):
+            self.remove(follower_id, user_id)
+
+    def _after_change(self, change):
+        """Note `change`; whether it's time to compact. Call with the lock
+        held."""
+
+        if self._journal is not None:
+            self._journal.append(change)
+        if self._compacting is not None:
+            self._compacting.append(change)
+
+        self._changes += 1
+        return (self._changes >= COMPACT_THRESHOLD and
+                self._compacting is None)
+
+    def _compact(self):
+        """Fold pending changes into new CSR arrays.
+
+        The arrays are built from a copy without holding the lock, then
+        swapped in with the changes made meanwhile replayed onto them.
+        """
+
+        with self._lock:
+            if self._compacting is not None:
+                return
+            self._compacting = []
+            current = self._following
+            snapshot = current.copy()
+
+        edges = list(snapshot.pairs())
+        following = _Direction(edges)
+        followers = _Direction((b, a) for a, b in edges)
+
+        with self._lock:
+            changes, self._compacting = self._compacting, None
+            # A reload swapped in newer data while this was building
+            if self._following is not current:
+                return
+
+            for op, follower_id, followee_id in changes:
+                getattr(following, op)(follower_id, followee_id)
+                getattr(followers, op)(followee_id, follower_id)
+
+            self._following = following
+            self._followers = followers
+            self._changes = len(changes)
+
+    def replace_with(self, fresh):
+        """Adopt `fresh`'s data, replaying changes made since it was read."""
+
+        with self._lock:
+            for op, follower_id, followee_id in self._journal or ():
+                getattr(fresh, op)(follower_id, followee_id)
+
+            self._following = fresh._following
+            self._followers = fresh._followers
+            self._changes = fresh._changes
+            self._journal = None
+            self.loaded_at = time.monotonic()
+
+    def start_reload(self):
+        """Begin journaling changes for a reload; False if one is running."""
+
+        with self._lock:
+            if self._journal is not None:
+                return False
+            self._journal = []
+            return True
+
+    def nbytes(self):
+        """Approximate bytes used by the CSR arrays."""
+
+        return self._following.base.nbytes() + self._followers.base.nbytes()
+
+
+def _reload(app, index):
+    """Background thread: reload `index` from the DB."""
+
+    with app.app_context():
+        try:
+            index.replace_with(FollowGraph.from_db())
+        except Exception:
+            index._journal = None
+            app.logger.exception("Follow graph reload failed")
+
+
+def current_graph():
+    """The app's follow graph index, or None if it's switched off.
+
+    Loads it on first use; kicks off a background reload once it is older
+    than GRAPH_INDEX_MAX_AGE.
+    """
+
+    if not has_app_context() or not current_app.config.get('GRAPH_INDEX'):
+        return None
+
+    app = current_app._get_current_object()
+    index = app.extensions.get('follow_graph')
+
+    if index is None:
+        with _load_lock:
+            index = app.extensions.get('follow_graph')
+            if index is None:
+                index = app.extensions['follow_graph'] = FollowGraph.from_db()
+        return index
+
+    max_age = app.config.get('GRAPH_INDEX_MAX_AGE', DEFAULT_MAX_AGE)
+    if time.monotonic() - index.loaded_at > max_age and index.start_reload():
+        threading.Thread(target=_reload, args=(app, index),
+                         daemon=True).start()
+
+    return index
+
+
+def record_follow(follower_id, followee_id):
+    """Apply a committed follow to the index, if enabled."""
+
+    index = current_graph()
+    if index is not None:
+        index.add(follower_id, followee_id)
+
+
+def record_unfollow(follower_id, followee_id):
+    """Apply a committed unfollow to the index, if enabled."""
+
+    index = current_graph()
+    if index is not None:
+        index.remove(follower_id, followee_id)
+
+
+def record_user_deleted(user_id):
+    """Drop a deleted user's follows from the index, if enabled."""
+
+    index = current_graph()
+    if index is not None:
+        index.remove_user(user_id)
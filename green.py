@@ -0,0 +1,37 @@
+"""Gunicorn settings for serving with cooperative green threads.
+
+    gunicorn -c green.py "app:create_app()"
+
+With the default sync workers, a worker serves one request at a time and
+sits idle during every Postgres round trip, of which a profile or home page
+makes many. Here each worker runs requests in gevent greenlets instead:
+sockets are patched to yield to other greenlets while they wait, and
+psycopg2 is told to wait on the gevent hub too (psycogreen), so one worker
+keeps many requests in flight while their queries run.
+
+The views are unchanged. Code that keeps the CPU busy still holds up the
+whole worker while it runs. Suggestion builds, export files and account
+purges run from the CLI or the job worker, not in requests; the one
+exception is thumbnailing (images.py), which renders an image in the
+request that first asks for it and serves it from disk after that.
+
+Each in-flight request needs a database connection while it queries, so
+the pool is sized with DB_POOL_SIZE (20 here unless set); requests beyond
+pool size plus overflow wait their turn. Keep workers * (DB_POOL_SIZE + 10)
+under Postgres' max_connections.
+
+GREEN_CONNECTIONS caps the requests each worker handles at once (default
+100). Worker count comes from WEB_CONCURRENCY or -w as usual.
+"""
+
+import os
+
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('GREEN_CONNECTIONS', 100))
+
+os.environ.setdefault('DB_POOL_SIZE', '20')
+
+
+def post_fork(server, worker):
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
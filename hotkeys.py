@@ -0,0 +1,268 @@
+"""Which profiles, messages and timelines are hot right now.
+
+Every request to a profile, message or timeline page is counted against a
+key such as `user:42`, `message:7014…` or `tag:python`. Counts go into a
+count-min sketch (DEPTH rows of WIDTH counters; a key's count is the
+smallest of its counters, which can only overestimate) and the TOP_K
+biggest keys are kept alongside. Memory is fixed however many different
+keys turn up. Counts are halved every DECAY_INTERVAL seconds, so keys that
+stop getting traffic fade out.
+
+Hot keys are shown to admins (usernames in ADMIN_USERS) at
+/admin/hot-keys. When the query cache's versions are shared by every
+worker (caching.py), hot users and messages also stay cached
+HOT_TTL_FACTOR times longer: a change made through any worker still
+retires them at once. A cache whose versions are per worker keeps the
+usual TTLs.
+
+Counts are per worker process, or shared by the host's workers with
+SHARED_STATE_PATH set (shared.py). Set HOT_KEYS to False to switch this
+off.
+"""
+
+import threading
+import time
+from array import array
+
+from flask import current_app, g, has_app_context, request
+
+import shared
+
+WIDTH = 2048
+DEPTH = 4
+
+TOP_K = 50
+
+DECAY_INTERVAL = 60
+
+# Requests (per decay period, roughly) before a top key counts as hot
+HOT_THRESHOLD = 20
+
+# How much longer hot entries stay in the query cache
+HOT_TTL_FACTOR = 10
+
+# Pages counted, and the key each one's traffic is counted against
+PAGE_KEYS = {
+    'warbler.users_show': lambda args: f"user:{args['user_id']}",
+    'warbler.show_following': lambda args: f"user:{args['user_id']}",
+    'warbler.users_followers': lambda args: f"user:{args['user_id']}",
+    'warbler.users_likes': lambda args: f"user:{args['user_id']}",
+    'warbler.messages_show': lambda args: f"message:{args['message_id']}",
+    'warbler.tag_timeline': lambda args: f"tag:{args['tag'].lower()}",
+}
+
+# Query cache regions whose keys are user / message ids
+CACHE_REGIONS = {
+    'users': 'user',
+    'messages': 'message',
+}
+
+
+class CountMinSketch:
+    """Approximate counts of any number of keys in fixed memory."""
+
+    def __init__(self, width=WIDTH, depth=DEPTH):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('Q', bytes(8 * width)) for _ in range(depth)]
+
+    def _cells(self, key):
+        return [hash((row, key)) % self.width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Count `key`; returns its new estimated count.
+
+        Conservative update: only counters below the new estimate are
+        raised, which keeps overestimates down.
+        """
+
+        cells = self._cells(key)
+        estimate = min(row[cell]
+                       for row, cell in zip(self.rows, cells)) + count
+
+        for row, cell in zip(self.rows, cells):
+            if row[cell] < estimate:
+                row[cell] = estimate
+
+        return estimate
+
+    def estimate(self, key):
+        return min(row[cell]
+                   for row, cell in zip(self.rows, self._cells(key)))
+
+    def halve(self):
+        for row in self.rows:
+            for cell in range(self.width):
+                row[cell] >>= 1
+
+    def nbytes(self):
+        return sum(row.itemsize * len(row) for row in self.rows)
+
+
+class HotKeys:
+    """Sketch plus the current top `k` keys; safe across threads."""
+
+    def __init__(self, width=WIDTH, depth=DEPTH, k=TOP_K,
+                 decay_interval=DECAY_INTERVAL, threshold=HOT_THRESHOLD,
+                 clock=time.monotonic):
+        self.sketch = CountMinSketch(width, depth)
+        self.k = k
+        self.decay_interval = decay_interval
+        self.threshold = threshold
+        self.clock = clock
+        self.top = {}
+        self.events = 0
+        self._floor = 0
+        self._decayed_at = clock()
+        self._lock = threading.Lock()
+
+    def record(self, key):
+        with self._lock:
+            now = self.clock()
+            if now - self._decayed_at >= self.decay_interval:
+                self._decay()
+                self._decayed_at = now
+
+            self.events += 1
+            count = self.sketch.add(key)
+
+            if key in self.top or len(self.top) < self.k:
+                self.top[key] = count
+            elif count > self._floor:
+                del self.top[min(self.top, key=self.top.get)]
+                self.top[key] = count
+            else:
+                return
+
+            if len(self.top) == self.k:
+                self._floor = min(self.top.values())
+
+    def _decay(self):
+        self.sketch.halve()
+        self.top = {key: count >> 1 for key, count in self.top.items()
+                    if count >> 1}
+        self._floor = min(self.top.values()) if len(self.top) == self.k else 0
+
+    def hottest(self, n=None):
+        """[(key, estimated count)], biggest first."""
+
+        with self._lock:
+            ranked = sorted(self.top.items(), key=lambda item: -item[1])
+        return ranked[:n] if n else ranked
+
+    def is_hot(self, key):
+        return self.top.get(key, 0) >= self.threshold
+
+    def stats(self):
+        return {'events': self.events,
+                'tracked': len(self.top),
+                'memory_bytes': self.sketch.nbytes()}
+
+
+class SharedHotKeys:
+    """The same interface, counted in a shared table (shared.py) by every
+    worker on the host.
+
+    The table holds the heaviest keys directly ("space-saving": a new key
+    in a full stripe takes over the smallest count there), so no sketch is
+    needed. Whichever worker first finds DECAY_INTERVAL has passed halves
+    every count.
+    """
+
+    def __init__(self, table, stats, k=TOP_K, decay_interval=DECAY_INTERVAL,
+                 threshold=HOT_THRESHOLD, clock=time.time):
+        self.table = table
+        self.stats_table = stats
+        self.k = k
+        self.decay_interval = decay_interval
+        self.threshold = threshold
+        self.clock = clock
+
+    def record(self, key):
+        now = self.clock()
+        due = []
+
+        def claim(decayed_at):
+            if decayed_at is None:
+                return now
+            if now - decayed_at >= self.decay_interval:
+                due.append(True)
+                return now
+            return decayed_at
+
+        # Only the worker that moves the decay time on does the halving
+        self.stats_table.update('hotkeys:decayed_at', claim)
+        if due:
+            self.table.scale(0.5, drop_below=1)
+
+        self.stats_table.add('hotkeys:events')
+        self.table.add(key, evict=True)
+
+    def hottest(self, n=None):
+        ranked = sorted(((key, int(count)) for key, count
+                         in self.table.items()),
+                        key=lambda item: -item[1])[:self.k]
+        return ranked[:n] if n else ranked
+
+    def is_hot(self, key):
+        return self.table.get(key) >= self.threshold
+
+    def stats(self):
+        table_stats = self.table.stats()
+        return {'events': int(self.stats_table.get('hotkeys:events')),
+                'tracked': table_stats['used'],
+                'memory_bytes': table_stats['memory_bytes']}
+
+
+_init_lock = threading.Lock()
+
+
+def current_tracker():
+    """The app's tracker, or None if switched off (HOT_KEYS)."""
+
+    if not has_app_context() or not current_app.config.get('HOT_KEYS', True):
+        return None
+
+    app = current_app._get_current_object()
+    tracker = app.extensions.get('hotkeys')
+
+    if tracker is None:
+        with _init_lock:
+            tracker = app.extensions.get('hotkeys')
+            if tracker is None:
+                threshold = app.config.get('HOT_KEY_THRESHOLD',
+                                           HOT_THRESHOLD)
+                table = shared.current_table('hotkeys')
+                if table is not None:
+                    tracker = SharedHotKeys(table,
+                                            shared.current_table('stats'),
+                                            threshold=threshold)
+                else:
+                    tracker = HotKeys(threshold=threshold)
+                app.extensions['hotkeys'] = tracker
+
+    return tracker
+
+
+def record_request():
+    """Count this request against its page's key, if it has one."""
+
+    if request.endpoint == 'warbler.homepage':
+        key = f"home:{g.user.id}" if g.get('user') else None
+    else:
+        make_key = PAGE_KEYS.get(request.endpoint)
+        key = make_key(request.view_args) if make_key else None
+
+    tracker = current_tracker()
+    if key is not None and tracker is not None:
+        tracker.record(key)
+
+
+def cache_ttl_factor(region, key):
+    """How many times the usual TTL to keep a query cache entry for."""
+
+    kind = CACHE_REGIONS.get(region)
+    tracker = current_tracker()
+    if kind is None or tracker is None:
+        return 1
+    return HOT_TTL_FACTOR if tracker.is_hot(f"{kind}:{key}") else 1
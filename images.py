@@ -0,0 +1,480 @@
+"""Thumbnail proxy for user avatars and header images.
+
+User images are arbitrary external URLs, often full-size photos. Templates
+link them through `thumb_url(url, size)` instead, which points at
+`/images/<size>?url=...&sig=...`. The first request for an image fetches
+it once, renders every size in a worker pool, and stores the results in a
+content-addressed disk cache; after that it is served from disk with
+long-lived cache headers.
+
+URLs are signed with the app's SECRET_KEY so the endpoint can't be used as
+an open proxy. Since users choose the URLs, the proxy only fetches from
+public addresses: hosts resolving to loopback, private, link-local or
+reserved addresses are refused, on the first request and on every
+redirect. The check is made as each connection is opened, and the
+connection goes to an address that passed it, so a name can't resolve to
+a public address for the check and a private one for the fetch. Hosts in
+IMAGE_FETCH_ALLOW_HOSTS skip the check. Local images (`/static/...`) are
+left alone.
+
+An image that can't be fetched or decoded is remembered for
+IMAGE_FAILURE_TTL seconds (per worker), so a broken avatar doesn't make
+every page view wait on its origin; requests for it go straight to the
+original URL meanwhile.
+
+Thumbnails are rendered in the request that first asks for an image (all
+sizes at once, from one fetch); every later request is a disk read.
+"""
+
+import hashlib
+import hmac
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import (Blueprint, abort, current_app, redirect, request,
+                   send_file, url_for)
+
+# name -> (width, height, crop). Cropped sizes fill the box exactly;
+# uncropped ones fit inside it, keeping the aspect ratio.
+SIZES = {
+    'avatar-sm': (48, 48, True),
+    'avatar': (200, 200, True),
+    'header': (640, 320, False),
+}
+
+CACHE_CONTROL = 'public, max-age=604800'
+
+FETCH_USER_AGENT = 'Warbler image proxy'
+
+# Scan the cache for eviction at least this often (seconds), since other
+# workers add to it too
+EVICT_INTERVAL = 300
+
+# Seconds a source that failed is left alone (IMAGE_FAILURE_TTL)
+FAILURE_TTL = 60
+
+# Most failed sources remembered at once
+MAX_FAILURES = 10000
+
+bp = Blueprint('images', __name__)
+
+# Pillow releases the GIL while resizing, so threads give real parallelism
+_pool = ThreadPoolExecutor(max_workers=4)
+
+# One lock per source URL, so concurrent misses fetch it only once
+_fetch_locks = {}
+_fetch_locks_guard = threading.Lock()
+
+# Source URL -> time.monotonic() until which it isn't tried again
+_failures = {}
+
+
+def sign(url, size):
+    """HMAC signature authorizing a thumbnail of `url` at `size`."""
+
+    key = current_app.config['SECRET_KEY'].encode('utf-8')
+    msg = f"{size}|{url}".encode('utf-8')
+    return hmac.new(key, msg, hashlib.sha256).hexdigest()[:16]
+
+
+def thumb_url(url, size='avatar'):
+    """URL of a resized copy of external image `url` (template global)."""
+
+    if not url or not url.startswith(('http://', 'https://')):
+        return url
+
+    return url_for('images.thumbnail', size=size, url=url, sig=sign(url, size))
+
+
+class ImageCache:
+    """Content-addressed disk cache with least-recently-used eviction.
+
+    Image bytes are stored once under their own hash in `blobs/`. Small
+    files in `refs/` map a (url, size) key to a blob, so identical images
+    reached through different URLs share storage. Reads touch the blob's
+    mtime, and when the cache outgrows `max_bytes` the least recently used
+    blobs are removed.
+
+    Scanning the blobs is slow for a big cache, so `maybe_evict()` only
+    does it when this process's running total says the cache is over
+    `max_bytes`, or every EVICT_INTERVAL seconds.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.blob_dir = os.path.join(root, 'blobs')
+        self.ref_dir = os.path.join(root, 'refs')
+        self._evict_lock = threading.Lock()
+
+        # Size as of the last scan plus blobs written since; None until
+        # the first scan
+        self._size = None
+        self._scanned_at = 0
+
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.ref_dir, exist_ok=True)
+
+    @staticmethod
+    def key(url, size):
+        return hashlib.sha256(f"{size}|{url}".encode('utf-8')).hexdigest()
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    def get(self, url, size):
+        """Return (path, digest) of cached image, or None on a miss."""
+
+        try:
+            with open(os.path.join(self.ref_dir, self.key(url, size))) as f:
+                digest = f.read().strip()
+            path = self.blob_path(digest)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return path, digest
+
+    def put(self, url, size, data):
+        """Store `data` as the image for (`url`, `size`)."""
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+
+        if not os.path.exists(path):
+            _atomic_write(path, data)
+            if self._size is not None:
+                self._size += len(data)
+
+        _atomic_write(os.path.join(self.ref_dir, self.key(url, size)),
+                      digest.encode('ascii'))
+
+    def evict(self):
+        """Remove least recently used blobs until under `max_bytes`.
+
+        Refs left pointing at evicted blobs simply read as misses.
+        """
+
+        with self._evict_lock:
+            entries = sorted(os.scandir(self.blob_dir),
+                             key=lambda entry: entry.stat().st_mtime)
+            total = sum(entry.stat().st_size for entry in entries)
+
+            for entry in entries:
+                if total <= self.max_bytes:
+                    break
+                total -= entry.stat().st_size
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+            self._size = total
+            self._scanned_at = time.monotonic()
+
+    def maybe_evict(self):
+        """`evict()` if the cache may have outgrown `max_bytes`."""
+
+        if (self._size is None or self._size > self.max_bytes or
+                time.monotonic() - self._scanned_at > EVICT_INTERVAL):
+            self.evict()
+
+
+def _atomic_write(path, data):
+    """Write so readers never see a partial file."""
+
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _public(address):
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if getattr(ip, 'ipv4_mapped', None):
+        ip = ip.ipv4_mapped
+
+    # is_global is false for loopback, private, link-local, reserved and
+    # shared (carrier NAT) ranges
+    return ip.is_global and not ip.is_multicast
+
+
+def _public_addresses(host, port, allow_hosts=()):
+    """Resolve `host`, raising ValueError unless every address is public.
+
+    Every address must pass, so a name that points at both can't be used
+    to reach the inside. Returns the addresses to connect to.
+    """
+
+    try:
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, ValueError) as e:
+        raise ValueError(f"Can't resolve {host}: {e}")
+
+    addresses = [info[4][0] for info in infos]
+    if host not in allow_hosts:
+        for address in addresses:
+            if not _public(address):
+                raise ValueError(f"Not a public address: {host}")
+
+    return addresses
+
+
+def check_url(url, allow_hosts=()):
+    """Raise ValueError unless `url` is http(s) on a public address."""
+
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError(f"Not an http(s) URL: {url}")
+
+    if parts.hostname in allow_hosts:
+        return
+
+    try:
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+    except ValueError as e:
+        raise ValueError(f"Bad port in {url}: {e}")
+    _public_addresses(parts.hostname, port)
+
+
+def _connect(connection):
+    """Open `connection`'s socket to an address that passed the check.
+
+    The request keeps the host name, so the Host header and (for https)
+    the certificate check and SNI are for the name, not the address.
+    """
+
+    error = None
+    for address in _public_addresses(connection.host, connection.port,
+                                     connection.allow_hosts):
+        try:
+            return socket.create_connection((address, connection.port),
+                                            connection.timeout,
+                                            connection.source_address)
+        except OSError as e:
+            error = e
+    raise error
+
+
+class _CheckedHTTPConnection(http.client.HTTPConnection):
+    allow_hosts = ()
+
+    def connect(self):
+        self.sock = _connect(self)
+
+
+class _CheckedHTTPSConnection(http.client.HTTPSConnection):
+    allow_hosts = ()
+
+    def connect(self):
+        self.sock = self._context.wrap_socket(_connect(self),
+                                              server_hostname=self.host)
+
+
+class _CheckedHTTPHandler(urllib.request.HTTPHandler):
+    def __init__(self, allow_hosts):
+        super().__init__()
+        self.connection_class = type('Connection', (_CheckedHTTPConnection,),
+                                     {'allow_hosts': allow_hosts})
+
+    def http_open(self, req):
+        return self.do_open(self.connection_class, req)
+
+
+class _CheckedHTTPSHandler(urllib.request.HTTPSHandler):
+    def __init__(self, allow_hosts):
+        super().__init__()
+        self.connection_class = type('Connection', (_CheckedHTTPSConnection,),
+                                     {'allow_hosts': allow_hosts})
+
+    def https_open(self, req):
+        return self.do_open(self.connection_class, req,
+                            context=self._context)
+
+
+class _CheckedRedirects(urllib.request.HTTPRedirectHandler):
+    """Follows redirects only to http(s) URLs on public addresses (the
+    connection is checked again as it's opened)."""
+
+    def __init__(self, allow_hosts):
+        self.allow_hosts = allow_hosts
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_url(newurl, self.allow_hosts)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def fetch(url, timeout, max_bytes, allow_hosts=()):
+    """Download `url`, refusing anything larger than `max_bytes` and any
+    hop that isn't on a public address (unless its host is in
+    `allow_hosts`)."""
+
+    check_url(url, allow_hosts)
+
+    # No proxies: the address checked has to be the one connected to
+    opener = urllib.request.build_opener(
+        urllib.request.ProxyHandler({}),
+        _CheckedHTTPHandler(allow_hosts),
+        _CheckedHTTPSHandler(allow_hosts),
+        _CheckedRedirects(allow_hosts))
+    req = urllib.request.Request(url, headers={'User-Agent': FETCH_USER_AGENT})
+
+    with opener.open(req, timeout=timeout) as resp:
+        data = resp.read(max_bytes + 1)
+
+    if len(data) > max_bytes:
+        raise ValueError(f"Image too large: {url}")
+
+    return data
+
+
+def resize(data, size):
+    """Return JPEG bytes of image `data` resized to named `size`."""
+
+    from PIL import Image, ImageOps
+
+    width, height, crop = SIZES[size]
+
+    with Image.open(io.BytesIO(data)) as img:
+        img = img.convert('RGB')
+
+        if crop:
+            img = ImageOps.fit(img, (width, height), Image.LANCZOS)
+        else:
+            img.thumbnail((width, height), Image.LANCZOS)
+
+        out = io.BytesIO()
+        img.save(out, 'JPEG', quality=85, optimize=True, progressive=True)
+
+    return out.getvalue()
+
+
+def get_cache(app):
+    """The app's image cache, created on first use."""
+
+    cache = app.extensions.get('image_cache')
+
+    if cache is None:
+        cache = ImageCache(
+            app.config.get('IMAGE_CACHE_DIR') or
+            os.path.join(app.instance_path, 'image-cache'),
+            app.config.get('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+        app.extensions['image_cache'] = cache
+
+    return cache
+
+
+def recently_failed(url):
+    """Whether fetching or decoding `url` failed within the failure TTL."""
+
+    until = _failures.get(url)
+    return until is not None and time.monotonic() < until
+
+
+def remember_failure(url, ttl):
+    """Leave `url` alone for `ttl` seconds."""
+
+    now = time.monotonic()
+    if len(_failures) >= MAX_FAILURES:
+        for key, until in list(_failures.items()):
+            if until <= now:
+                _failures.pop(key, None)
+        # Still full: forget the oldest
+        while len(_failures) >= MAX_FAILURES:
+            _failures.pop(next(iter(_failures)), None)
+    _failures[url] = now + ttl
+
+
+def load_thumbnail(url, size):
+    """Return (path, digest) for `url` at `size`, fetching on a miss.
+
+    A miss fetches the source once and renders every size in the worker
+    pool, since the other sizes of the same image are usually next.
+    Raises ValueError without trying if the source failed recently.
+    """
+
+    app = current_app._get_current_object()
+    cache = get_cache(app)
+
+    hit = cache.get(url, size)
+    if hit:
+        return hit
+
+    if recently_failed(url):
+        raise ValueError(f"Failed recently: {url}")
+
+    with _fetch_locks_guard:
+        lock = _fetch_locks.setdefault(url, threading.Lock())
+
+    with lock:
+        # Someone else may have filled it (or failed) while we waited
+        hit = cache.get(url, size)
+        if hit:
+            return hit
+        if recently_failed(url):
+            raise ValueError(f"Failed recently: {url}")
+
+        try:
+            data = fetch(url,
+                         app.config.get('IMAGE_FETCH_TIMEOUT', 5),
+                         app.config.get('IMAGE_MAX_SOURCE_BYTES',
+                                        10 * 1024 * 1024),
+                         app.config.get('IMAGE_FETCH_ALLOW_HOSTS', ()))
+
+            futures = {name: _pool.submit(resize, data, name)
+                       for name in SIZES}
+            for name, future in futures.items():
+                cache.put(url, name, future.result())
+        except Exception:
+            remember_failure(url, app.config.get('IMAGE_FAILURE_TTL',
+                                                 FAILURE_TTL))
+            raise
+        finally:
+            with _fetch_locks_guard:
+                _fetch_locks.pop(url, None)
+
+    cache.maybe_evict()
+    return cache.get(url, size)
+
+
+@bp.route('/images/<size>')
+def thumbnail(size):
+    """Serve a cached, resized copy of the signed external image URL.
+
+    If the origin can't be fetched or decoded, redirect to it instead so
+    the page still shows something.
+    """
+
+    url = request.args.get('url', '')
+    sig = request.args.get('sig', '')
+
+    if size not in SIZES or not hmac.compare_digest(sig, sign(url, size)):
+        abort(404)
+
+    try:
+        path, digest = load_thumbnail(url, size)
+    except Exception:
+        current_app.logger.warning("Could not thumbnail %s", url,
+                                   exc_info=True)
+        return redirect(url)
+
+    resp = send_file(path, mimetype='image/jpeg', conditional=True,
+                     add_etags=False)
+    resp.set_etag(digest)
+    resp.headers['Cache-Control'] = CACHE_CONTROL
+    return resp.make_conditional(request)
+
+
+def init_app(app):
+    """Register the thumbnail endpoint and `thumb_url` on `app`."""
+
+    app.add_template_global(thumb_url)
+    app.register_blueprint(bp)
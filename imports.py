@@ -0,0 +1,384 @@
+"""Bulk imports of follows and messages, e.g. when moving from elsewhere.
+
+Following hundreds of accounts one `add_follow()` POST at a time loads
+each followee and commits once per follow. Imports instead take a whole
+list (a JSON list, or CSV) and apply it IMPORT_CHUNK_SIZE rows at a time:
+one query to look up a chunk's usernames, one multi-row INSERT ... ON
+CONFLICT DO NOTHING, one commit. Rows that are already there (follows you
+have, messages imported before) are skipped rather than failing the
+chunk, and rows that can't be imported are reported by line, so a file
+can be fixed and imported again.
+
+Follows: a username per row (a leading @ is fine), optionally under a
+`username` header.
+
+Messages: `text` and, optionally, `timestamp` (ISO 8601, UTC unless it
+says otherwise) per row, in that order or under a header. Imported
+messages get ids for their timestamp (see snowflake.py), so they sort
+among old messages, and a message with the same text and timestamp as one
+already there is skipped. Rows without a timestamp are posted as new
+messages every time, so importing a file again duplicates them; only the
+rows that failed should be imported again. Each starts a thread of its
+own; tags and mentions are indexed as they go in.
+
+Both use Postgres's ON CONFLICT.
+
+    flask import follows alice follows.csv
+    flask import messages alice posts.csv
+"""
+
+import csv
+import io
+from datetime import datetime, timezone
+from itertools import islice
+
+import click
+from dateutil.parser import isoparse
+from flask.cli import with_appcontext
+from sqlalchemy.dialects.postgresql import insert
+
+import caching
+import connections
+import graph
+import snowflake
+import suggestions
+import threads
+from models import db, User, Message, FollowersFollowee, MessageTag, Mention
+from tags import index_rows
+
+IMPORT_CHUNK_SIZE = 500
+
+# Most rows taken by one web request; bigger imports go through the CLI
+IMPORT_MAX_ROWS = 10000
+
+# Errors kept for the report; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+MAX_MESSAGE_LENGTH = Message.__table__.c.text.type.length
+
+FOLLOW_COLUMNS = ('username',)
+MESSAGE_COLUMNS = ('text', 'timestamp')
+
+
+class ImportReport:
+    """How many rows went in, were skipped, or failed (and why)."""
+
+    def __init__(self):
+        self.added = 0
+        self.skipped = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line, value, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'value': value,
+                                'error': message})
+
+    def to_dict(self):
+        return {'added': self.added, 'skipped': self.skipped,
+                'failed': self.failed, 'errors': self.errors}
+
+
+def csv_rows(lines, columns):
+    """(line number, {column: value}) for each non-blank row of CSV
+    `lines`.
+
+    A first row naming the columns is taken as the header; without one,
+    `columns` are in that order.
+    """
+
+    reader = csv.reader(lines)
+    names = None
+
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+
+        if names is None:
+            cells = [cell.strip().lower() for cell in row]
+            if set(cells) <= set(columns) and cells[0] in columns:
+                names = cells
+                continue
+            names = columns
+
+        yield reader.line_num, dict(zip(names, row))
+
+
+def json_rows(items, columns):
+    """The same for a JSON list of values (of the first column) or
+    objects."""
+
+    for line, item in enumerate(items, 1):
+        if isinstance(item, dict):
+            yield line, item
+        else:
+            yield line, {columns[0]: item}
+
+
+def text_rows(stream, columns):
+    """CSV rows from an uploaded file or other binary stream.
+
+    The upload is read whole (web imports are capped at IMPORT_MAX_ROWS)
+    rather than wrapped: Werkzeug spools uploads to a temporary file that
+    TextIOWrapper can't wrap before Python 3.11. Raises UnicodeDecodeError
+    if it isn't UTF-8.
+    """
+
+    text = stream.read().decode('utf-8-sig')
+    return csv_rows(io.StringIO(text, newline=''), columns)
+
+
+def _chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _limited(rows, max_rows, report):
+    for count, (line, row) in enumerate(rows):
+        if max_rows is not None and count == max_rows:
+            report.error(line, None, f"Only {max_rows} rows can be imported "
+                                     "at once; import the rest separately")
+            return
+        yield line, row
+
+
+def _text(row, column):
+    value = row.get(column)
+    return value.strip() if isinstance(value, str) else ''
+
+
+##############################################################################
+# Follows
+
+
+def _follow_rows(user, rows, report):
+    for line, row in rows:
+        username = _text(row, 'username').lstrip('@')
+        if not username:
+            report.error(line, None, "No username")
+        elif username == user.username:
+            report.error(line, username, "You can't follow yourself")
+        else:
+            yield line, username
+
+
+def _add_follows(user_id, chunk, seen, report):
+    """Insert one chunk of follows and commit; ids of those added."""
+
+    found = dict(db.session
+                 .query(User.username, User.id)
+                 .filter(User.username.in_({name for _, name in chunk}),
+                         User.deleted_at.is_(None)))
+
+    values = []
+    for line, username in chunk:
+        followee_id = found.get(username)
+        if followee_id is None:
+            report.error(line, username, "No such user")
+        elif followee_id in seen:
+            report.skipped += 1
+        else:
+            seen.add(followee_id)
+            values.append({'follower_id': user_id,
+                           'followee_id': followee_id})
+
+    added = []
+    if values:
+        added = [followee_id for (followee_id,) in db.session.execute(
+            insert(FollowersFollowee.__table__)
+            .values(values)
+            .on_conflict_do_nothing()
+            .returning(FollowersFollowee.followee_id))]
+        report.skipped += len(values) - len(added)
+        report.added += len(added)
+
+    if added:
+        suggestions.mark_stale(user_id)
+    db.session.commit()
+    return added
+
+
+def import_follows(user, rows, chunk_size=IMPORT_CHUNK_SIZE, max_rows=None):
+    """Follow the users named in `rows` (from `csv_rows()` or
+    `json_rows()`) as `user`. Returns an ImportReport."""
+
+    report = ImportReport()
+    seen = set()
+    rows = _follow_rows(user, _limited(rows, max_rows, report), report)
+
+    for chunk in _chunks(rows, chunk_size):
+        for followee_id in _add_follows(user.id, chunk, seen, report):
+            graph.record_follow(user.id, followee_id)
+            connections.forget_follow(user.id, followee_id)
+            caching.forget_follow(user.id, followee_id)
+
+    return report
+
+
+##############################################################################
+# Messages
+
+
+def _timestamp(value):
+    """Naive UTC datetime, to the millisecond, from ISO 8601 `value`."""
+
+    when = isoparse(value)
+    if when.tzinfo is not None:
+        when = when.astimezone(timezone.utc).replace(tzinfo=None)
+    return when.replace(microsecond=when.microsecond // 1000 * 1000)
+
+
+def _message_rows(rows, report):
+    now = datetime.utcnow()
+
+    for line, row in rows:
+        text = _text(row, 'text')
+        stamp = _text(row, 'timestamp')
+
+        if not text:
+            report.error(line, None, "No text")
+            continue
+        if len(text) > MAX_MESSAGE_LENGTH:
+            report.error(line, text, f"Longer than {MAX_MESSAGE_LENGTH} "
+                                     "characters")
+            continue
+
+        when = None
+        if stamp:
+            try:
+                when = _timestamp(stamp)
+            except ValueError:
+                report.error(line, stamp, "Not an ISO 8601 timestamp")
+                continue
+            if not snowflake.EPOCH <= when <= now:
+                report.error(line, stamp, "Timestamp before "
+                             f"{snowflake.EPOCH:%Y} or in the future")
+                continue
+
+        yield line, text, when
+
+
+def _add_messages(user_id, chunk, report):
+    """Insert one chunk of messages with their tags and mentions, and
+    commit; how many were added."""
+
+    stamps = {when for _, _, when in chunk if when is not None}
+    existing = set()
+    if stamps:
+        existing = set(db.session
+                       .query(Message.timestamp, Message.text)
+                       .filter(Message.user_id == user_id,
+                               Message.timestamp.in_(stamps)))
+
+    values = []
+    lines = {}
+    for line, text, when in chunk:
+        if when is not None:
+            if (when, text) in existing:
+                report.skipped += 1
+                continue
+            existing.add((when, text))
+
+        message_id = (snowflake.id_at(when) if when is not None
+                      else snowflake.next_id())
+        lines[message_id] = line
+        values.append({'id': message_id,
+                       'text': text,
+                       'timestamp': snowflake.time_of(message_id),
+                       'user_id': user_id,
+                       'thread_id': message_id,
+                       'path': threads.segment(message_id),
+                       'reply_count': 0})
+
+    added = []
+    if values:
+        # Messages already there were filtered out above, so the only
+        # conflict left is on the primary key: another message has this
+        # row's id, and the row is lost rather than a repeat
+        added = list(db.session.execute(
+            insert(Message.__table__)
+            .values(values)
+            .on_conflict_do_nothing()
+            .returning(Message.id, Message.text)))
+        report.added += len(added)
+
+        inserted = {message_id for message_id, _ in added}
+        for value in values:
+            if value['id'] not in inserted:
+                report.error(lines[value['id']], value['text'],
+                             "Couldn't get a unique id; import it again")
+
+        tag_rows, mention_rows = index_rows(added)
+        db.session.bulk_insert_mappings(MessageTag, tag_rows)
+        db.session.bulk_insert_mappings(Mention, mention_rows)
+
+    db.session.commit()
+    return len(added)
+
+
+def import_messages(user, rows, chunk_size=IMPORT_CHUNK_SIZE,
+                    max_rows=None):
+    """Post the messages in `rows` (from `csv_rows()` or `json_rows()`) as
+    `user`. Returns an ImportReport."""
+
+    report = ImportReport()
+    rows = _message_rows(_limited(rows, max_rows, report), report)
+
+    added = sum(_add_messages(user.id, chunk, report)
+                for chunk in _chunks(rows, chunk_size))
+
+    if added:
+        caching.forget_messages(user.id)
+
+    return report
+
+
+##############################################################################
+# CLI
+
+
+@click.group('import')
+def import_cli():
+    """Import follows and messages in bulk."""
+
+
+def _run(importer, username, file, columns, chunk_size):
+    user = User.active().filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user {username}")
+
+    report = importer(user, csv_rows(file, columns), chunk_size)
+
+    for error in report.errors:
+        click.echo(f"line {error['line']}: {error['error']}"
+                   + (f" ({error['value']})" if error['value'] else ''),
+                   err=True)
+    click.echo(f"Added {report.added}, skipped {report.skipped}, "
+               f"{report.failed} failed")
+
+
+@import_cli.command('follows')
+@click.argument('username')
+@click.argument('file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--chunk-size', default=IMPORT_CHUNK_SIZE)
+@with_appcontext
+def follows_command(username, file, chunk_size):
+    """Have USERNAME follow the users listed in CSV FILE ('-' for stdin)."""
+
+    _run(import_follows, username, file, FOLLOW_COLUMNS, chunk_size)
+
+
+@import_cli.command('messages')
+@click.argument('username')
+@click.argument('file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--chunk-size', default=IMPORT_CHUNK_SIZE)
+@with_appcontext
+def messages_command(username, file, chunk_size):
+    """Post the messages in CSV FILE ('-' for stdin) as USERNAME."""
+
+    _run(import_messages, username, file, MESSAGE_COLUMNS, chunk_size)
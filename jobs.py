@@ -0,0 +1,260 @@
+"""Durable background job queue for Warbler.
+
+Jobs live in the `jobs` table, so no broker is needed: anything that can
+reach the database can enqueue work or run a worker.
+
+Register a task with the `@task` decorator and enqueue it from a route with
+`enqueue('task_name', **kwargs)`. The job is added to the current session,
+so it is committed (or rolled back) together with the request's own write.
+A function registered with `@gave_up('task_name')` is called with the same
+kwargs once a job for that task has failed its last attempt.
+
+Run workers with:
+
+    flask jobs work --processes 2
+"""
+
+import json
+import os
+import socket
+import time
+import traceback
+from datetime import datetime, timedelta
+from multiprocessing import Process
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from models import db, Job
+
+TASKS = {}
+
+GAVE_UP = {}
+
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_POLL_INTERVAL = 1.0
+
+# Running jobs whose lock is older than this are assumed to belong to a
+# worker that died and are put back on the queue.
+STALE_LOCK_TIMEOUT = timedelta(minutes=10)
+
+
+def task(fn):
+    """Register `fn` as a background task under its function name."""
+
+    TASKS[fn.__name__] = fn
+    return fn
+
+
+def gave_up(name):
+    """Register the decorated function to clean up after task `name` once
+    its job has run out of attempts."""
+
+    def register(fn):
+        GAVE_UP[name] = fn
+        return fn
+
+    return register
+
+
+def enqueue(name, max_attempts=5, delay=0, **payload):
+    """Add a job for task `name` to the current session and return it.
+
+    Caller is responsible for committing.
+    """
+
+    if name not in TASKS:
+        raise KeyError(f"Unknown task: {name}")
+
+    job = Job(
+        name=name,
+        payload=json.dumps(payload),
+        max_attempts=max_attempts,
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+    db.session.add(job)
+    return job
+
+
+def worker_name():
+    """Identify this worker process in `Job.locked_by`."""
+
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_batch(batch_size=DEFAULT_BATCH_SIZE, worker=None):
+    """Lock up to `batch_size` due jobs for this worker and return them.
+
+    On Postgres, rows already locked by another worker are skipped, so any
+    number of workers can poll the same table without handing out a job
+    twice.
+    """
+
+    worker = worker or worker_name()
+    now = datetime.utcnow()
+
+    query = (Job
+             .query
+             .filter(Job.status == 'queued', Job.run_at <= now)
+             .order_by(Job.run_at, Job.id)
+             .limit(batch_size))
+
+    if db.engine.dialect.name == 'postgresql':
+        query = query.with_for_update(skip_locked=True)
+
+    jobs = query.all()
+
+    for job in jobs:
+        job.status = 'running'
+        job.locked_at = now
+        job.locked_by = worker
+        job.attempts += 1
+
+    db.session.commit()
+    return jobs
+
+
+def retry_delay(attempts):
+    """Exponential backoff in seconds after `attempts` failures."""
+
+    return min(2 ** attempts, 3600)
+
+
+def run_job(job):
+    """Run a single claimed job, recording success or failure."""
+
+    job_id = job.id
+
+    try:
+        TASKS[job.name](**json.loads(job.payload))
+        job.status = 'done'
+        job.last_error = None
+        job.locked_at = None
+        db.session.commit()
+        return True
+
+    except Exception:
+        db.session.rollback()
+
+        job = Job.query.get(job_id)
+        job.last_error = traceback.format_exc()
+        job.locked_at = None
+
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            if job.name in GAVE_UP:
+                GAVE_UP[job.name](**json.loads(job.payload))
+        else:
+            job.status = 'queued'
+            job.run_at = (datetime.utcnow() +
+                          timedelta(seconds=retry_delay(job.attempts)))
+
+        db.session.commit()
+        return False
+
+
+def run_batch(batch_size=DEFAULT_BATCH_SIZE, worker=None):
+    """Claim and run one batch of jobs. Return number of jobs processed."""
+
+    jobs = claim_batch(batch_size, worker)
+
+    for job in jobs:
+        run_job(job)
+
+    return len(jobs)
+
+
+def requeue_stale(timeout=STALE_LOCK_TIMEOUT):
+    """Put jobs abandoned by crashed workers back on the queue."""
+
+    cutoff = datetime.utcnow() - timeout
+
+    count = (Job
+             .query
+             .filter(Job.status == 'running', Job.locked_at < cutoff)
+             .update({'status': 'queued', 'locked_at': None,
+                      'locked_by': None},
+                     synchronize_session=False))
+    db.session.commit()
+    return count
+
+
+def work(batch_size=DEFAULT_BATCH_SIZE, poll_interval=DEFAULT_POLL_INTERVAL,
+         burst=False):
+    """Process jobs until stopped; with `burst`, stop once queue is empty."""
+
+    worker = worker_name()
+    requeue_stale()
+
+    while True:
+        processed = run_batch(batch_size, worker)
+
+        if not processed:
+            if burst:
+                return
+            time.sleep(poll_interval)
+
+
+##############################################################################
+# CLI
+
+
+@click.group('jobs')
+def jobs_cli():
+    """Manage the background job queue."""
+
+
+@jobs_cli.command('work')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE)
+@click.option('--poll-interval', default=DEFAULT_POLL_INTERVAL)
+@click.option('--processes', default=1, help='Number of worker processes.')
+@click.option('--burst', is_flag=True, help='Exit when the queue is empty.')
+@with_appcontext
+def work_command(batch_size, poll_interval, processes, burst):
+    """Run job workers."""
+
+    if processes == 1:
+        work(batch_size, poll_interval, burst)
+        return
+
+    # Each child needs its own connections, not ones inherited from us
+    db.engine.dispose()
+
+    app = current_app._get_current_object()
+    children = [Process(target=_work_in_child,
+                        args=(app, batch_size, poll_interval, burst))
+                for _ in range(processes)]
+    for proc in children:
+        proc.start()
+    for proc in children:
+        proc.join()
+
+
+def _work_in_child(app, batch_size, poll_interval, burst):
+    """Entry point for forked worker processes."""
+
+    with app.app_context():
+        work(batch_size, poll_interval, burst)
+
+
+@jobs_cli.command('stats')
+@with_appcontext
+def stats_command():
+    """Show number of jobs in each status."""
+
+    counts = (db.session
+              .query(Job.status, db.func.count(Job.id))
+              .group_by(Job.status)
+              .all())
+
+    for status, count in counts:
+        click.echo(f"{status}: {count}")
+
+
+@jobs_cli.command('requeue-stale')
+@with_appcontext
+def requeue_stale_command():
+    """Requeue jobs left running by crashed workers."""
+
+    click.echo(f"Requeued {requeue_stale()} job(s)")
@@ -0,0 +1,292 @@
+"""Per-user Bloom filters for "has X liked this?" and "does X follow Y?".
+
+Pages ask these questions for every message or user card they show, and
+the answer is nearly always no. Each user gets a Bloom filter over the ids
+they've liked and one over the ids they follow. A "no" from a filter is
+certain and needs no query; a "maybe" is confirmed against the DB, so
+answers are always exact.
+
+Filters are built from the DB the first time a user is asked about, and
+stamped with the query cache's version of that user's likes or follows
+(caching.py), read before the DB. Every like, unlike, follow and unfollow
+changes that version through `caching.forget_likes()` or
+`caching.forget_follow()`, whichever worker handles it, and a filter whose
+version has moved on is rebuilt before it answers. So a "no" is never
+older than the last write. Since that needs versions every worker sees,
+filters are off whenever the query cache is. Filters not used for
+FILTER_TTL seconds are dropped.
+
+`stats()` reports lookups, how many skipped the DB, the observed
+false-positive rate and memory used; admins see it at /admin/membership.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+
+FALSE_POSITIVE_RATE = 0.01
+
+# Filters are sized for at least this many items, and twice what the user
+# has now so new likes don't quickly degrade them
+MIN_CAPACITY = 64
+
+FILTER_TTL = 30
+
+# Most filters kept per process; least recently used are dropped
+MAX_FILTERS = 20000
+
+MASK64 = (1 << 64) - 1
+
+LIKES = 'likes'
+FOLLOWING = 'following'
+
+# The query cache entity each kind of filter is built from
+ENTITIES = {LIKES: 'likes', FOLLOWING: 'follows'}
+
+
+def _mix(x):
+    """splitmix64 finalizer: spread an integer key over 64 bits."""
+
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+class BloomFilter:
+    """Bloom filter over non-negative integers."""
+
+    def __init__(self, capacity, fp_rate=FALSE_POSITIVE_RATE):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(fp_rate) /
+                               math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: k positions from two halves of one 64-bit hash
+        h = _mix(key)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+    def nbytes(self):
+        return len(self.bits)
+
+
+class MembershipFilters:
+    """LRU collection of per-user filters, plus instrumentation.
+
+    `version(kind, user_id)` gives the current version of what a filter
+    is built from; a filter built under another version is rebuilt.
+    """
+
+    def __init__(self, version, ttl=FILTER_TTL, max_filters=MAX_FILTERS,
+                 fp_rate=FALSE_POSITIVE_RATE):
+        # caching imports the models, which import this module
+        from caching import SingleFlight
+
+        self.version = version
+        self.ttl = ttl
+        self.max_filters = max_filters
+        self.fp_rate = fp_rate
+        self._filters = OrderedDict()
+        self._lock = threading.Lock()
+        self.flights = SingleFlight()
+
+        self.lookups = 0
+        self.negatives = 0
+        self.false_positives = 0
+        self.builds = 0
+
+    def _load(self, kind, user_id):
+        from models import db, Like, FollowersFollowee
+
+        if kind == LIKES:
+            query = (db.session.query(Like.message_id)
+                     .filter(Like.user_id == user_id))
+        else:
+            query = (db.session.query(FollowersFollowee.followee_id)
+                     .filter(FollowersFollowee.follower_id == user_id))
+
+        return [item_id for (item_id,) in query]
+
+    def _build(self, kind, user_id):
+        items = self._load(kind, user_id)
+        bloom = BloomFilter(max(MIN_CAPACITY, 2 * len(items)), self.fp_rate)
+        for item_id in items:
+            bloom.add(item_id)
+        return bloom
+
+    def get(self, kind, user_id):
+        """The current filter for `user_id`'s `kind` set, built if needed.
+
+        Built outside the lock, so builds for different users run side by
+        side; concurrent requests for the same filter share one build.
+        The lock is only taken to look up and to install, and a build
+        never replaces one that started after it.
+        """
+
+        key = (kind, user_id)
+        # Before the DB, so a write landing during the build leaves the
+        # filter under a version that's already stale
+        version = self.version(kind, user_id)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._filters.get(key)
+            if entry is not None and entry[0] > now and entry[1] == version:
+                self._filters.move_to_end(key)
+                return entry[2]
+
+        # Only callers that saw the same version share a build
+        flight_key = (kind, user_id, version)
+        flight, led, waiting = self.flights.begin([flight_key])
+        if flight is None:
+            return self.flights.wait(waiting[flight_key], flight_key)
+
+        try:
+            bloom = self._build(kind, user_id)
+        except BaseException as error:
+            self.flights.finish(flight, led, error=error)
+            raise
+        self.flights.finish(flight, led, {flight_key: bloom})
+
+        expires = now + self.ttl
+        with self._lock:
+            self.builds += 1
+            entry = self._filters.get(key)
+            if entry is None or entry[0] <= expires:
+                self._filters[key] = (expires, version, bloom)
+            self._filters.move_to_end(key)
+            while len(self._filters) > self.max_filters:
+                self._filters.popitem(last=False)
+
+        return bloom
+
+    def candidates(self, kind, user_id, item_ids):
+        """Subset of `item_ids` the filter can't rule out."""
+
+        bloom = self.get(kind, user_id)
+        maybe = [item_id for item_id in item_ids if item_id in bloom]
+
+        self.lookups += len(item_ids)
+        self.negatives += len(item_ids) - len(maybe)
+        return maybe
+
+    def confirmed(self, maybe, actual):
+        """Count filter positives the DB said no to."""
+
+        self.false_positives += len(maybe) - len(actual)
+
+    def stats(self):
+        """Counters, observed false-positive rate and memory in use."""
+
+        with self._lock:
+            filters = [entry[2] for entry in self._filters.values()]
+
+        # Every item the filter said "no" to, or wrongly said "maybe" to
+        actual_negatives = self.negatives + self.false_positives
+        return {
+            'filters': len(filters),
+            'bytes': sum(bloom.nbytes() for bloom in filters),
+            'items': sum(bloom.count for bloom in filters),
+            'builds': self.builds,
+            'lookups': self.lookups,
+            'db_skipped': self.negatives,
+            'false_positives': self.false_positives,
+            'false_positive_rate': (self.false_positives / actual_negatives
+                                    if actual_negatives else 0.0),
+            'target_false_positive_rate': self.fp_rate,
+        }
+
+
+_init_lock = threading.Lock()
+
+
+def _version(kind, user_id):
+    import caching
+
+    return caching.current_cache().version((ENTITIES[kind], user_id))
+
+
+def current_filters():
+    """The app's filters, or None if switched off (MEMBERSHIP_FILTERS, or
+    no query cache to take versions from)."""
+
+    import caching
+
+    if (not has_app_context()
+            or not current_app.config.get('MEMBERSHIP_FILTERS', True)
+            or caching.current_cache() is None):
+        return None
+
+    app = current_app._get_current_object()
+    filters = app.extensions.get('membership')
+
+    if filters is None:
+        with _init_lock:
+            filters = app.extensions.get('membership')
+            if filters is None:
+                filters = MembershipFilters(
+                    _version,
+                    ttl=app.config.get('MEMBERSHIP_FILTER_TTL', FILTER_TTL))
+                app.extensions['membership'] = filters
+
+    return filters
+
+
+def liked_among(user_id, message_ids):
+    """Set of `message_ids` that `user_id` has liked."""
+
+    from models import db, Like
+
+    filters = current_filters()
+    maybe = (filters.candidates(LIKES, user_id, message_ids)
+             if filters is not None else list(message_ids))
+
+    if not maybe:
+        return set()
+
+    liked = {message_id for (message_id,) in
+             db.session.query(Like.message_id)
+             .filter(Like.user_id == user_id, Like.message_id.in_(maybe))}
+
+    if filters is not None:
+        filters.confirmed(maybe, liked)
+
+    return liked
+
+
+def is_following(follower_id, followee_id):
+    """Does `follower_id` follow `followee_id`? None if filters are off."""
+
+    from models import db, FollowersFollowee
+
+    filters = current_filters()
+    if filters is None:
+        return None
+
+    if not filters.candidates(FOLLOWING, follower_id, [followee_id]):
+        return False
+
+    found = db.session.query(
+        db.session.query(FollowersFollowee)
+        .filter_by(follower_id=follower_id, followee_id=followee_id)
+        .exists()).scalar()
+
+    filters.confirmed([followee_id], [followee_id] if found else [])
+    return found
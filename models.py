@@ -5,6 +5,9 @@ from datetime import datetime
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
+import membership
+import snowflake
+
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
@@ -28,6 +31,11 @@ class FollowersFollowee(db.Model):
         primary_key=True,
     )
 
+    # Primary key leads with followee_id; this serves "who does X follow?"
+    __table_args__ = (
+        db.Index('ix_follows_follower_followee', 'follower_id', 'followee_id'),
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -74,6 +82,11 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Set when the account is deleted; its rows are purged in the background
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     likes = db.relationship('Like', backref='user', lazy='dynamic')
 
     # WHAT DOES LAZY MEAN???
@@ -90,21 +103,47 @@ class User(db.Model):
         "User",
         secondary="follows",
         primaryjoin=(FollowersFollowee.followee_id == id),
-        secondaryjoin=(FollowersFollowee.follower_id == id),
-        backref=db.backref('following', lazy='dynamic'),
+        # Deleted accounts drop out of both lists straight away, before
+        # their follows are purged
+        secondaryjoin=db.and_(FollowersFollowee.follower_id == id,
+                              deleted_at.is_(None)),
+        back_populates='following',
+        lazy='dynamic')
+
+    following = db.relationship(
+        "User",
+        secondary="follows",
+        primaryjoin=(FollowersFollowee.follower_id == id),
+        secondaryjoin=db.and_(FollowersFollowee.followee_id == id,
+                              deleted_at.is_(None)),
+        back_populates='followers',
         lazy='dynamic')
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @classmethod
+    def active(cls):
+        """Query of users that haven't been deleted."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
+        found = membership.is_following(other_user.id, self.id)
+        if found is not None:
+            return found
+
         return bool(self.followers.filter_by(id=other_user.id).first())
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
+        found = membership.is_following(self.id, other_user.id)
+        if found is not None:
+            return found
+
         return bool(self.following.filter_by(id=other_user.id).first())
 
     @classmethod
@@ -137,7 +176,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -147,14 +186,38 @@ class User(db.Model):
         return False
 
 
+def _message_id(context):
+    """Time-ordered id; for imported messages, ordered by their timestamp."""
+
+    timestamp = context.current_parameters.get('timestamp')
+    if timestamp is not None:
+        return snowflake.id_at(timestamp)
+    return snowflake.next_id()
+
+
+def _message_timestamp(context):
+    """Time the message's id was made, so the two always agree."""
+
+    message_id = context.current_parameters.get('id')
+    if snowflake.is_snowflake(message_id):
+        return snowflake.time_of(message_id)
+    return datetime.utcnow()
+
+
 class Message(db.Model):
-    """An individual message ("warble")."""
+    """An individual message ("warble").
+
+    Ids are snowflakes (see snowflake.py), so ordering by id is ordering by
+    time and feeds can sort and page on the primary key alone.
+    """
 
     __tablename__ = 'messages'
 
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=_message_id,
     )
 
     text = db.Column(
@@ -165,17 +228,55 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=_message_timestamp,
     )
 
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete='CASCADE'),
         nullable=False,
+        index=True,
+    )
+
+    # Message this one replies to. Not a foreign key, for the same reason
+    # as likes' (see partitions.py)
+    reply_to_id = db.Column(
+        db.BigInteger,
+    )
+
+    # Id of the message that started the thread; a thread's first message
+    # has its own id here
+    thread_id = db.Column(
+        db.BigInteger,
+    )
+
+    # Ids from the thread's first message down to this one (see threads.py).
+    # "C" collation so it sorts byte by byte, keeping replies under their
+    # parent
+    path = db.Column(
+        db.Text(collation='C'),
+    )
+
+    # Replies below this message, at any depth
+    reply_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
     )
 
     likes = db.relationship('Like', backref='messages', lazy='dynamic')
 
+    # A thread, or a reply and everything under it, is one range of this
+    __table_args__ = (
+        db.Index('ix_messages_thread_path', 'thread_id', 'path'),
+    )
+
+    @classmethod
+    def visible(cls):
+        """Query of messages whose author hasn't been deleted."""
+
+        return cls.query.join(User).filter(User.deleted_at.is_(None))
+
 
 class Like(db.Model):
     """A like on a message"""
@@ -189,11 +290,301 @@ class Like(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='CASCADE'),
         primary_key=True
     )
 
+    # When the like was made; trending.py warms up from recent ones. Empty
+    # for likes made before it was recorded
+    created_at = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
+    )
+
+    # Primary key leads with user_id; this serves "who liked message X?"
+    # and keeps deleting a message from scanning every like
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
+        db.Index('ix_likes_created_at', 'created_at'),
+    )
+
+
+class MessageTag(db.Model):
+    """A hashtag used in a message, lowercased and without the '#'."""
+
+    __tablename__ = 'message_tags'
+
+    # Primary key order serves "newest messages tagged X" as a range scan
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    # For removing a message's tags along with it
+    __table_args__ = (
+        db.Index('ix_message_tags_message_id', 'message_id'),
+    )
+
+
+class Mention(db.Model):
+    """A user @mentioned in a message."""
+
+    __tablename__ = 'mentions'
+
+    # Primary key order serves "newest messages mentioning X" as a range scan
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    __table_args__ = (
+        db.Index('ix_mentions_message_id', 'message_id'),
+    )
+
+
+class Suggestion(db.Model):
+    """A precomputed "who to follow" suggestion for a user."""
+
+    __tablename__ = 'suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    suggested_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    # 0 is the best suggestion
+    rank = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    suggested = db.relationship('User', foreign_keys=[suggested_id])
+
+    __table_args__ = (
+        db.Index('ix_suggestions_user_rank', 'user_id', 'rank'),
+    )
+
+
+class SuggestionRefresh(db.Model):
+    """Marks a user whose follow set changed since suggestions were built."""
+
+    __tablename__ = 'suggestion_refreshes'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+
+class Job(db.Model):
+    """A unit of background work waiting in the job queue.
+
+    Jobs are written in the same transaction as the request that creates
+    them, so a job exists if and only if its write was committed.
+    """
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # JSON-encoded keyword arguments for the task
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    # queued -> running -> done / failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+        index=True,
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    locked_by = db.Column(
+        db.Text,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.name} ({self.status})>"
+
+
+class AccountPurge(db.Model):
+    """Progress of purging a deleted account's rows.
+
+    Each batch updates these counts in the same transaction as its deletes,
+    so after a crash the purge carries on from where it got to.
+    """
+
+    __tablename__ = 'account_purges'
+
+    # Not a foreign key: this row outlives the user it describes
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # Name of the step being worked on; 'done' when finished
+    stage = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    follows = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    messages = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    def __repr__(self):
+        return f"<AccountPurge of user #{self.user_id}: {self.stage}>"
+
+
+class DataExport(db.Model):
+    """A user's data export, written to a file by a background job."""
+
+    __tablename__ = 'data_exports'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+        index=True,
+    )
+
+    # 'ndjson' or 'zip'
+    format = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # queued -> done / failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    # Name of the finished file in the exports folder
+    filename = db.Column(
+        db.Text,
+    )
+
+    rows = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    def __repr__(self):
+        return f"<DataExport #{self.id} of user #{self.user_id}: {self.status}>"
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -201,5 +592,4 @@ def connect_db(app):
     You should call this in your Flask app.
     """
 
-    db.app = app
     db.init_app(app)
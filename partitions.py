@@ -0,0 +1,396 @@
+"""Monthly partitions of the messages table, and archiving cold months.
+
+On Postgres, `flask partitions enable` turns `messages` into a table
+partitioned by RANGE (timestamp), one partition per calendar month
+(`messages_2026_10` holds October 2026) plus a default partition that
+catches anything outside them, such as imported messages from a month
+before partitioning. Postgres then only reads the partitions a query's
+timestamp bounds can touch, so `recent_first()` keeps timelines on the
+newest months. Creating a month's partition moves that month's rows out
+of the default partition into it; until then, the month is listed and
+archived from the default partition.
+
+Postgres can't enforce a foreign key to a partitioned table unless it
+includes the partition key, so enabling drops the foreign keys from likes,
+message_tags and mentions to messages. Code that deletes messages removes
+those rows first (see `messages_destroy()` and `deletion.py`).
+
+`flask partitions maintain` (run it daily) creates partitions for the next
+PARTITIONS_AHEAD months and, with `--archive-after N`, archives months more
+than N months old. Archiving writes the month's messages and their likes to
+gzipped CSV files in ARCHIVE_DIR, then detaches and drops the partition.
+
+On other databases (or before `enable`) a "partition" is just a month's
+range of timestamps: the same commands list, archive and delete rows by
+month, so tests and small installs behave the same way.
+"""
+
+import csv
+import gzip
+import os
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, text
+
+import snowflake
+from models import db, Message, Like, MessageTag, Mention
+
+PARTITIONS_AHEAD = 3
+
+# How far back timelines look before falling back to older partitions
+HOT_WINDOW = timedelta(days=31)
+
+DEFAULT_PARTITION = 'messages_default'
+
+
+def month_start(when):
+    return datetime(when.year, when.month, 1)
+
+
+def next_month(start):
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+
+def partition_name(start):
+    return f"messages_{start:%Y_%m}"
+
+
+def is_partitioned():
+    """Is `messages` a partitioned table?"""
+
+    if db.engine.dialect.name != 'postgresql':
+        return False
+
+    return bool(db.session.execute(text(
+        "SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = to_regclass('messages')")).scalar())
+
+
+def partition_exists(start):
+    """Does the month starting `start` have a partition of its own?"""
+
+    return bool(db.session.execute(
+        text("SELECT to_regclass(:name) IS NOT NULL"),
+        {'name': partition_name(start)}).scalar())
+
+
+def _in_default(start):
+    """Condition on a month's rows, for SQL on the default partition."""
+
+    return (f"\"timestamp\" >= '{start:%Y-%m-%d}' "
+            f"AND \"timestamp\" < '{next_month(start):%Y-%m-%d}'")
+
+
+def months():
+    """Start of each month that has a partition or, in the default
+    partition (or if not partitioned), messages; oldest first."""
+
+    if is_partitioned():
+        names = [name for (name,) in db.session.execute(text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass('messages')"))]
+        found = {datetime.strptime(name, 'messages_%Y_%m')
+                 for name in names if name != DEFAULT_PARTITION}
+        found.update(start for (start,) in db.session.execute(text(
+            f"SELECT DISTINCT date_trunc('month', \"timestamp\") "
+            f"FROM {DEFAULT_PARTITION}")))
+        return sorted(found)
+
+    oldest, newest = db.session.query(func.min(Message.timestamp),
+                                      func.max(Message.timestamp)).one()
+    found = []
+    if oldest is not None:
+        start = month_start(oldest)
+        while start <= newest:
+            found.append(start)
+            start = next_month(start)
+    return found
+
+
+def create_partition(start):
+    """Create the partition for the month starting `start`, if missing.
+
+    Postgres won't create it while the default partition holds rows from
+    that month, so those are moved into it: taken out into a temporary
+    table first, then put back once the partition exists. The default
+    partition is locked meanwhile; caller commits.
+    """
+
+    if partition_exists(start):
+        return
+
+    name = partition_name(start)
+    db.session.execute(text(
+        f"LOCK TABLE {DEFAULT_PARTITION} IN ACCESS EXCLUSIVE MODE"))
+
+    moving = db.session.execute(text(
+        f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} "
+        f"WHERE {_in_default(start)})")).scalar()
+    if moving:
+        db.session.execute(text(
+            f"CREATE TEMPORARY TABLE {name}_moving (LIKE messages)"))
+        db.session.execute(text(
+            f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+            f"WHERE {_in_default(start)} RETURNING *) "
+            f"INSERT INTO {name}_moving SELECT * FROM moved"))
+
+    db.session.execute(text(
+        f"CREATE TABLE {name} PARTITION OF messages "
+        f"FOR VALUES FROM ('{start:%Y-%m-%d}') "
+        f"TO ('{next_month(start):%Y-%m-%d}')"))
+
+    if moving:
+        db.session.execute(text(
+            f"INSERT INTO messages SELECT * FROM {name}_moving"))
+        db.session.execute(text(f"DROP TABLE {name}_moving"))
+
+
+def ensure_partitions(ahead=PARTITIONS_AHEAD, now=None):
+    """Create partitions from this month through `ahead` months on.
+
+    Returns how many months are covered. Does nothing unless partitioned.
+    """
+
+    if not is_partitioned():
+        return 0
+
+    _create_ahead(ahead, now)
+    db.session.commit()
+
+    return ahead + 1
+
+
+def _create_ahead(ahead, now=None):
+    start = month_start(now or datetime.utcnow())
+    for _ in range(ahead + 1):
+        create_partition(start)
+        start = next_month(start)
+
+
+def enable(ahead=PARTITIONS_AHEAD):
+    """Convert `messages` to a partitioned table, keeping its rows.
+
+    Runs in one transaction and holds an exclusive lock on messages while
+    the rows are copied, so run it during a quiet period.
+    """
+
+    if db.engine.dialect.name != 'postgresql':
+        raise click.ClickException("Partitioning needs Postgres")
+
+    if is_partitioned():
+        return False
+
+    existing = months()
+
+    statements = [
+        "LOCK TABLE messages IN ACCESS EXCLUSIVE MODE",
+        "ALTER TABLE messages RENAME TO messages_unpartitioned",
+        "CREATE TABLE messages (LIKE messages_unpartitioned "
+        "INCLUDING DEFAULTS) PARTITION BY RANGE (\"timestamp\")",
+        "ALTER TABLE messages ADD PRIMARY KEY (id, \"timestamp\")",
+        "ALTER TABLE messages ADD FOREIGN KEY (user_id) "
+        "REFERENCES users (id) ON DELETE CASCADE",
+        "CREATE INDEX ix_messages_user_id_new ON messages (user_id)",
+        "CREATE INDEX ix_messages_timestamp ON messages (\"timestamp\")",
+        "CREATE INDEX ix_messages_thread_path_new "
+        "ON messages (thread_id, path)",
+        f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF messages DEFAULT",
+        "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey",
+        "ALTER TABLE message_tags "
+        "DROP CONSTRAINT IF EXISTS message_tags_message_id_fkey",
+        "ALTER TABLE mentions "
+        "DROP CONSTRAINT IF EXISTS mentions_message_id_fkey",
+    ]
+    for statement in statements:
+        db.session.execute(text(statement))
+
+    for start in existing:
+        create_partition(start)
+    _create_ahead(ahead)
+
+    for statement in [
+            "INSERT INTO messages SELECT * FROM messages_unpartitioned",
+            "ALTER SEQUENCE IF EXISTS messages_id_seq OWNED BY messages.id",
+            "DROP TABLE messages_unpartitioned",
+            "ALTER INDEX ix_messages_user_id_new "
+            "RENAME TO ix_messages_user_id",
+            "ALTER INDEX ix_messages_thread_path_new "
+            "RENAME TO ix_messages_thread_path"]:
+        db.session.execute(text(statement))
+
+    db.session.commit()
+    return True
+
+
+def recent_first(query, limit, before=None, window=HOT_WINDOW):
+    """Newest `limit` messages from a Message `query`, newest first.
+
+    With `before` (a message id), only messages older than that one, for
+    paging. Asks for the `window` before the starting point first, which
+    Postgres answers from the hot partitions alone; only reads further back
+    if that's not enough.
+    """
+
+    top = datetime.utcnow()
+    if before is not None:
+        query = query.filter(Message.id < before)
+        if snowflake.is_snowflake(before):
+            top = snowflake.time_of(before)
+
+    cutoff = top - window
+
+    found = (query
+             .filter(Message.timestamp >= cutoff)
+             .order_by(Message.id.desc())
+             .limit(limit)
+             .all())
+
+    if len(found) < limit:
+        found += (query
+                  .filter(Message.timestamp < cutoff)
+                  .order_by(Message.id.desc())
+                  .limit(limit - len(found))
+                  .all())
+
+    return found
+
+
+def _export(query, path):
+    """Write `query`'s rows to gzipped CSV at `path`; return row count."""
+
+    tmp_path = path + '.tmp'
+    count = 0
+
+    with gzip.open(tmp_path, 'wt', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow([col['name'] for col in query.column_descriptions])
+        for row in query.yield_per(1000):
+            writer.writerow(row)
+            count += 1
+
+    os.replace(tmp_path, path)
+    return count
+
+
+def archive_dir_for(app):
+    """Directory archived months are written to."""
+
+    return app.config.get('ARCHIVE_DIR') or os.path.join(
+        app.instance_path, 'archive')
+
+
+def archive(start, archive_dir=None):
+    """Archive the month starting `start` to gzipped CSVs and remove it.
+
+    Writes `<partition>.csv.gz` (messages) and `<partition>_likes.csv.gz`
+    (their likes), then deletes those likes and the messages' tags and
+    mentions, and detaches and drops the partition, or deletes the month's
+    rows if not partitioned. The files are written before anything is
+    removed, so an interrupted archive can simply be run again. Returns
+    (messages, likes) archived.
+    """
+
+    archive_dir = archive_dir or archive_dir_for(current_app)
+    os.makedirs(archive_dir, exist_ok=True)
+
+    name = partition_name(start)
+    in_month = db.and_(Message.timestamp >= start,
+                       Message.timestamp < next_month(start))
+
+    message_ids = db.session.query(Message.id).filter(in_month)
+    columns = [getattr(Message, col.key) for col in Message.__table__.columns]
+
+    messages = _export(db.session.query(*columns).filter(in_month),
+                       os.path.join(archive_dir, f"{name}.csv.gz"))
+    likes = _export(db.session.query(Like.user_id, Like.message_id)
+                    .filter(Like.message_id.in_(message_ids)),
+                    os.path.join(archive_dir, f"{name}_likes.csv.gz"))
+
+    # Tags and mentions aren't archived; they can be rebuilt from the text
+    for model in (Like, MessageTag, Mention):
+        (model
+         .query
+         .filter(model.message_id.in_(message_ids))
+         .delete(synchronize_session=False))
+
+    # A month without a partition of its own is in the default partition
+    if is_partitioned() and partition_exists(start):
+        db.session.execute(text(
+            f"ALTER TABLE messages DETACH PARTITION {name}"))
+        db.session.execute(text(f"DROP TABLE {name}"))
+    else:
+        Message.query.filter(in_month).delete(synchronize_session=False)
+
+    db.session.commit()
+    return messages, likes
+
+
+def archive_older_than(months_old, now=None, archive_dir=None):
+    """Archive every month more than `months_old` months before now."""
+
+    cutoff = month_start(now or datetime.utcnow())
+    for _ in range(months_old):
+        cutoff = month_start(cutoff - timedelta(days=1))
+
+    archived = []
+    for start in months():
+        if start < cutoff:
+            archive(start, archive_dir)
+            archived.append(start)
+
+    return archived
+
+
+##############################################################################
+# CLI
+
+
+@click.group('partitions')
+def partitions_cli():
+    """Manage monthly partitions of the messages table."""
+
+
+@partitions_cli.command('enable')
+@click.option('--ahead', default=PARTITIONS_AHEAD)
+@with_appcontext
+def enable_command(ahead):
+    """Convert messages to a partitioned table (Postgres)."""
+
+    if enable(ahead):
+        click.echo("messages is now partitioned by month")
+    else:
+        click.echo("messages is already partitioned")
+
+
+@partitions_cli.command('maintain')
+@click.option('--ahead', default=PARTITIONS_AHEAD,
+              help='Months of partitions to create in advance.')
+@click.option('--archive-after', type=int, default=None,
+              help='Archive months older than this many months.')
+@with_appcontext
+def maintain_command(ahead, archive_after):
+    """Create upcoming partitions and archive old ones (run daily)."""
+
+    ensure_partitions(ahead)
+
+    if archive_after is not None:
+        for start in archive_older_than(archive_after):
+            click.echo(f"Archived {partition_name(start)}")
+
+
+@partitions_cli.command('list')
+@with_appcontext
+def list_command():
+    """Show months with partitions (or messages) and their row counts."""
+
+    for start in months():
+        count = (Message
+                 .query
+                 .filter(Message.timestamp >= start,
+                         Message.timestamp < next_month(start))
+                 .count())
+        click.echo(f"{partition_name(start)}: {count}")
@@ -0,0 +1,91 @@
+"""Plain rows for list pages.
+
+List pages print a few fields of each user or message, but loading them
+as ORM objects costs far more than that: every column (long bios,
+password hashes), instance state, an identity map entry and relationship
+attributes for each one. These queries select only the columns the list
+templates use and return named tuples, which have no per-row dict and
+read like the objects they replace, so templates don't change. Nothing is
+added to the session.
+
+Rows are read-only snapshots; pages that change things still load models.
+`python bench_rows.py` compares memory and time with the ORM path.
+"""
+
+from collections import namedtuple
+
+from models import db, User, Message
+
+# What user cards (user lists, follow lists) show
+UserCard = namedtuple('UserCard', ['id', 'username', 'image_url',
+                                   'header_image_url', 'bio'])
+
+# A message's author, as shown next to it
+Author = namedtuple('Author', ['id', 'username', 'image_url'])
+
+# What timelines show of a message; `user` is its Author
+MessageRow = namedtuple('MessageRow', ['id', 'text', 'timestamp',
+                                       'reply_count', 'user_id', 'user'])
+
+USER_CARD_COLUMNS = (User.id, User.username, User.image_url,
+                     User.header_image_url, User.bio)
+
+MESSAGE_COLUMNS = (Message.id, Message.text, Message.timestamp,
+                   Message.reply_count, Message.user_id,
+                   User.username, User.image_url)
+
+
+def user_cards_query():
+    """Query of active users' card columns, to filter and order as usual.
+
+    Pass it to `user_cards()` to get rows out.
+    """
+
+    return (db.session
+            .query(*USER_CARD_COLUMNS)
+            .filter(User.deleted_at.is_(None)))
+
+
+def user_cards(query):
+    """UserCards from a `user_cards_query()`, as they're fetched."""
+
+    return map(UserCard._make, query)
+
+
+def user_cards_by_id(user_ids):
+    """{id: UserCard} for the active users among `user_ids`."""
+
+    if not user_ids:
+        return {}
+    return {card.id: card for card in
+            user_cards(user_cards_query().filter(User.id.in_(user_ids)))}
+
+
+def messages_query():
+    """Query of visible messages' timeline columns, with their authors'.
+
+    Pass it to `message_rows()` to get rows out.
+    """
+
+    return (db.session
+            .query(*MESSAGE_COLUMNS)
+            .select_from(Message)
+            .join(User, Message.user_id == User.id)
+            .filter(User.deleted_at.is_(None)))
+
+
+def message_rows(query):
+    """MessageRows from a `messages_query()`, as they're fetched.
+
+    Messages by the same author share one Author.
+    """
+
+    authors = {}
+
+    for (message_id, text, timestamp, reply_count, user_id,
+         username, image_url) in query:
+        author = authors.get(user_id)
+        if author is None:
+            author = authors[user_id] = Author(user_id, username, image_url)
+        yield MessageRow(message_id, text, timestamp, reply_count, user_id,
+                         author)
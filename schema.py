@@ -0,0 +1,100 @@
+"""Bring an existing database up to the current models.
+
+`db.create_all()` creates missing tables but never changes ones that
+already exist, so a database created before these columns were added
+needs `flask schema upgrade` (Postgres) once, before the new code serves
+requests:
+
+- messages.id and likes.message_id become bigint with no serial default,
+  as snowflake ids (snowflake.py) overflow an integer on the first post;
+- users.deleted_at (deletion.py);
+- messages.reply_to_id, thread_id, path and reply_count (threads.py);
+- likes.created_at (trending.py), empty for the likes already there;
+- the indexes on follows, messages and likes the newer queries rely on.
+
+Every step checks or uses IF NOT EXISTS, so running it again, or on a
+database made by `db.create_all()`, changes nothing. It runs in one
+transaction; changing the id types rewrites messages and likes under an
+exclusive lock, so run it during a quiet period.
+"""
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text
+
+from models import db
+
+# Columns that must be bigint: (table, column)
+BIGINT_COLUMNS = [
+    ('messages', 'id'),
+    ('likes', 'message_id'),
+]
+
+STATEMENTS = [
+    "ALTER TABLE messages ALTER COLUMN id DROP DEFAULT",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP",
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS reply_to_id BIGINT",
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS thread_id BIGINT",
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS path TEXT COLLATE \"C\"",
+    "ALTER TABLE messages "
+    "ADD COLUMN IF NOT EXISTS reply_count INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE likes ADD COLUMN IF NOT EXISTS created_at TIMESTAMP",
+    "CREATE INDEX IF NOT EXISTS ix_follows_follower_followee "
+    "ON follows (follower_id, followee_id)",
+    "CREATE INDEX IF NOT EXISTS ix_messages_user_id ON messages (user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_messages_thread_path "
+    "ON messages (thread_id, path)",
+    "CREATE INDEX IF NOT EXISTS ix_likes_message_id ON likes (message_id)",
+    "CREATE INDEX IF NOT EXISTS ix_likes_created_at ON likes (created_at)",
+]
+
+
+def column_type(table, column):
+    """Postgres data type of `table`.`column`, or None if there's none."""
+
+    return db.session.execute(
+        text("SELECT data_type FROM information_schema.columns "
+             "WHERE table_schema = current_schema() "
+             "AND table_name = :table AND column_name = :column"),
+        {'table': table, 'column': column}).scalar()
+
+
+def upgrade():
+    """Apply whatever the database is missing; returns the steps taken."""
+
+    if db.engine.dialect.name != 'postgresql':
+        raise click.ClickException("Upgrading the schema needs Postgres")
+
+    db.create_all()
+
+    done = []
+    for table, column in BIGINT_COLUMNS:
+        if column_type(table, column) != 'bigint':
+            db.session.execute(text(
+                f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT"))
+            done.append(f"{table}.{column} is now bigint")
+
+    for statement in STATEMENTS:
+        db.session.execute(text(statement))
+
+    db.session.commit()
+    return done
+
+
+##############################################################################
+# CLI
+
+
+@click.group('schema')
+def schema_cli():
+    """Manage the database schema."""
+
+
+@schema_cli.command('upgrade')
+@with_appcontext
+def upgrade_command():
+    """Add the columns and indexes an older database is missing."""
+
+    for step in upgrade():
+        click.echo(step)
+    click.echo("Schema is up to date")
@@ -1,9 +1,11 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, FollowersFollowee
+from datetime import datetime
+from app import create_app
+from models import db, User, Message, FollowersFollowee
 
+create_app().app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -11,8 +13,11 @@ db.create_all()
 with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
+# Timestamps are parsed so each message's id can be made for its own time
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    db.session.bulk_insert_mappings(Message, [
+        dict(row, timestamp=datetime.fromisoformat(row['timestamp']))
+        for row in DictReader(messages)])
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(FollowersFollowee, DictReader(follows))
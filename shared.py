@@ -0,0 +1,351 @@
+"""Counters and small state shared by every worker process on a host.
+
+Gunicorn forks several workers, so anything a worker keeps in its own
+memory (cache hit counts, prewarm counts, hot-key counts, cache versions,
+trending scores) only sees that worker's share of the traffic. A
+SharedTable lives in a memory-mapped file instead, which every worker
+maps; writes by one are seen by all straight away, without a network
+service.
+
+A table is a fixed-size hash table of string keys to float values (exact
+for counts up to 2**53). Its slots are split into STRIPES stripes; a key
+always lives in the stripe its hash picks, and each stripe has its own
+lock: a thread lock within a process and an fcntl byte-range lock on the
+file across processes. Every read-modify-write of a key (`update()`,
+`add()`) runs under its stripe's lock, so it is atomic across workers.
+
+Keys are placed by linear probing within their stripe, and never more
+than MAX_PROBE slots past where their hash puts them, so finding, adding
+or removing a key reads at most MAX_PROBE slots however big the stripe
+is. Removing a key shifts the keys after it back rather than leaving a
+gap, so no lookup has to probe past an empty slot.
+
+Tables never grow. When none of the MAX_PROBE slots a key may use is
+free, `add()` gives up (returns None) unless asked to `evict`, in which
+case the key takes over the slot of the smallest value among them,
+starting from that value. That is the "space-saving" heavy hitter scheme, sampled: it
+keeps the biggest counts and can only overestimate the rest.
+
+Set SHARED_STATE_PATH (e.g. /dev/shm/warbler) to use shared tables; each
+table is a file named after it next to that path. Without it, counters
+stay per worker as before. Delete the files to reset them.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import current_app, has_app_context
+
+MAGIC = b'WRBLTAB1'
+
+# Magic, slot count, stripe count
+HEADER = struct.Struct('<8sII')
+HEADER_SIZE = 64
+
+# Key hash (0 marks an empty slot), key, value
+SLOT = struct.Struct('<Q48sd')
+KEY_BYTES = 48
+
+STRIPES = 64
+
+# Furthest a key is placed from its home slot
+MAX_PROBE = 32
+
+# Tables used by the app, and their slot counts
+TABLES = {
+    'stats': 4096,
+    'hotkeys': 1024,
+    # Query cache versions (caching.py); 4 MB
+    'versions': 65536,
+    # Trending scores by message id (trending.py); 1 MB
+    'trending': 16384,
+}
+
+
+def _hash(key):
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class TableFull(Exception):
+    """No free slot left in a key's stripe."""
+
+
+class SharedTable:
+    """Fixed-size str -> float hash table in a file mapped by every worker."""
+
+    def __init__(self, path, slots=4096, stripes=STRIPES):
+        if slots % stripes:
+            raise ValueError("slots must be a multiple of stripes")
+
+        self.path = path
+        self.slots = slots
+        self.stripes = stripes
+        self.per_stripe = slots // stripes
+        self.max_probe = min(MAX_PROBE, self.per_stripe)
+        self.size = HEADER_SIZE + slots * SLOT.size
+        self.pid = os.getpid()
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # Byte 0 guards setting the file up; bytes 1.. are the stripe locks
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            if os.fstat(self.fd).st_size == 0:
+                os.ftruncate(self.fd, self.size)
+                os.pwrite(self.fd, HEADER.pack(MAGIC, slots, stripes), 0)
+            header = HEADER.unpack(os.pread(self.fd, HEADER.size, 0))
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, 0)
+
+        if header != (MAGIC, slots, stripes):
+            os.close(self.fd)
+            raise ValueError(f"{path} holds a different table {header[1:]}; "
+                             "delete it to start afresh")
+
+        self.map = mmap.mmap(self.fd, self.size)
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    @contextmanager
+    def _locked(self, stripe):
+        with self._locks[stripe]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, 1 + stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, 1 + stripe)
+
+    def _offset(self, index):
+        return HEADER_SIZE + index * SLOT.size
+
+    def _read(self, index):
+        return SLOT.unpack_from(self.map, self._offset(index))
+
+    def _write(self, index, key_hash, key, value):
+        SLOT.pack_into(self.map, self._offset(index), key_hash, key, value)
+
+    def _probe(self, key_hash):
+        """The key's stripe, and the slot indexes it may live in, in
+        probing order."""
+
+        stripe = key_hash % self.stripes
+        start = stripe * self.per_stripe
+        home = (key_hash // self.stripes) % self.per_stripe
+        return stripe, [start + (home + n) % self.per_stripe
+                        for n in range(self.max_probe)]
+
+    @staticmethod
+    def _encode(key):
+        encoded = key.encode()
+        if len(encoded) > KEY_BYTES:
+            raise ValueError(f"Key longer than {KEY_BYTES} bytes: {key!r}")
+        return encoded
+
+    def _find(self, key_hash, encoded, indexes):
+        """(index of the key's slot or of the first free one, found)."""
+
+        for index in indexes:
+            slot_hash, slot_key, _ = self._read(index)
+            if slot_hash == 0:
+                return index, False
+            if slot_hash == key_hash and slot_key.rstrip(b'\0') == encoded:
+                return index, True
+        return None, False
+
+    def update(self, key, change, evict=False):
+        """Set `key` to `change(current value or None)`, atomically.
+
+        Returns the new value. If `change` returns None the key is removed.
+        Raises TableFull if the key is new and its slots are all taken,
+        unless `evict`: then it replaces the smallest entry among them and
+        `change` is passed that entry's value.
+        """
+
+        encoded = self._encode(key)
+        key_hash = _hash(encoded)
+        stripe, indexes = self._probe(key_hash)
+
+        with self._locked(stripe):
+            index, found = self._find(key_hash, encoded, indexes)
+            current = self._read(index)[2] if found else None
+
+            if index is None and evict:
+                index = min(indexes, key=lambda i: self._read(i)[2])
+                current = self._read(index)[2]
+
+            value = change(current)
+            if value is None:
+                if found:
+                    self._remove(stripe, index)
+            elif index is None:
+                raise TableFull(key)
+            else:
+                self._write(index, key_hash, encoded, value)
+
+        return value
+
+    def _remove(self, stripe, index):
+        """Empty slot `index`, shifting back the entries after it that
+        probed past it, so no probe runs past a gap. Call with the stripe
+        locked."""
+
+        start = stripe * self.per_stripe
+        hole = at = index - start
+
+        for _ in range(self.per_stripe - 1):
+            at = (at + 1) % self.per_stripe
+            gap = (at - hole) % self.per_stripe
+            # An entry this far on can't have probed past the hole
+            if gap >= self.max_probe:
+                break
+
+            key_hash, key, value = self._read(start + at)
+            if key_hash == 0:
+                break
+
+            home = (key_hash // self.stripes) % self.per_stripe
+            if (at - home) % self.per_stripe >= gap:
+                self._write(start + hole, key_hash, key, value)
+                hole = at
+
+        self._write(start + hole, 0, b'', 0.0)
+
+    def add(self, key, amount=1, evict=False):
+        """Add `amount` to `key` (from 0); the new value, or None if full."""
+
+        try:
+            return self.update(key, lambda value: (value or 0) + amount,
+                               evict)
+        except TableFull:
+            return None
+
+    def get(self, key, default=0):
+        encoded = self._encode(key)
+        key_hash = _hash(encoded)
+        stripe, indexes = self._probe(key_hash)
+
+        with self._locked(stripe):
+            index, found = self._find(key_hash, encoded, indexes)
+            return self._read(index)[2] if found else default
+
+    def delete(self, key):
+        self.update(key, lambda value: None)
+
+    def items(self, prefix=''):
+        """[(key, value)] of every entry whose key starts with `prefix`."""
+
+        encoded = prefix.encode()
+        found = []
+
+        for stripe in range(self.stripes):
+            start = stripe * self.per_stripe
+            with self._locked(stripe):
+                for index in range(start, start + self.per_stripe):
+                    key_hash, key, value = self._read(index)
+                    key = key.rstrip(b'\0')
+                    if key_hash and key.startswith(encoded):
+                        found.append((key.decode(), value))
+
+        return found
+
+    def scale(self, factor, prefix='', drop_below=0):
+        """Multiply the values under `prefix` by `factor`, removing those
+        that end up below `drop_below`."""
+
+        for key, _ in self.items(prefix):
+            def change(value):
+                if value is None:
+                    return None
+                value *= factor
+                return value if value >= drop_below else None
+            self.update(key, change)
+
+    def clear(self):
+        for stripe in range(self.stripes):
+            start = stripe * self.per_stripe
+            with self._locked(stripe):
+                for index in range(start, start + self.per_stripe):
+                    self._write(index, 0, b'', 0.0)
+
+    def stats(self):
+        return {'slots': self.slots,
+                'used': len(self.items()),
+                'memory_bytes': self.size}
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class Counters:
+    """Named counts under `prefix` in a shared table."""
+
+    def __init__(self, table, prefix):
+        self.table = table
+        self.prefix = prefix
+
+    def add(self, name, amount=1):
+        if amount:
+            self.table.add(f'{self.prefix}:{name}', amount)
+
+    def get(self, name):
+        return int(self.table.get(f'{self.prefix}:{name}'))
+
+
+class LocalCounters:
+    """The same, kept in this process only."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, name, amount=1):
+        with self._lock:
+            self.counts[name] += amount
+
+    def get(self, name):
+        return self.counts[name]
+
+
+_init_lock = threading.Lock()
+
+
+def current_table(name):
+    """The app's shared table `name` (see TABLES), or None if there's no
+    SHARED_STATE_PATH."""
+
+    if not has_app_context():
+        return None
+
+    base = current_app.config.get('SHARED_STATE_PATH')
+    if not base:
+        return None
+
+    app = current_app._get_current_object()
+    tables = app.extensions.setdefault('shared', {})
+    table = tables.get(name)
+
+    # A table opened before a fork has the parent's locks; open it afresh
+    if table is None or table.pid != os.getpid():
+        with _init_lock:
+            table = tables.get(name)
+            if table is None or table.pid != os.getpid():
+                table = SharedTable(f'{base}.{name}', TABLES[name])
+                tables[name] = table
+
+    return table
+
+
+def counters(prefix):
+    """Counters under `prefix`: shared if there's SHARED_STATE_PATH, else
+    this process's own."""
+
+    table = current_table('stats')
+    if table is None:
+        return LocalCounters()
+    return Counters(table, prefix)
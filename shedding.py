@@ -0,0 +1,366 @@
+"""Load shedding: adaptive concurrency limits per route class.
+
+When Postgres slows down, requests take longer, more of them are in flight
+at once, and without a limit a worker piles them up until nothing gets
+answered. Each route class (`read`, `write`, `auth`) instead has a limit
+on the requests a worker runs at once. A limit creeps up by about one per
+round of requests while they finish within the class's LATENCY_TARGET,
+and is cut by BACKOFF (at most once per target interval) when they don't,
+so it settles near what the database can currently take.
+
+Requests over the limit are shed:
+
+- Timelines and profiles (STALE_ENDPOINTS) are answered with the copy of
+  the page last served to the same user, if it is no older than
+  STALE_MAX_AGE, marked as stale with a `Warning: 110` header, an `Age`
+  header and a banner. The next request that gets through refreshes it.
+  Pages showing flashed messages aren't kept, so a one-off message
+  ("Hello, …!") isn't shown again.
+- Writes, logins and timelines with no copy to fall back on wait up to
+  QUEUE_WAIT seconds for a slot.
+- Everything else gets a fast 503 with Retry-After.
+
+Limits only bite when a worker runs requests concurrently (green or
+threaded workers); a sync worker runs one at a time anyway. Limits and
+copies are per worker. `/admin/shedding` shows them; set LOAD_SHEDDING to
+False to switch this off.
+
+For trying this out locally, FAULT_DB_LATENCY_MS adds that much delay to
+every database query (read per query, so tests can change it):
+
+    FAULT_DB_LATENCY_MS=300 flask run
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from flask import (Response, _request_ctx_stack, current_app, g, request,
+                   session)
+from sqlalchemy import event
+
+READ = 'read'
+WRITE = 'write'
+AUTH = 'auth'
+
+AUTH_ENDPOINTS = {'warbler.login', 'warbler.signup', 'warbler.logout'}
+
+# Pages worth serving stale when the site is overloaded
+STALE_ENDPOINTS = {'warbler.homepage', 'warbler.users_show',
+                   'warbler.tag_timeline', 'warbler.mentions_timeline'}
+
+# Served without limits: static files, fingerprinted assets, thumbnails
+UNLIMITED_BLUEPRINTS = {'assets', 'images'}
+
+# Downloads and bulk imports take as long as the data they carry; their
+# time says nothing about how the database is doing, so it doesn't move
+# the limit
+UNTIMED_ENDPOINTS = {'warbler.export_download', 'warbler.export_file',
+                     'warbler.import_follows', 'warbler.import_messages'}
+
+# Concurrency limits start at these, and stay between MIN_LIMIT and
+# MAX_LIMIT
+INITIAL_LIMITS = {READ: 20, WRITE: 10, AUTH: 4}
+MIN_LIMIT = 1
+MAX_LIMIT = 200
+
+# Seconds a request may take before its class is taken as overloaded
+# (logins hash passwords with bcrypt, so get longer)
+LATENCY_TARGETS = {READ: 0.5, WRITE: 1.0, AUTH: 2.0}
+
+BACKOFF = 0.9
+
+# Longest a critical request waits for a slot before it's shed (seconds)
+QUEUE_WAIT = 1.0
+
+RETRY_AFTER = 1
+
+# Oldest copy of a page served as stale (seconds), and how much each
+# worker keeps
+STALE_MAX_AGE = 600
+STALE_MAX_BYTES = 32 * 1024 * 1024
+
+STALE_BANNER = (b'<div class="alert alert-warning text-center mb-0" '
+                b'id="stale-banner">Warbler is busy right now. This is a copy '
+                b'of the page from %d seconds ago.</div>')
+
+BODY_TAG = re.compile(rb'<body[^>]*>')
+
+
+class AdaptiveLimit:
+    """Concurrency limit for one route class, adjusted by latency (AIMD)."""
+
+    def __init__(self, initial, target, min_limit=MIN_LIMIT,
+                 max_limit=MAX_LIMIT, clock=time.monotonic):
+        self.limit = float(initial)
+        self.target = target
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.clock = clock
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._backed_off_at = None
+        self._slots = threading.Condition()
+
+    def acquire(self, wait=0):
+        """Take a slot, waiting up to `wait` seconds; whether one was got."""
+
+        deadline = self.clock() + wait
+
+        with self._slots:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    return False
+                self._slots.wait(remaining)
+
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def reject(self):
+        """Count a request shed for want of a slot."""
+
+        with self._slots:
+            self.rejected += 1
+
+    def release(self, latency, failed=False):
+        """Give a slot back, with how long its request took (None to leave
+        the limit as it is)."""
+
+        with self._slots:
+            busy = self.in_flight >= self.limit / 2
+            self.in_flight -= 1
+
+            if latency is None:
+                pass
+            elif failed or latency > self.target:
+                now = self.clock()
+                if (self._backed_off_at is None
+                        or now - self._backed_off_at >= self.target):
+                    self.limit = max(self.min_limit, self.limit * BACKOFF)
+                    self._backed_off_at = now
+            elif busy:
+                # Only grow while the limit is actually being used
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self._slots.notify()
+
+    def stats(self):
+        return {'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'admitted': self.admitted,
+                'rejected': self.rejected}
+
+
+class StaleStore:
+    """The last copy of pages served, by (user id, path), as an LRU capped
+    by total size."""
+
+    def __init__(self, max_bytes=STALE_MAX_BYTES, max_age=STALE_MAX_AGE,
+                 clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.clock = clock
+        self.size = 0
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, key, body, mimetype):
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+
+            self._pages[key] = (self.clock(), body, mimetype)
+            self.size += len(body)
+
+            while self.size > self.max_bytes and self._pages:
+                _, (_, dropped, _) = self._pages.popitem(last=False)
+                self.size -= len(dropped)
+
+    def get(self, key):
+        """(age in seconds, body, mimetype), or None if none recent enough."""
+
+        with self._lock:
+            page = self._pages.get(key)
+            if page is None:
+                return None
+            stored_at, body, mimetype = page
+            age = self.clock() - stored_at
+            if age > self.max_age:
+                return None
+            return age, body, mimetype
+
+    def stats(self):
+        return {'pages': len(self._pages), 'bytes': self.size}
+
+
+class Shedder:
+    """A worker's limits, stale copies and shedding counts."""
+
+    def __init__(self, limits=None, stale=None):
+        self.limits = limits or {
+            name: AdaptiveLimit(INITIAL_LIMITS[name], LATENCY_TARGETS[name])
+            for name in INITIAL_LIMITS}
+        self.stale = stale or StaleStore()
+        self.stale_served = 0
+        self.shed = 0
+
+    def stats(self):
+        return {'limits': {name: limit.stats()
+                           for name, limit in self.limits.items()},
+                'stale_pages': self.stale.stats(),
+                'stale_served': self.stale_served,
+                'shed': self.shed}
+
+
+def route_class():
+    """READ, WRITE or AUTH for this request; None if it isn't limited."""
+
+    if (request.endpoint in (None, 'static')
+            or request.blueprint in UNLIMITED_BLUEPRINTS):
+        return None
+    if request.endpoint in AUTH_ENDPOINTS:
+        return AUTH
+    if request.method in ('GET', 'HEAD'):
+        return READ
+    return WRITE
+
+
+def _stale_key():
+    from app import CURR_USER_KEY
+    return (session.get(CURR_USER_KEY), request.full_path)
+
+
+def _stale_response(shedder):
+    page = shedder.stale.get(_stale_key())
+    if page is None:
+        return None
+
+    age, body, mimetype = page
+    body = BODY_TAG.sub(lambda tag: tag.group(0) + STALE_BANNER % age,
+                        body, count=1)
+    shedder.stale_served += 1
+    return Response(body, mimetype=mimetype,
+                    headers={'Warning': '110 - "Response is Stale"',
+                             'Age': str(int(age))})
+
+
+def _unavailable(shedder):
+    shedder.shed += 1
+    return Response("Warbler is busy right now; please try again shortly.",
+                    status=503, mimetype='text/plain',
+                    headers={'Retry-After': str(RETRY_AFTER)})
+
+
+def admit():
+    """Take a slot for this request, or answer it without one."""
+
+    shedder = current_app.extensions['shedding']
+    if not current_app.config.get('LOAD_SHEDDING', True):
+        return None
+
+    name = route_class()
+    if name is None:
+        return None
+
+    limit = shedder.limits[name]
+    critical = name != READ or request.endpoint in STALE_ENDPOINTS
+
+    if limit.acquire():
+        g.shed_slot = (limit, time.perf_counter())
+        return None
+
+    if request.endpoint in STALE_ENDPOINTS:
+        stale = _stale_response(shedder)
+        if stale is not None:
+            limit.reject()
+            return stale
+
+    if critical and limit.acquire(QUEUE_WAIT):
+        g.shed_slot = (limit, time.perf_counter())
+        return None
+
+    limit.reject()
+    return _unavailable(shedder)
+
+
+def _shows_flashes():
+    """Whether this page shows flashed messages: already rendered, or still
+    waiting in the session for a streamed template."""
+
+    return bool(getattr(_request_ctx_stack.top, 'flashes', None)
+                or session.get('_flashes'))
+
+
+def keep_copy(response):
+    """Keep timelines and profiles to serve stale when overloaded."""
+
+    if (request.endpoint not in STALE_ENDPOINTS or request.method != 'GET'
+            or response.status_code != 200 or 'shed_slot' not in g
+            or _shows_flashes()):
+        return response
+
+    store = current_app.extensions['shedding'].stale
+    key = _stale_key()
+    mimetype = response.mimetype
+
+    if not response.is_streamed:
+        store.put(key, response.get_data(), mimetype)
+        return response
+
+    # Streamed pages are kept once they've been sent in full
+    charset = response.charset
+
+    def copying(chunks):
+        sent = []
+        for chunk in chunks:
+            sent.append(chunk.encode(charset) if isinstance(chunk, str)
+                        else chunk)
+            yield chunk
+        store.put(key, b''.join(sent), mimetype)
+
+    response.response = copying(response.response)
+    return response
+
+
+def release(exc=None):
+    """Give this request's slot back (after streaming, if it streamed)."""
+
+    slot = g.pop('shed_slot', None)
+    if slot is not None:
+        limit, start = slot
+        latency = None
+        if request.endpoint not in UNTIMED_ENDPOINTS:
+            latency = time.perf_counter() - start
+        limit.release(latency, failed=exc is not None)
+
+
+def inject_latency(app):
+    """Delay every query by FAULT_DB_LATENCY_MS (read at each query)."""
+
+    from models import db
+
+    def delay(*args):
+        latency_ms = app.config.get('FAULT_DB_LATENCY_MS') or 0
+        if latency_ms:
+            # Patched to yield under gevent, like a real network wait
+            time.sleep(latency_ms / 1000)
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', delay)
+
+
+def init_app(app):
+    """Register limits on `app`; call before other request hooks."""
+
+    app.extensions['shedding'] = Shedder()
+    app.before_request(admit)
+    app.after_request(keep_copy)
+    app.teardown_request(release)
+
+    if app.config.get('FAULT_DB_LATENCY_MS') is not None:
+        inject_latency(app)
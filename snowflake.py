@@ -0,0 +1,242 @@
+"""Time-ordered 64-bit ids, made up by each process without coordination.
+
+An id is
+
+    41 bits  milliseconds since EPOCH  (good until 2084)
+    10 bits  worker id
+    12 bits  sequence within the millisecond
+
+so sorting ids sorts by creation time, and each process can hand out 4096
+ids per millisecond without talking to the database or to other workers.
+
+Worker ids are split in two halves. Ids made now use the lower half
+(0..MAX_SLOT); ids made for the past by `id_at()` (imports) use the upper
+half (BACKFILL_BASE + slot). Backfilled ids are numbered from a sequence
+of their own, which can't run into the ids handed out for that
+millisecond when it was current.
+
+Each process's slot comes from the SNOWFLAKE_WORKER_ID environment
+variable if set. Otherwise, on Postgres, it leases the lowest free slot by
+taking an advisory lock on it, held on a connection of its own for the
+life of the process, so no two live processes, on any host, share one.
+If the connection drops, the lock goes with it and another process may
+take the slot; ids are primary keys, so a clash then fails an insert
+rather than going unnoticed. Without Postgres (or with every slot taken)
+the slot is derived from the host name and process id, which only
+usually keeps workers apart.
+
+If the clock steps backwards, ids keep counting up from the last one
+handed out rather than going back in time.
+"""
+
+import logging
+import os
+import random
+import socket
+import threading
+import zlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+EPOCH = datetime(2015, 1, 1)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+TIME_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+# Worker ids from here up are for ids made by id_at()
+BACKFILL_BASE = 1 << (WORKER_BITS - 1)
+MAX_SLOT = BACKFILL_BASE - 1
+
+# Key space of the advisory locks leasing slots ('SNOW')
+LEASE_SPACE = 0x534E4F57
+
+# Ids handed out before snowflakes were 32-bit serials, all below this
+FIRST_ID = 1 << 31
+
+
+def _millis(when):
+    return int((when - EPOCH) / timedelta(milliseconds=1))
+
+
+def default_worker_id():
+    """This process's slot when none is leased."""
+
+    if os.environ.get('SNOWFLAKE_WORKER_ID'):
+        return int(os.environ['SNOWFLAKE_WORKER_ID']) & MAX_SLOT
+
+    host = zlib.crc32(socket.gethostname().encode())
+    return (host ^ os.getpid()) & MAX_SLOT
+
+
+class WorkerLease:
+    """A slot held with a Postgres advisory lock, on a connection of its own
+    that stays open until `release()`."""
+
+    def __init__(self, engine, slots=MAX_SLOT + 1):
+        self.worker_id = None
+
+        # Out of the pool, and outside any transaction, so it can sit idle
+        # for the life of the process
+        conn = engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT')
+        conn.detach()
+
+        for slot in range(slots):
+            if conn.execute(text("SELECT pg_try_advisory_lock(:space, "
+                                 ":slot)"),
+                            space=LEASE_SPACE, slot=slot).scalar():
+                self.worker_id = slot
+                self.conn = conn
+                return
+
+        conn.close()
+
+    def release(self):
+        if self.worker_id is not None:
+            self.conn.close()
+            self.worker_id = None
+
+
+def lease_worker_id():
+    """A WorkerLease for this process, or None without Postgres, outside
+    an app, or with every slot taken."""
+
+    from models import db
+
+    try:
+        engine = db.engine
+    except RuntimeError:
+        return None
+
+    if engine.dialect.name != 'postgresql':
+        return None
+
+    lease = WorkerLease(engine)
+    if lease.worker_id is None:
+        logging.getLogger(__name__).warning(
+            "Every snowflake worker id is leased; using a derived one")
+        return None
+    return lease
+
+
+class IdGenerator:
+    """Hands out increasing ids for one worker; safe across threads."""
+
+    def __init__(self, worker_id=None, clock=datetime.utcnow):
+        self.worker_id = (default_worker_id() if worker_id is None
+                          else worker_id & MAX_SLOT)
+        self.clock = clock
+        self._millis = -1
+        self._sequence = 0
+        # Started anywhere, so a process that reuses a slot is unlikely to
+        # repeat an earlier one's ids for the same past millisecond
+        self._backfill_sequence = random.getrandbits(SEQUENCE_BITS)
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        """A new id, greater than any this generator made before."""
+
+        with self._lock:
+            millis = _millis(self.clock())
+
+            if millis > self._millis:
+                self._millis = millis
+                self._sequence = 0
+            else:
+                # Same millisecond, or the clock went back: keep counting,
+                # moving on to the next millisecond if the sequence is used up
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    self._millis += 1
+                    self._sequence = 0
+
+            return ((self._millis << TIME_SHIFT) |
+                    (self.worker_id << SEQUENCE_BITS) |
+                    self._sequence)
+
+    def id_at(self, when):
+        """An id for something created at `when`, e.g. imported data.
+
+        From the backfill half of the worker ids. Unique among this
+        process's ids unless it makes more than 4096 for the same
+        millisecond.
+        """
+
+        if when < EPOCH:
+            raise ValueError(f"Can't make an id for before {EPOCH}")
+
+        with self._lock:
+            self._backfill_sequence = ((self._backfill_sequence + 1) &
+                                       MAX_SEQUENCE)
+            return ((_millis(when) << TIME_SHIFT) |
+                    ((BACKFILL_BASE | self.worker_id) << SEQUENCE_BITS) |
+                    self._backfill_sequence)
+
+
+def time_of(snowflake_id):
+    """When `snowflake_id` was made (UTC, to the millisecond)."""
+
+    return EPOCH + timedelta(milliseconds=snowflake_id >> TIME_SHIFT)
+
+
+def first_id_at(when):
+    """Smallest id that can have been made at or after `when`."""
+
+    return max(_millis(when), 0) << TIME_SHIFT
+
+
+def is_snowflake(value):
+    """Was `value` made here, rather than being a legacy serial id?"""
+
+    return value is not None and value >= FIRST_ID
+
+
+_generator = None
+_generator_pid = None
+_lease = None
+_init_lock = threading.Lock()
+
+# Leases a forked process inherited: the parent's, so never closed here
+# (that would end the parent's session), nor garbage collected
+_inherited = []
+
+
+def generator():
+    """This process's generator, made afresh (with its own lease) after a
+    fork."""
+
+    global _generator, _generator_pid, _lease
+
+    if _generator_pid != os.getpid():
+        with _init_lock:
+            if _generator_pid != os.getpid():
+                if _lease is not None:
+                    _inherited.append(_lease)
+
+                _lease = None
+                if not os.environ.get('SNOWFLAKE_WORKER_ID'):
+                    _lease = lease_worker_id()
+
+                _generator = IdGenerator(
+                    _lease.worker_id if _lease is not None else None)
+                _generator_pid = os.getpid()
+
+    return _generator
+
+
+def next_id():
+    """A new id from this process's generator."""
+
+    return generator().next_id()
+
+
+def id_at(when):
+    """An id for something created at `when`."""
+
+    return generator().id_at(when)
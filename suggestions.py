@@ -0,0 +1,218 @@
+""""Who to follow" suggestions computed from the follows graph.
+
+Suggestions are built in batch with sparse matrix products, then stored in
+the `suggestions` table so serving them is a single indexed lookup.
+
+With A the adjacency matrix (A[u, v] = 1 if u follows v):
+
+- A @ A counts friends-of-friends paths u -> w -> v
+- A.T @ A counts common followers (people who follow both u and v)
+
+A user's score for v is a weighted sum of the two; people they already
+follow, and they themselves, are left out. Only the top `TOP_K` are kept.
+
+Run `flask suggestions refresh` periodically (e.g. from cron): it rebuilds
+suggestions only for users whose follow set changed since the last run
+(`--all` rebuilds everyone). The same work is registered as the
+`refresh_stale_suggestions` job queue task, but nothing enqueues it on its
+own; the schedule is up to whoever runs the app.
+"""
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy.dialects.postgresql import insert
+
+from jobs import task
+from models import db, User, FollowersFollowee, Suggestion, SuggestionRefresh
+
+TOP_K = 10
+
+FRIEND_OF_FRIEND_WEIGHT = 1.0
+COMMON_FOLLOWER_WEIGHT = 0.5
+
+# Rows scored per sparse product, to bound memory on big graphs
+CHUNK_SIZE = 1000
+
+
+def load_graph():
+    """Return (ids, A): sorted user ids and their CSR adjacency matrix.
+
+    Row/column i of A is user ids[i]; A[i, j] = 1 if ids[i] follows ids[j].
+    """
+
+    import numpy as np
+    from scipy.sparse import csr_matrix
+
+    ids = np.array([user_id for (user_id,) in
+                    db.session.query(User.id)
+                    .filter(User.deleted_at.is_(None))
+                    .order_by(User.id)],
+                   dtype=np.int64)
+
+    # Deleted accounts' follows linger until purged; leave them out
+    deleted = db.session.query(User.id).filter(User.deleted_at.isnot(None))
+    edges = np.array(db.session.query(FollowersFollowee.follower_id,
+                                      FollowersFollowee.followee_id)
+                     .filter(~FollowersFollowee.follower_id.in_(deleted),
+                             ~FollowersFollowee.followee_id.in_(deleted))
+                     .all(),
+                     dtype=np.int64).reshape(-1, 2)
+
+    rows = np.searchsorted(ids, edges[:, 0])
+    cols = np.searchsorted(ids, edges[:, 1])
+    data = np.ones(len(edges), dtype=np.float32)
+
+    return ids, csr_matrix((data, (rows, cols)), shape=(len(ids), len(ids)))
+
+
+def score_rows(A, AT, rows):
+    """Sparse suggestion scores for users at matrix indices `rows`."""
+
+    return (FRIEND_OF_FRIEND_WEIGHT * (A[rows] @ A) +
+            COMMON_FOLLOWER_WEIGHT * (AT[rows] @ A)).tocsr()
+
+
+def top_k(scores, A, rows, k=TOP_K):
+    """Yield (row, [(col, score), ...]) best first, for each scored row.
+
+    Self and already-followed columns are excluded.
+    """
+
+    import numpy as np
+
+    for i, row in enumerate(rows):
+        start, end = scores.indptr[i], scores.indptr[i + 1]
+        cols = scores.indices[start:end]
+        vals = scores.data[start:end]
+
+        followed = A.indices[A.indptr[row]:A.indptr[row + 1]]
+        keep = (cols != row) & ~np.isin(cols, followed) & (vals > 0)
+        cols, vals = cols[keep], vals[keep]
+
+        if len(cols) > k:
+            best = np.argpartition(-vals, k)[:k]
+            cols, vals = cols[best], vals[best]
+
+        # Highest score first; ties go to the older account
+        order = np.lexsort((cols, -vals))
+        yield row, list(zip(cols[order].tolist(), vals[order].tolist()))
+
+
+def refresh(user_ids=None):
+    """Rebuild stored suggestions for `user_ids` (all users if None).
+
+    Returns number of users refreshed.
+    """
+
+    import numpy as np
+
+    ids, A = load_graph()
+    AT = A.T.tocsr()
+
+    if user_ids is None:
+        rows = np.arange(len(ids))
+    else:
+        wanted = np.array(sorted(user_ids), dtype=np.int64)
+        rows = np.searchsorted(ids, wanted)
+        # Drop users deleted since they were marked
+        in_range = rows < len(ids)
+        rows = rows[in_range][ids[rows[in_range]] == wanted[in_range]]
+
+    for start in range(0, len(rows), CHUNK_SIZE):
+        chunk = rows[start:start + CHUNK_SIZE]
+        chunk_ids = ids[chunk].tolist()
+
+        mappings = [
+            dict(user_id=int(ids[row]), suggested_id=int(ids[col]),
+                 rank=rank, score=score)
+            for row, best in top_k(score_rows(A, AT, chunk), A, chunk)
+            for rank, (col, score) in enumerate(best)
+        ]
+
+        (Suggestion
+         .query
+         .filter(Suggestion.user_id.in_(chunk_ids))
+         .delete(synchronize_session=False))
+        db.session.bulk_insert_mappings(Suggestion, mappings)
+        db.session.commit()
+
+    return len(rows)
+
+
+def mark_stale(user_id):
+    """Note that `user_id`'s follows changed; caller commits.
+
+    A single INSERT that ignores an existing mark, so two follows by the
+    same user at once don't race to create it.
+    """
+
+    db.session.execute(
+        insert(SuggestionRefresh.__table__)
+        .values(user_id=user_id)
+        .on_conflict_do_nothing())
+
+
+@task
+def refresh_stale_suggestions():
+    """Take the stale marks, then rebuild suggestions for those users.
+
+    Marks are deleted as they're read, so a follow made while the rebuild
+    runs leaves a new mark for the next run. If the rebuild fails, the
+    marks are put back.
+    """
+
+    table = SuggestionRefresh.__table__
+    user_ids = [user_id for (user_id,) in db.session.execute(
+        table.delete().returning(table.c.user_id))]
+
+    if not user_ids:
+        db.session.commit()
+        return 0
+
+    try:
+        count = refresh(user_ids)
+    except Exception:
+        db.session.rollback()
+        for user_id in user_ids:
+            mark_stale(user_id)
+        db.session.commit()
+        raise
+
+    # refresh() commits as it goes, but not if no one was left to rebuild
+    db.session.commit()
+    return count
+
+
+def for_user(user_id, limit=5):
+    """Suggested users for `user_id`, best first."""
+
+    return (User
+            .query
+            .join(Suggestion, Suggestion.suggested_id == User.id)
+            .filter(Suggestion.user_id == user_id,
+                    User.deleted_at.is_(None))
+            .order_by(Suggestion.rank)
+            .limit(limit)
+            .all())
+
+
+@click.group('suggestions')
+def suggestions_cli():
+    """Manage "who to follow" suggestions."""
+
+
+@suggestions_cli.command('refresh')
+@click.option('--all', 'everyone', is_flag=True,
+              help='Rebuild for every user, not just stale ones.')
+@with_appcontext
+def refresh_command(everyone):
+    """Rebuild suggestions (run periodically, e.g. from cron)."""
+
+    if everyone:
+        count = refresh()
+        SuggestionRefresh.query.delete()
+        db.session.commit()
+    else:
+        count = refresh_stale_suggestions()
+
+    click.echo(f"Refreshed suggestions for {count} user(s)")
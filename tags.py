@@ -0,0 +1,231 @@
+"""Hashtag and @mention index.
+
+When a message is posted its #tags are written to `message_tags` and the
+users it @mentions to `mentions`. Both tables are keyed (tag or user,
+message id), so a tag or mentions timeline is one backwards range scan of
+the primary key, and paging carries on from the last message id seen
+(`before`) instead of using OFFSET.
+
+Messages posted before the index existed are indexed with:
+
+    flask tags backfill --processes 4
+"""
+
+import re
+from multiprocessing import Pool
+
+import click
+from flask import current_app, url_for
+from flask.cli import with_appcontext
+from jinja2 import Markup, escape
+from sqlalchemy import func
+
+from models import db, User, Message, MessageTag, Mention
+
+TAG_RE = re.compile(r'(?<![\w&#])#(\w{1,50})')
+MENTION_RE = re.compile(r'(?<![\w@])@(\w{1,50})')
+
+PAGE_SIZE = 50
+
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def parse(text):
+    """(tags, usernames) used in `text`; tags are lowercased."""
+
+    tags = {tag.lower() for tag in TAG_RE.findall(text)}
+    usernames = set(MENTION_RE.findall(text))
+    return tags, usernames
+
+
+def index_rows(messages):
+    """MessageTag and Mention rows for (id, text) pairs in `messages`.
+
+    Usernames for the whole batch are looked up in one query.
+    """
+
+    parsed = [(message_id, parse(text)) for message_id, text in messages]
+
+    usernames = set().union(*(names for _, (_, names) in parsed))
+    user_ids = {}
+    if usernames:
+        user_ids = dict(db.session
+                        .query(User.username, User.id)
+                        .filter(User.username.in_(usernames),
+                                User.deleted_at.is_(None)))
+
+    tag_rows = [{'tag': tag, 'message_id': message_id}
+                for message_id, (tags, _) in parsed
+                for tag in tags]
+    mention_rows = [{'user_id': user_ids[name], 'message_id': message_id}
+                    for message_id, (_, names) in parsed
+                    for name in names if name in user_ids]
+
+    return tag_rows, mention_rows
+
+
+def index_message(message):
+    """Index a new message's tags and mentions; caller commits.
+
+    The message must have its id, i.e. be flushed.
+    """
+
+    tag_rows, mention_rows = index_rows([(message.id, message.text)])
+    db.session.bulk_insert_mappings(MessageTag, tag_rows)
+    db.session.bulk_insert_mappings(Mention, mention_rows)
+
+
+def _page(query, key, before, limit):
+    if before is not None:
+        query = query.filter(key < before)
+    return query.order_by(key.desc()).limit(limit).all()
+
+
+def tagged(tag, before=None, limit=PAGE_SIZE):
+    """Newest messages tagged `tag`, older than message `before` if given."""
+
+    query = (Message
+             .visible()
+             .join(MessageTag, MessageTag.message_id == Message.id)
+             .filter(MessageTag.tag == tag.lower()))
+
+    return _page(query, MessageTag.message_id, before, limit)
+
+
+def mentioning(user_id, before=None, limit=PAGE_SIZE):
+    """Newest messages mentioning `user_id`, older than `before` if given."""
+
+    query = (Message
+             .visible()
+             .join(Mention, Mention.message_id == Message.id)
+             .filter(Mention.user_id == user_id))
+
+    return _page(query, Mention.message_id, before, limit)
+
+
+def linkify(text):
+    """Message text as HTML, with #tags and @mentions linked."""
+
+    def tag_link(match):
+        url = url_for('warbler.tag_timeline', tag=match.group(1).lower())
+        return f'<a href="{url}">#{match.group(1)}</a>'
+
+    def mention_link(match):
+        url = url_for('warbler.list_users', q=match.group(1))
+        return f'<a href="{url}">@{match.group(1)}</a>'
+
+    html = str(escape(text))
+    html = TAG_RE.sub(tag_link, html)
+    html = MENTION_RE.sub(mention_link, html)
+    return Markup(html)
+
+
+def init_app(app):
+    app.add_template_filter(linkify)
+    app.cli.add_command(tags_cli)
+
+
+##############################################################################
+# Backfill
+
+
+def chunk_bounds(chunk_size=BACKFILL_CHUNK_SIZE):
+    """First message id of each run of `chunk_size` messages, in order."""
+
+    numbered = db.session.query(
+        Message.id,
+        (func.row_number().over(order_by=Message.id) - 1).label('n')
+    ).subquery()
+
+    return [message_id for (message_id,) in
+            db.session.query(numbered.c.id)
+            .filter(numbered.c.n % chunk_size == 0)
+            .order_by(numbered.c.id)]
+
+
+def backfill_range(low, high=None):
+    """(Re)index messages with ids from `low` up to, not including, `high`.
+
+    Replaces whatever index rows those messages had, so running it twice
+    is harmless. Returns number of messages indexed.
+    """
+
+    query = db.session.query(Message.id, Message.text).filter(
+        Message.id >= low)
+    if high is not None:
+        query = query.filter(Message.id < high)
+
+    messages = query.all()
+    if not messages:
+        return 0
+
+    message_ids = [message_id for message_id, _ in messages]
+    tag_rows, mention_rows = index_rows(messages)
+
+    (MessageTag
+     .query
+     .filter(MessageTag.message_id.in_(message_ids))
+     .delete(synchronize_session=False))
+    (Mention
+     .query
+     .filter(Mention.message_id.in_(message_ids))
+     .delete(synchronize_session=False))
+
+    db.session.bulk_insert_mappings(MessageTag, tag_rows)
+    db.session.bulk_insert_mappings(Mention, mention_rows)
+    db.session.commit()
+
+    return len(messages)
+
+
+_worker_context = None
+
+
+def _init_worker(app):
+    """Pool initializer: each worker process works in its own app context."""
+
+    global _worker_context
+    _worker_context = app.app_context()
+    _worker_context.push()
+
+
+def _backfill_chunk(bounds):
+    return backfill_range(*bounds)
+
+
+def backfill(processes=1, chunk_size=BACKFILL_CHUNK_SIZE):
+    """Index every message, `chunk_size` at a time across `processes`.
+
+    Returns number of messages indexed.
+    """
+
+    starts = chunk_bounds(chunk_size)
+    chunks = list(zip(starts, starts[1:] + [None]))
+
+    if processes == 1 or len(chunks) < 2:
+        return sum(backfill_range(low, high) for low, high in chunks)
+
+    app = current_app._get_current_object()
+
+    # Each child needs its own connections, not ones inherited from us
+    db.session.remove()
+    db.engine.dispose()
+
+    with Pool(processes, _init_worker, (app,)) as pool:
+        return sum(pool.imap_unordered(_backfill_chunk, chunks))
+
+
+@click.group('tags')
+def tags_cli():
+    """Manage the hashtag and mention index."""
+
+
+@tags_cli.command('backfill')
+@click.option('--processes', default=1, help='Number of worker processes.')
+@click.option('--chunk-size', default=BACKFILL_CHUNK_SIZE)
+@with_appcontext
+def backfill_command(processes, chunk_size):
+    """Index tags and mentions of every existing message."""
+
+    count = backfill(processes, chunk_size)
+    click.echo(f"Indexed {count} message(s)")
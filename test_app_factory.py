@@ -0,0 +1,94 @@
+"""Application factory tests."""
+
+# run these tests like:
+#
+# python -m unittest test_app_factory.py
+
+
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+import app as app_module
+from app import create_app
+
+# Cumulative time to `import app` (microseconds, from `python -X importtime`).
+# Importing must not build an app or pull in optional extensions.
+IMPORT_TIME_BUDGET_US = 600000
+
+# Feature modules only create_app() imports
+FEATURES = ['caching', 'deletion', 'exports', 'hotkeys', 'imports', 'jobs',
+            'partitions', 'schema', 'shedding', 'suggestions', 'tags',
+            'timelines', 'trending']
+
+
+def import_times(module):
+    """Return {module name: cumulative import microseconds} for `module`."""
+
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stderr=subprocess.PIPE,
+        check=True)
+
+    times = {}
+    for line in result.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+
+    return times
+
+
+class AppFactoryTestCase(TestCase):
+    """Test create_app and lazy imports."""
+
+    def test_create_app_config(self):
+        """Config passed to the factory overrides defaults."""
+
+        test_app = create_app({'TESTING': True, 'SECRET_KEY': 'abc'})
+
+        self.assertTrue(test_app.config['TESTING'])
+        self.assertEqual(test_app.config['SECRET_KEY'], 'abc')
+        self.assertIn('warbler', test_app.blueprints)
+        self.assertIn('jobs', test_app.cli.commands)
+
+    def test_apps_are_isolated(self):
+        """Each call builds a separate app."""
+
+        app1 = create_app({'WTF_CSRF_ENABLED': False})
+        app2 = create_app()
+
+        self.assertIsNot(app1, app2)
+        self.assertNotIn('WTF_CSRF_ENABLED', app2.config)
+
+    def test_lazy_default_app(self):
+        """`app.app` is built on first access and then reused."""
+
+        self.assertIs(app_module.app, app_module.app)
+
+    def test_import_time_budget(self):
+        """Importing app is cheap and skips disabled extensions."""
+
+        times = import_times('app')
+
+        self.assertNotIn('flask_debugtoolbar', times)
+        for name in FEATURES:
+            self.assertNotIn(name, times)
+        self.assertLess(times['app'], IMPORT_TIME_BUDGET_US)
+
+    def test_pool_size_from_environment(self):
+        """DB_POOL_SIZE (set by green.py) sizes the connection pool."""
+
+        os.environ['DB_POOL_SIZE'] = '25'
+        try:
+            test_app = create_app()
+        finally:
+            del os.environ['DB_POOL_SIZE']
+
+        self.assertEqual(test_app.config['SQLALCHEMY_POOL_SIZE'], 25)
+        self.assertIsNone(create_app().config.get('SQLALCHEMY_POOL_SIZE'))
@@ -0,0 +1,154 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+# python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+import assets
+from app import create_app
+
+
+class AssetBuildTestCase(TestCase):
+    """Test fingerprinting and precompression."""
+
+    def setUp(self):
+        """Make a small static dir to build from."""
+
+        self.source = tempfile.mkdtemp()
+        self.build_dir = os.path.join(self.source, 'dist')
+
+        os.makedirs(os.path.join(self.source, 'images'))
+        with open(os.path.join(self.source, 'images', 'logo.png'), 'wb') as f:
+            f.write(b'\x89PNG fake image')
+        with open(os.path.join(self.source, 'site.css'), 'w') as f:
+            f.write("body { background: url('/static/images/logo.png'); }")
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+
+    def test_build_manifest(self):
+        """Every file gets a content-hashed name in the manifest."""
+
+        manifest = assets.build(self.source, self.build_dir)
+
+        self.assertEqual(set(manifest), {'images/logo.png', 'site.css'})
+        self.assertRegex(manifest['site.css'], r'^site\.[0-9a-f]{12}\.css$')
+        self.assertEqual(assets.load_manifest(self.build_dir), manifest)
+
+        # Rebuilding unchanged files gives the same names
+        self.assertEqual(assets.build(self.source, self.build_dir), manifest)
+
+    def test_hash_changes_with_content(self):
+        """Editing a file changes its fingerprinted name."""
+
+        before = assets.build(self.source, self.build_dir)
+
+        with open(os.path.join(self.source, 'images', 'logo.png'), 'ab') as f:
+            f.write(b'more')
+
+        after = assets.build(self.source, self.build_dir)
+
+        self.assertNotEqual(before['images/logo.png'],
+                            after['images/logo.png'])
+        # CSS references the new image, so its hash changes too
+        self.assertNotEqual(before['site.css'], after['site.css'])
+
+    def test_css_urls_and_precompression(self):
+        """CSS points at hashed images and gets a gzip variant; images don't."""
+
+        manifest = assets.build(self.source, self.build_dir)
+        css_path = os.path.join(self.build_dir, manifest['site.css'])
+
+        with gzip.open(css_path + '.gz') as f:
+            css = f.read().decode()
+
+        self.assertIn(f"url('/assets/{manifest['images/logo.png']}')", css)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.build_dir, manifest['images/logo.png']) + '.gz'))
+
+    def test_relative_css_urls(self):
+        """URLs relative to a stylesheet still work from /assets/."""
+
+        os.makedirs(os.path.join(self.source, 'stylesheets'))
+        with open(os.path.join(self.source, 'stylesheets', 'page.css'),
+                  'w') as f:
+            f.write("#hero { background: url('../images/logo.png'); }\n"
+                    ".gone { background: url(../images/gone.png); }\n"
+                    ".icon { background: url(data:image/png;base64,AAAA); }")
+
+        manifest = assets.build(self.source, self.build_dir)
+        with open(os.path.join(self.build_dir,
+                               manifest['stylesheets/page.css'])) as f:
+            css = f.read()
+
+        self.assertIn(f"url('/assets/{manifest['images/logo.png']}')", css)
+        self.assertIn("url(/static/images/gone.png)", css)
+        self.assertIn("url(data:image/png;base64,AAAA)", css)
+
+
+class AssetServingTestCase(TestCase):
+    """Test serving fingerprinted assets."""
+
+    def setUp(self):
+        """Build assets into a temp dir and point an app at it."""
+
+        self.build_dir = tempfile.mkdtemp()
+        self.app = create_app({'ASSETS_BUILD_DIR': self.build_dir})
+        self.manifest = assets.build(self.app.static_folder, self.build_dir)
+        self.app.extensions['assets'] = self.manifest
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.build_dir)
+
+    def test_asset_url(self):
+        """asset_url uses the manifest, falling back to plain static URLs."""
+
+        with self.app.test_request_context():
+            self.assertEqual(
+                assets.asset_url('stylesheets/style.css'),
+                '/assets/' + self.manifest['stylesheets/style.css'])
+            self.assertEqual(assets.asset_url('nope.css'), '/static/nope.css')
+
+    def test_serve_immutable_gzip(self):
+        """Hashed assets are long-cached and served precompressed."""
+
+        url = '/assets/' + self.manifest['stylesheets/style.css']
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Cache-Control'],
+                         assets.IMMUTABLE_CACHE_CONTROL)
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn(b'body', gzip.decompress(resp.data))
+        resp.close()
+
+        plain = self.client.get(url)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        plain.close()
+
+    def test_pages_link_hashed_assets(self):
+        """Rendered pages link the fingerprinted stylesheet."""
+
+        resp = self.client.get('/login')
+
+        self.assertIn(self.manifest['stylesheets/style.css'].encode(),
+                      resp.data)
+        # The page itself still isn't cached
+        self.assertIn('max-age=0', resp.headers['Cache-Control'])
+
+    def test_missing_asset(self):
+        """Unknown assets are a 404."""
+
+        resp = self.client.get('/assets/not-there.css')
+        self.assertEqual(resp.status_code, 404)
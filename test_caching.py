@@ -0,0 +1,412 @@
+"""Query cache tests."""
+
+# run these tests like:
+#
+# python -m unittest test_caching.py
+
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import caching
+import shared
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class CacheTestCase(TestCase):
+    """Test regions, versions and expiry on the in-process backend."""
+
+    def setUp(self):
+        self.cache = caching.Cache(caching.MemoryBackend(),
+                                   ttls={'short': 0.05})
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return {'loaded': self.loads}
+
+    def test_hit_until_bumped(self):
+        """Entries are reused until their entity's version changes."""
+
+        first = self.cache.get('users', 1, ('user', 1), self.load)
+        again = self.cache.get('users', 1, ('user', 1), self.load)
+        self.assertEqual(first, again)
+        self.assertEqual(self.loads, 1)
+
+        # Other entities are untouched
+        self.cache.get('users', 2, ('user', 2), self.load)
+        self.cache.bump(('user', 2))
+        self.cache.get('users', 1, ('user', 1), self.load)
+        self.assertEqual(self.loads, 2)
+
+        self.cache.bump(('user', 1))
+        after = self.cache.get('users', 1, ('user', 1), self.load)
+        self.assertEqual(after, {'loaded': 3})
+
+        self.assertEqual(self.cache.stats()['users'],
+                         {'hits': 2, 'misses': 3, 'coalesced': 0})
+
+    def test_region_ttl(self):
+        """Entries expire after their region's TTL."""
+
+        self.cache.get('short', 'k', ('thing', 1), self.load)
+        self.cache.get('short', 'k', ('thing', 1), self.load)
+        self.assertEqual(self.loads, 1)
+
+        time.sleep(0.1)
+        self.cache.get('short', 'k', ('thing', 1), self.load)
+        self.assertEqual(self.loads, 2)
+
+    def test_values_are_copies(self):
+        """Changing a returned value doesn't change what's cached."""
+
+        self.cache.get('likes', 1, ('likes', 1), lambda: [1, 2])
+        hit = self.cache.get('likes', 1, ('likes', 1), lambda: [])
+        hit.append(3)
+
+        self.assertEqual(self.cache.get('likes', 1, ('likes', 1),
+                                        lambda: []), [1, 2])
+
+    def test_lru_eviction(self):
+        """Losing a version to eviction only costs a miss."""
+
+        cache = caching.Cache(caching.MemoryBackend(max_entries=4))
+        cache.get('users', 1, ('user', 1), self.load)
+        for n in range(2, 5):
+            cache.get('users', n, ('user', n), self.load)
+
+        cache.get('users', 1, ('user', 1), self.load)
+        self.assertEqual(self.loads, 5)
+
+
+class SharedVersionsTestCase(TestCase):
+    """Test that workers with their own entries share versions."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.loads = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def load(self):
+        self.loads += 1
+        return {'loaded': self.loads}
+
+    def worker(self):
+        table = shared.SharedTable(os.path.join(self.dir, 'versions'),
+                                   slots=64, stripes=4)
+        backend = caching.MemoryBackend(
+            versions=caching.SharedVersions(table))
+        return caching.Cache(backend, shared_versions=True)
+
+    def test_bump_reaches_other_workers(self):
+        one, two = self.worker(), self.worker()
+
+        one.get('users', 1, ('user', 1), self.load)
+        two.get('users', 1, ('user', 1), self.load)
+        self.assertEqual(two.get('users', 1, ('user', 1), self.load),
+                         {'loaded': 2})
+
+        one.bump(('user', 1))
+        self.assertEqual(two.get('users', 1, ('user', 1), self.load),
+                         {'loaded': 3})
+
+    def test_lost_version_is_new(self):
+        """A version dropped from the table doesn't come back."""
+
+        cache = self.worker()
+        before = cache.version(('user', 1))
+        cache.backend.shared_versions.table.delete('v:user:1')
+
+        self.assertNotEqual(cache.version(('user', 1)), before)
+
+
+class CoalescingTestCase(TestCase):
+    """Test that concurrent misses share one load."""
+
+    def setUp(self):
+        self.loads = 0
+        self.started = threading.Event()
+
+    def slow_load(self):
+        self.loads += 1
+        self.started.set()
+        time.sleep(0.2)
+        return {'loaded': self.loads}
+
+    def run_together(self, calls):
+        results = [None] * len(calls)
+
+        def run(n):
+            try:
+                results[n] = calls[n]()
+            except Exception as e:
+                results[n] = e
+
+        threads = [threading.Thread(target=run, args=(n,))
+                   for n in range(len(calls))]
+        threads[0].start()
+        self.started.wait(1)
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_concurrent_misses_load_once(self):
+        cache = caching.Cache(caching.MemoryBackend())
+
+        results = self.run_together(
+            [lambda: cache.get('users', 1, ('user', 1), self.slow_load)] * 10)
+
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(results, [{'loaded': 1}] * 10)
+        self.assertEqual(cache.stats()['users']['coalesced'], 9)
+
+        # Waiters get copies of their own
+        self.assertIsNot(results[0], results[1])
+
+    def test_errors_are_shared(self):
+        cache = caching.Cache(caching.MemoryBackend())
+
+        def failing_load():
+            self.slow_load()
+            raise RuntimeError("DB went away")
+
+        results = self.run_together(
+            [lambda: cache.get('users', 1, ('user', 1), failing_load)] * 3)
+
+        self.assertEqual(self.loads, 1)
+        self.assertTrue(all(isinstance(result, RuntimeError)
+                            for result in results))
+
+        # Nothing is left waiting; the next miss loads afresh
+        self.assertEqual(cache.get('users', 1, ('user', 1),
+                                   lambda: 'ok'), 'ok')
+
+    def test_across_workers(self):
+        """Caches sharing a backend coalesce through advisory locks."""
+
+        backend = caching.MemoryBackend()
+        workers = [caching.Cache(backend, locks=caching.AdvisoryLocks())
+                   for _ in range(3)]
+
+        def in_worker(cache):
+            def call():
+                with app.app_context():
+                    return cache.get('users', 1, ('user', 1),
+                                     self.slow_load)
+            return call
+
+        results = self.run_together([in_worker(cache) for cache in workers])
+
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(results, [{'loaded': 1}] * 3)
+
+    def test_lock_wait_gives_up(self):
+        """A worker stuck behind a lock too long loads for itself."""
+
+        locks = caching.AdvisoryLocks(wait_ms=50)
+
+        with app.app_context():
+            with locks.hold('busy') as first:
+                with locks.hold('busy') as second:
+                    self.assertTrue(first)
+                    self.assertFalse(second)
+
+
+class CachedRoutesTestCase(TestCase):
+    """Test that pages use the cache and write routes invalidate it."""
+
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+        app.extensions.pop('query_cache', None)
+        # Tests run in one process, where per-process cache versions are
+        # enough
+        app.config['QUERY_CACHE'] = True
+
+        alice = User(username="alice", email="alice@test.com",
+                     password="HASHED_PASSWORD")
+        bob = User(username="bob", email="bob@test.com",
+                   password="HASHED_PASSWORD")
+        carol = User(username="carol", email="carol@test.com",
+                     password="HASHED_PASSWORD")
+        db.session.add_all([alice, bob, carol])
+        db.session.commit()
+        self.alice_id = alice.id
+        self.bob_id = bob.id
+        self.carol_id = carol.id
+
+        db.session.add(FollowersFollowee(follower_id=self.carol_id,
+                                         followee_id=self.bob_id))
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.alice_id
+
+    def tearDown(self):
+        db.session.rollback()
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+        app.extensions.pop('query_cache', None)
+        app.config.pop('QUERY_CACHE', None)
+
+    def count_queries(self, url):
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        with app.app_context():
+            engine = db.engine
+
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            html = self.client.get(url).get_data(as_text=True)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+
+        return html, statements
+
+    def test_repeat_visit_skips_queries(self):
+        """A second visit answers users and follow lists from the cache."""
+
+        url = f"/users/{self.bob_id}/followers"
+        html, first = self.count_queries(url)
+        self.assertIn("@carol", html)
+
+        html, second = self.count_queries(url)
+        self.assertIn("@carol", html)
+        self.assertLess(len(second), len(first))
+        self.assertFalse([sql for sql in second
+                          if 'FROM follows' in sql and 'count' not in sql])
+
+    def test_follow_invalidates(self):
+        """Following shows up straight away on both users' pages."""
+
+        self.client.get(f"/users/{self.bob_id}/followers")
+        self.client.get(f"/users/{self.alice_id}/following")
+
+        self.client.post(f"/users/follow/{self.bob_id}")
+
+        html = self.client.get(
+            f"/users/{self.bob_id}/followers").get_data(as_text=True)
+        self.assertIn("@alice", html)
+        html = self.client.get(
+            f"/users/{self.alice_id}/following").get_data(as_text=True)
+        self.assertIn("@bob", html)
+
+        self.client.post(f"/users/stop-following/{self.bob_id}")
+
+        html = self.client.get(
+            f"/users/{self.bob_id}/followers").get_data(as_text=True)
+        self.assertNotIn("@alice", html)
+
+    def test_users_cached_without_password(self):
+        with app.test_request_context():
+            caching.user(self.bob_id)
+            cache = caching.current_cache()
+            self.assertNotIn(b"HASHED_PASSWORD",
+                             b"".join(value for _, value in
+                                      cache.backend._data.values()
+                                      if isinstance(value, bytes)))
+
+            db.session.expunge_all()
+            self.assertEqual(caching.user(self.bob_id).password,
+                             "HASHED_PASSWORD")
+
+    def test_forget_user(self):
+        """A renamed user is shown by their new name once forgotten."""
+
+        self.client.get(f"/users/{self.bob_id}/followers")
+
+        # Edits made behind the cache's back wait for the TTL
+        User.query.filter_by(id=self.carol_id).update({'username': 'caz'})
+        db.session.commit()
+        html = self.client.get(
+            f"/users/{self.bob_id}/followers").get_data(as_text=True)
+        self.assertIn("@carol", html)
+
+        with app.test_request_context():
+            caching.forget_user(self.carol_id)
+        html = self.client.get(
+            f"/users/{self.bob_id}/followers").get_data(as_text=True)
+        self.assertIn("@caz", html)
+
+    def test_likes_invalidate(self):
+        """A new like shows up on the likes page straight away."""
+
+        msg = Message(text="likeable", user_id=self.bob_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        self.client.get(f"/users/{self.alice_id}")
+        self.client.post("/like/add", data={"message_id": msg_id})
+
+        html = self.client.get(
+            f"/users/{self.alice_id}/likes").get_data(as_text=True)
+        self.assertIn("likeable", html)
+
+    def test_switched_off(self):
+        """With QUERY_CACHE off, pages read straight from the DB."""
+
+        app.config['QUERY_CACHE'] = False
+        try:
+            self.client.get(f"/users/{self.bob_id}/followers")
+            db.session.add(FollowersFollowee(follower_id=self.alice_id,
+                                             followee_id=self.bob_id))
+            db.session.commit()
+            html = self.client.get(
+                f"/users/{self.bob_id}/followers").get_data(as_text=True)
+        finally:
+            app.config['QUERY_CACHE'] = True
+
+        self.assertIn("@alice", html)
+
+    def test_message_page(self):
+        """Message pages are cached until the message changes."""
+
+        msg = Message(text="hot take", user_id=self.bob_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        html, first = self.count_queries(f"/messages/{msg_id}")
+        html, second = self.count_queries(f"/messages/{msg_id}")
+        self.assertIn("hot take", html)
+        self.assertLess(len(second), len(first))
+
+        self.client.post(f"/messages/{msg_id}/reply",
+                         data={"text": "cold take"})
+        html = self.client.get(f"/messages/{msg_id}").get_data(as_text=True)
+        self.assertIn("cold take", html)
+        self.assertEqual(Message.query.get(msg_id).reply_count, 1)
+
+        self.client.post(f"/messages/{msg_id}/delete")
+        resp = self.client.get(f"/messages/{msg_id}")
+        self.assertEqual(resp.status_code, 404)
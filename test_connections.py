@@ -0,0 +1,154 @@
+"""Mutual connection tests."""
+
+# run these tests like:
+#
+# python -m unittest test_connections.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, create_app, CURR_USER_KEY
+import connections
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ConnectionsTestCase(TestCase):
+    """Test who-you-know info between a viewer and a profile."""
+
+    def setUp(self):
+        """viewer follows a, b, c and star; a, b and c follow star."""
+
+        User.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        Like.query.delete()
+        db.session.commit()
+        connections.clear_cache()
+
+        names = ['viewer', 'a', 'b', 'c', 'star', 'stranger']
+        self.users = {}
+        for name in names:
+            self.users[name] = User(username=name, email=f"{name}@test.com",
+                                    password="HASHED_PASSWORD")
+        db.session.add_all(self.users.values())
+        db.session.commit()
+        self.ids = {name: user.id for name, user in self.users.items()}
+
+        for follower, followee in [('viewer', 'a'), ('viewer', 'b'),
+                                   ('viewer', 'c'), ('viewer', 'star'),
+                                   ('a', 'star'), ('b', 'star'),
+                                   ('c', 'star'), ('star', 'viewer'),
+                                   ('stranger', 'star')]:
+            db.session.add(FollowersFollowee(follower_id=self.ids[follower],
+                                             followee_id=self.ids[followee]))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+        connections.clear_cache()
+
+    def lookup(self, viewer, profile):
+        return connections.for_profile(User.query.get(self.ids[viewer]),
+                                       User.query.get(self.ids[profile]))
+
+    def test_followed_by_people_you_follow(self):
+        """Lists up to SHOWN accounts in common, plus the total."""
+
+        result = self.lookup('viewer', 'star')
+
+        self.assertEqual(result.total, 3)
+        self.assertEqual([name for _, name in result.followed_by],
+                         ['a', 'b', 'c'])
+        self.assertTrue(result.mutual)
+
+    def test_one_way(self):
+        """Follows you, but you don't follow back; or no link at all."""
+
+        result = self.lookup('a', 'viewer')
+
+        self.assertFalse(result.you_follow)
+        self.assertTrue(result.follows_you)
+        self.assertFalse(result.mutual)
+
+        result = self.lookup('stranger', 'a')
+
+        self.assertFalse(result.you_follow)
+        self.assertFalse(result.follows_you)
+        self.assertEqual(result.total, 0)
+        self.assertEqual(result.followed_by, [])
+
+    def test_self_and_anonymous(self):
+        """Nothing to show for your own profile or when logged out."""
+
+        viewer = User.query.get(self.ids['viewer'])
+
+        self.assertIsNone(connections.for_profile(viewer, viewer))
+        self.assertIsNone(connections.for_profile(None, viewer))
+
+    def test_same_answer_from_graph_index(self):
+        """The in-memory graph path agrees with the DB path."""
+
+        from_db = self.lookup('viewer', 'star')
+        connections.clear_cache()
+
+        graph_app = create_app({'GRAPH_INDEX': True})
+        with graph_app.app_context():
+            from_graph = self.lookup('viewer', 'star')
+
+        self.assertEqual(from_graph, from_db)
+
+    def test_cache_cleared_by_follow(self):
+        """Following someone updates your view of them straight away."""
+
+        self.assertFalse(self.lookup('stranger', 'viewer').you_follow)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids['stranger']
+
+            c.post(f"/users/follow/{self.ids['viewer']}")
+            resp = c.get(f"/users/{self.ids['viewer']}")
+
+        self.assertTrue(self.lookup('stranger', 'viewer').you_follow)
+        self.assertIn(b'Unfollow', resp.data)
+
+    def test_profile_page(self):
+        """Profile shows mutual badge and followed-by names."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids['viewer']
+
+            resp = c.get(f"/users/{self.ids['star']}")
+
+        self.assertIn(b'You follow each other', resp.data)
+        self.assertIn(b'@a</a>', resp.data)
+
+    def test_button_not_cached(self):
+        """A follow made through another worker shows on the next view."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids['stranger']
+
+            self.assertIn(b'>Follow<', c.get(f"/users/{self.ids['a']}").data)
+
+            # Straight to the DB, so this worker's cache isn't told
+            db.session.add(FollowersFollowee(follower_id=self.ids['stranger'],
+                                             followee_id=self.ids['a']))
+            db.session.commit()
+
+            resp = c.get(f"/users/{self.ids['a']}")
+
+        self.assertIn(b'>Unfollow<', resp.data)
@@ -0,0 +1,196 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+# python -m unittest test_deletion.py
+
+
+import os
+from unittest import TestCase
+
+from models import (db, User, Message, FollowersFollowee, Like, Job,
+                    AccountPurge)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import deletion
+import jobs
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class DeletionTestCase(TestCase):
+    """Test tombstoning an account and purging it in batches."""
+
+    def setUp(self):
+        """gone posts 5 messages liked by fan; gone and fan follow each
+        other; gone likes one of fan's messages."""
+
+        Job.query.delete()
+        AccountPurge.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        gone = User(username="gone", email="gone@test.com",
+                    password="HASHED_PASSWORD")
+        fan = User(username="fan", email="fan@test.com",
+                   password="HASHED_PASSWORD")
+        db.session.add_all([gone, fan])
+        db.session.commit()
+        self.gone_id = gone.id
+        self.fan_id = fan.id
+
+        messages = [Message(text=f"warble {n}", user_id=self.gone_id)
+                    for n in range(5)]
+        fan_message = Message(text="fan warble", user_id=self.fan_id)
+        db.session.add_all(messages + [fan_message])
+        db.session.commit()
+        self.message_ids = [msg.id for msg in messages]
+        self.fan_message_id = fan_message.id
+
+        db.session.add_all(
+            [Like(user_id=self.fan_id, message_id=message_id)
+             for message_id in self.message_ids] +
+            [Like(user_id=self.gone_id, message_id=self.fan_message_id),
+             FollowersFollowee(follower_id=self.gone_id,
+                               followee_id=self.fan_id),
+             FollowersFollowee(follower_id=self.fan_id,
+                               followee_id=self.gone_id)])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        Job.query.delete()
+        AccountPurge.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def delete_account(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.gone_id
+
+        return self.client.post("/users/delete")
+
+    def test_delete_hides_account(self):
+        """The account vanishes from pages before anything is purged."""
+
+        resp = self.delete_account()
+        self.assertEqual(resp.status_code, 302)
+
+        # Nothing purged yet, just tombstoned and queued
+        self.assertEqual(Message.query.filter_by(user_id=self.gone_id)
+                         .count(), 5)
+        self.assertEqual(Job.query.filter_by(name='purge_account').count(), 1)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.fan_id
+
+        self.assertEqual(
+            self.client.get(f"/users/{self.gone_id}").status_code, 404)
+        self.assertEqual(
+            self.client.get(f"/messages/{self.message_ids[0]}").status_code,
+            404)
+
+        html = self.client.get(f"/users/{self.fan_id}/followers").get_data(
+            as_text=True)
+        self.assertNotIn("@gone", html)
+
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertNotIn("warble 0", html)
+
+        fan = User.query.get(self.fan_id)
+        self.assertEqual(fan.following.count(), 0)
+        self.assertEqual(fan.followers.count(), 0)
+
+    def test_deleted_user_cannot_log_in(self):
+        """Login and existing sessions stop working at once."""
+
+        self.delete_account()
+
+        self.assertFalse(User.authenticate("gone", "HASHED_PASSWORD"))
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.gone_id
+
+        resp = self.client.get("/")
+        self.assertIn("Sign up now", resp.get_data(as_text=True))
+
+    def test_purge_in_batches(self):
+        """Small batches walk through every stage and record progress."""
+
+        self.delete_account()
+
+        steps = 0
+        while deletion.purge_step(self.gone_id, batch_size=2):
+            steps += 1
+
+        purge = AccountPurge.query.get(self.gone_id)
+        self.assertEqual(purge.stage, deletion.DONE)
+        self.assertEqual(purge.messages, 5)
+        self.assertEqual(purge.likes, 6)
+        self.assertEqual(purge.follows, 2)
+        self.assertIsNotNone(purge.finished_at)
+        self.assertGreater(steps, len(deletion.STAGES))
+
+        self.assertIsNone(User.query.get(self.gone_id))
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(FollowersFollowee.query.count(), 0)
+
+    def test_purge_resumes(self):
+        """A purge stopped part way carries on from its recorded stage."""
+
+        self.delete_account()
+
+        deletion.purge_step(self.gone_id, batch_size=1)
+        deletion.purge_step(self.gone_id, batch_size=1)
+        db.session.expire_all()
+
+        self.assertEqual(AccountPurge.query.get(self.gone_id).stage,
+                         'followers')
+
+        deletion.purge_account(self.gone_id, max_batches=3)
+
+        # Ran out of batches: the job queued a follow-up for itself
+        db.session.commit()
+        self.assertEqual(Job.query.filter_by(name='purge_account').count(), 2)
+
+        jobs.work(burst=True)
+
+        self.assertEqual(AccountPurge.query.get(self.gone_id).stage,
+                         deletion.DONE)
+        self.assertIsNone(User.query.get(self.gone_id))
+        self.assertEqual(Job.query.filter_by(status='failed').count(), 0)
+
+    def test_purge_updates_reply_counts(self):
+        """Purged replies stop counting towards other users' threads."""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.gone_id
+
+        self.client.post(f"/messages/{self.fan_message_id}/reply",
+                         data={"text": "a reply"})
+        reply_id = Message.query.filter_by(text="a reply").one().id
+        self.client.post(f"/messages/{reply_id}/reply",
+                         data={"text": "a reply to it"})
+        self.assertEqual(Message.query.get(self.fan_message_id).reply_count,
+                         2)
+
+        self.delete_account()
+        while deletion.purge_step(self.gone_id, batch_size=2):
+            pass
+
+        db.session.expire_all()
+        self.assertEqual(Message.query.get(self.fan_message_id).reply_count,
+                         0)
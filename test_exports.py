@@ -0,0 +1,298 @@
+"""Account data export tests."""
+
+# run these tests like:
+#
+# python -m unittest test_exports.py
+
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import (db, User, Message, FollowersFollowee, Like, Job,
+                    DataExport)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import exports
+import jobs
+import shedding
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExportTestCase(TestCase):
+    """Test streamed downloads, export files and the CLI."""
+
+    def setUp(self):
+        """alice posts 3 messages and likes bob's; alice and bob follow
+        each other; alice also likes a message of a deleted account."""
+
+        Job.query.delete()
+        DataExport.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        alice = User(username="alice", email="alice@test.com",
+                     password="HASHED_PASSWORD", bio="Alice's bio")
+        bob = User(username="bob", email="bob@test.com",
+                   password="HASHED_PASSWORD")
+        gone = User(username="gone", email="gone@test.com",
+                    password="HASHED_PASSWORD",
+                    deleted_at=datetime.utcnow())
+        db.session.add_all([alice, bob, gone])
+        db.session.commit()
+        self.alice_id = alice.id
+        self.bob_id = bob.id
+
+        bob_message = Message(text="bob's warble", user_id=self.bob_id)
+        ghost = Message(text="ghost", user_id=gone.id)
+        db.session.add_all([Message(text=f"warble {n}", user_id=self.alice_id)
+                            for n in range(3)] + [bob_message, ghost])
+        db.session.commit()
+
+        db.session.add_all([
+            Like(user_id=self.alice_id, message_id=bob_message.id),
+            Like(user_id=self.alice_id, message_id=ghost.id),
+            FollowersFollowee(follower_id=self.alice_id,
+                              followee_id=self.bob_id),
+            FollowersFollowee(follower_id=self.bob_id,
+                              followee_id=self.alice_id),
+        ])
+        db.session.commit()
+
+        self.dir = tempfile.mkdtemp()
+        app.config['EXPORT_DIR'] = self.dir
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.alice_id
+
+    def tearDown(self):
+        db.session.rollback()
+        Job.query.delete()
+        DataExport.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+        app.config['EXPORT_DIR'] = None
+        app.config.pop('EXPORT_STREAM_MAX_ROWS', None)
+        shutil.rmtree(self.dir)
+
+    def check_records(self, records):
+        by_type = {}
+        for record in records:
+            by_type.setdefault(record.pop('type'), []).append(record)
+
+        [profile] = by_type['profile']
+        self.assertEqual(profile['username'], "alice")
+        self.assertEqual(profile['bio'], "Alice's bio")
+        self.assertNotIn('password', profile)
+
+        self.assertEqual([msg['text'] for msg in by_type['message']],
+                         ["warble 0", "warble 1", "warble 2"])
+        self.assertEqual([(like['author'], like['text'])
+                          for like in by_type['like']],
+                         [("bob", "bob's warble")])
+        self.assertEqual(by_type['follower'],
+                         [{'id': self.bob_id, 'username': "bob"}])
+        self.assertEqual(by_type['following'],
+                         [{'id': self.bob_id, 'username': "bob"}])
+
+    def test_server_side_cursor(self):
+        query = exports._query(User.id)
+        self.assertTrue(query._execution_options['stream_results'])
+
+    def test_download_ndjson(self):
+        resp = self.client.get("/users/export/download?format=ndjson")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertIn('filename="warbler-alice.ndjson"',
+                      resp.headers['Content-Disposition'])
+
+        lines = resp.get_data(as_text=True).splitlines()
+        self.check_records(json.loads(line) for line in lines)
+
+    def test_download_zip(self):
+        resp = self.client.get("/users/export/download?format=zip")
+        archive = zipfile.ZipFile(io.BytesIO(resp.get_data()))
+
+        self.assertEqual(archive.namelist(),
+                         ['profile.json', 'messages.ndjson', 'likes.ndjson',
+                          'followers.ndjson', 'following.ndjson'])
+        self.assertIsNone(archive.testzip())
+
+        records = [dict(type='profile',
+                        **json.loads(archive.read('profile.json')))]
+        for kind, name, _, _ in exports.SECTIONS:
+            for line in archive.read(name).splitlines():
+                records.append(dict(type=kind, **json.loads(line)))
+        self.check_records(records)
+
+    def test_big_accounts_use_files(self):
+        app.config['EXPORT_STREAM_MAX_ROWS'] = 3
+
+        resp = self.client.get("/users/export/download?format=zip")
+        self.assertEqual(resp.status_code, 302)
+
+        html = self.client.get("/users/export").get_data(as_text=True)
+        self.assertIn("too big to download directly", html)
+
+    def test_page_doesnt_count(self):
+        """The export page itself runs no COUNT queries."""
+
+        statements = []
+
+        def record(*args):
+            statements.append(args[2])
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            resp = self.client.get("/users/export")
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse([sql for sql in statements if 'count(' in sql.lower()])
+
+    def test_export_file_gone(self):
+        export = DataExport(user_id=self.alice_id, format='zip',
+                            status=exports.DONE, filename='gone.zip',
+                            finished_at=datetime.utcnow())
+        db.session.add(export)
+        db.session.commit()
+
+        resp = self.client.get(f"/users/export/{export.id}")
+        self.assertEqual(resp.status_code, 302)
+
+        html = self.client.get("/users/export").get_data(as_text=True)
+        self.assertIn("That export file is gone", html)
+
+    def test_export_file(self):
+        """A queued export is written by a job and downloaded by its owner
+        only."""
+
+        resp = self.client.post("/users/export", data={'format': 'ndjson'})
+        self.assertEqual(resp.status_code, 302)
+        self.client.post("/users/export", data={'format': 'ndjson'})
+
+        export = DataExport.query.one()
+        self.assertEqual(export.status, exports.QUEUED)
+        export_id = export.id
+
+        with app.app_context():
+            jobs.work(burst=True)
+        db.session.expire_all()
+
+        export = DataExport.query.get(export_id)
+        self.assertEqual(export.status, exports.DONE)
+        self.assertEqual(export.rows, 6)
+        self.assertEqual(os.listdir(self.dir), [export.filename])
+
+        html = self.client.get("/users/export").get_data(as_text=True)
+        self.assertIn(f"/users/export/{export_id}", html)
+
+        resp = self.client.get(f"/users/export/{export_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.check_records(json.loads(line) for line in
+                           resp.get_data(as_text=True).splitlines())
+        resp.close()
+
+        other = app.test_client()
+        with other.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.bob_id
+        self.assertEqual(other.get(f"/users/export/{export_id}").status_code,
+                         404)
+
+    def test_failed_export_asked_again(self):
+        """An export whose job gave up is marked failed, and asking again
+        queues a new one."""
+
+        self.client.post("/users/export", data={'format': 'zip'})
+        Job.query.update({'max_attempts': 1})
+        db.session.commit()
+
+        # Somewhere the file can't be written
+        blocker = os.path.join(self.dir, 'blocker')
+        open(blocker, 'wb').close()
+        app.config['EXPORT_DIR'] = blocker
+
+        with app.app_context():
+            jobs.work(burst=True)
+        db.session.expire_all()
+
+        self.assertEqual(DataExport.query.one().status, exports.FAILED)
+        self.assertEqual(Job.query.one().status, 'failed')
+
+        self.client.post("/users/export", data={'format': 'zip'})
+
+        self.assertEqual(
+            [export.status for export in
+             DataExport.query.order_by(DataExport.id)],
+            [exports.FAILED, exports.QUEUED])
+
+    def test_prune(self):
+        export = DataExport(user_id=self.alice_id, format='zip',
+                            status=exports.DONE, filename='old.zip',
+                            finished_at=datetime.utcnow() - timedelta(days=8))
+        db.session.add(export)
+        db.session.commit()
+
+        old = time.time() - timedelta(days=8).total_seconds()
+        for name in ['old.zip', 'orphan.zip', 'new.zip']:
+            path = os.path.join(self.dir, name)
+            open(path, 'wb').close()
+            if name != 'new.zip':
+                os.utime(path, (old, old))
+
+        with app.app_context():
+            self.assertEqual(exports.prune(), 2)
+
+        self.assertEqual(os.listdir(self.dir), ['new.zip'])
+        self.assertEqual(DataExport.query.count(), 0)
+
+    def test_cli(self):
+        result = app.test_cli_runner().invoke(
+            args=['export', 'user', 'alice'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.check_records(json.loads(line)
+                           for line in result.output.splitlines())
+
+        path = os.path.join(self.dir, 'alice.zip')
+        result = app.test_cli_runner().invoke(
+            args=['export', 'user', 'alice', '--format', 'zip',
+                  '--output', path])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('messages.ndjson', zipfile.ZipFile(path).namelist())
+
+    def test_download_leaves_limit(self):
+        """Long downloads don't count as slow reads."""
+
+        limit = app.extensions['shedding'].limits[shedding.READ]
+        target, limit.target = limit.target, 0
+        before = limit.limit
+        try:
+            self.client.get("/users/export/download").get_data()
+        finally:
+            limit.target = target
+
+        self.assertEqual(limit.limit, before)
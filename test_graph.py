@@ -0,0 +1,193 @@
+"""Follow graph index tests."""
+
+# run these tests like:
+#
+# python -m unittest test_graph.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import create_app, CURR_USER_KEY
+import graph
+from graph import FollowGraph
+
+EDGES = [(1, 2), (1, 3), (2, 3), (4, 1), (3, 1)]
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the in-memory index on its own."""
+
+    def setUp(self):
+        self.graph = FollowGraph(EDGES)
+
+    def test_queries(self):
+        """Membership and neighbor lists in both directions."""
+
+        self.assertTrue(self.graph.is_following(1, 3))
+        self.assertFalse(self.graph.is_following(3, 2))
+        self.assertFalse(self.graph.is_following(99, 1))
+        self.assertEqual(self.graph.following(1), [2, 3])
+        self.assertEqual(self.graph.followers(1), [3, 4])
+        self.assertEqual(self.graph.followers(4), [])
+        self.assertEqual(self.graph.following(1000), [])
+
+    def test_incremental_updates(self):
+        """Follows and unfollows show up immediately."""
+
+        self.graph.add(2, 4)
+        self.graph.remove(1, 2)
+        self.graph.add(9, 1)
+
+        self.assertTrue(self.graph.is_following(2, 4))
+        self.assertFalse(self.graph.is_following(1, 2))
+        self.assertEqual(self.graph.following(1), [3])
+        self.assertEqual(self.graph.followers(1), [3, 4, 9])
+
+        # Undoing a pending change leaves the base as it was
+        self.graph.add(1, 2)
+        self.assertEqual(self.graph.following(1), [2, 3])
+
+    def test_compaction(self):
+        """Pending changes fold into the CSR arrays without changing answers."""
+
+        old_threshold = graph.COMPACT_THRESHOLD
+        graph.COMPACT_THRESHOLD = 3
+        try:
+            self.graph.add(2, 4)
+            self.graph.remove(1, 2)
+            self.graph.add(5, 2)
+        finally:
+            graph.COMPACT_THRESHOLD = old_threshold
+
+        self.assertEqual(self.graph._following.added, {})
+        self.assertEqual(self.graph.following(1), [3])
+        self.assertEqual(self.graph.followers(2), [5])
+        self.assertEqual(self.graph.following(2), [3, 4])
+
+    def test_changes_during_compaction(self):
+        """A follow made while the new arrays are built isn't lost."""
+
+        pairs = graph._Direction.pairs
+
+        def busy_pairs(direction):
+            # The lock isn't held while building, so this doesn't block
+            self.graph.add(6, 1)
+            graph._Direction.pairs = pairs
+            return pairs(direction)
+
+        old_threshold = graph.COMPACT_THRESHOLD
+        graph.COMPACT_THRESHOLD = 1
+        graph._Direction.pairs = busy_pairs
+        try:
+            self.graph.add(2, 4)
+        finally:
+            graph._Direction.pairs = pairs
+            graph.COMPACT_THRESHOLD = old_threshold
+
+        self.assertTrue(self.graph.is_following(2, 4))
+        self.assertTrue(self.graph.is_following(6, 1))
+        self.assertEqual(self.graph.followers(1), [3, 4, 6])
+        self.assertEqual(self.graph._following.added, {6: {1}})
+
+    def test_remove_user(self):
+        """Deleting a user drops their follows both ways."""
+
+        self.graph.remove_user(1)
+
+        self.assertEqual(self.graph.following(1), [])
+        self.assertEqual(self.graph.followers(1), [])
+        self.assertEqual(self.graph.following(3), [])
+
+    def test_reload_replays_changes(self):
+        """Changes made during a reload survive it."""
+
+        self.assertTrue(self.graph.start_reload())
+        self.assertFalse(self.graph.start_reload())
+
+        fresh = FollowGraph(EDGES)
+        self.graph.add(2, 4)
+        self.graph.replace_with(fresh)
+
+        self.assertTrue(self.graph.is_following(2, 4))
+
+    def test_memory_footprint(self):
+        """4 bytes per edge and per user id slot, in each direction."""
+
+        # following: ids 0..4 (+1 offset), 5 edges; followers: ids 0..3
+        self.assertEqual(self.graph.nbytes(), 4 * (6 + 5) + 4 * (5 + 5))
+
+
+class FollowGraphAppTestCase(TestCase):
+    """Test the index wired into the app."""
+
+    def setUp(self):
+        self.app = create_app({'GRAPH_INDEX': True, 'WTF_CSRF_ENABLED': False})
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+        User.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        Like.query.delete()
+
+        self.users = [User.signup(username=f"graphuser{i}",
+                                  email=f"graph{i}@test.com",
+                                  password="testpassword",
+                                  image_url=None)
+                      for i in range(3)]
+        db.session.commit()
+
+        db.session.add(FollowersFollowee(follower_id=self.users[0].id,
+                                         followee_id=self.users[1].id))
+        db.session.commit()
+
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+        self.ctx.pop()
+
+    def test_loaded_and_updated(self):
+        """Loaded from the DB on first use, then kept up to date by routes."""
+
+        u0, u1, u2 = [user.id for user in self.users]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u0
+
+            c.post(f"/users/follow/{u2}")
+            index = graph.current_graph()
+
+            self.assertEqual(index.following(u0), sorted([u1, u2]))
+
+            c.post(f"/users/stop-following/{u1}")
+            index = graph.current_graph()
+
+            self.assertEqual(index.following(u0), [u2])
+            self.assertTrue(User.query.get(u0).is_following(
+                User.query.get(u2)))
+
+    def test_follow_checks_not_stale(self):
+        """A follow another worker made shows up in follow checks before
+        the index is reloaded."""
+
+        u0, u1, u2 = self.users
+        index = graph.current_graph()
+
+        db.session.add(FollowersFollowee(follower_id=u2.id,
+                                         followee_id=u0.id))
+        db.session.commit()
+
+        self.assertFalse(index.is_following(u2.id, u0.id))
+        self.assertTrue(u2.is_following(u0))
+        self.assertTrue(u0.is_followed_by(u2))
@@ -0,0 +1,182 @@
+"""Hot-key tracking tests."""
+
+# run these tests like:
+#
+# python -m unittest test_hotkeys.py
+
+
+import os
+import random
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import caching
+import hotkeys
+
+db.create_all()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SketchTestCase(TestCase):
+    """Test the count-min sketch and top-K tracking."""
+
+    def test_never_undercounts(self):
+        sketch = hotkeys.CountMinSketch(width=64, depth=4)
+        counts = {}
+        for n in range(5000):
+            key = f"user:{n % 300}"
+            counts[key] = counts.get(key, 0) + 1
+            sketch.add(key)
+
+        for key, count in counts.items():
+            self.assertGreaterEqual(sketch.estimate(key), count)
+
+    def test_fixed_memory(self):
+        """Memory doesn't grow with the number of keys."""
+
+        tracker = hotkeys.HotKeys()
+        before = tracker.stats()['memory_bytes']
+
+        for n in range(20000):
+            tracker.record(f"message:{n}")
+
+        self.assertEqual(tracker.stats()['memory_bytes'], before)
+        self.assertLessEqual(tracker.stats()['tracked'], hotkeys.TOP_K)
+
+    def test_finds_heavy_hitters(self):
+        """Keys with most of the traffic make the top, in order."""
+
+        random.seed(0)
+        tracker = hotkeys.HotKeys(k=10)
+        for _ in range(20000):
+            if random.random() < 0.3:
+                tracker.record(random.choice(["user:1", "user:2",
+                                              "message:3"]))
+            else:
+                tracker.record(f"user:{random.randrange(100000)}")
+
+        top = [key for key, _ in tracker.hottest(3)]
+        self.assertEqual(sorted(top), ["message:3", "user:1", "user:2"])
+        self.assertTrue(tracker.is_hot("user:1"))
+        self.assertFalse(tracker.is_hot("user:99999"))
+
+    def test_decay(self):
+        """Keys that stop getting traffic cool off."""
+
+        clock = FakeClock()
+        tracker = hotkeys.HotKeys(decay_interval=60, threshold=10,
+                                  clock=clock)
+        for _ in range(16):
+            tracker.record("user:1")
+        self.assertTrue(tracker.is_hot("user:1"))
+
+        clock.now += 60
+        tracker.record("user:2")
+        self.assertEqual(dict(tracker.hottest())["user:1"], 8)
+        self.assertFalse(tracker.is_hot("user:1"))
+
+
+class HotPagesTestCase(TestCase):
+    """Test the request hook, admin endpoint and cache promotion."""
+
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+        app.extensions.pop('hotkeys', None)
+        app.extensions.pop('query_cache', None)
+        # Tests run in one process, where per-process cache versions are
+        # enough
+        app.config['QUERY_CACHE'] = True
+
+        admin = User(username="admin", email="admin@test.com",
+                     password="HASHED_PASSWORD")
+        star = User(username="star", email="star@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add_all([admin, star])
+        db.session.commit()
+        self.admin_id = admin.id
+        self.star_id = star.id
+
+        app.config['ADMIN_USERS'] = ['admin']
+        app.config['HOT_KEY_THRESHOLD'] = 3
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        app.config['ADMIN_USERS'] = []
+        del app.config['HOT_KEY_THRESHOLD']
+        app.extensions.pop('hotkeys', None)
+        app.extensions.pop('query_cache', None)
+        app.config.pop('QUERY_CACHE', None)
+
+    def test_pages_are_counted(self):
+        for _ in range(3):
+            self.client.get(f"/users/{self.star_id}")
+        self.client.get(f"/users/{self.star_id}/followers")
+        self.client.get("/tags/Python")
+
+        with app.app_context():
+            counts = dict(hotkeys.current_tracker().hottest())
+
+        self.assertEqual(counts[f"user:{self.star_id}"], 4)
+        self.assertEqual(counts["tag:python"], 1)
+
+    def test_admin_endpoint(self):
+        for _ in range(3):
+            self.client.get(f"/users/{self.star_id}")
+
+        resp = self.client.get("/admin/hot-keys")
+        self.assertEqual(resp.status_code, 401)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.admin_id
+        data = self.client.get("/admin/hot-keys").get_json()
+
+        self.assertEqual(data['hot_keys'][0],
+                         {'key': f"user:{self.star_id}", 'count': 3,
+                          'hot': True})
+        self.assertIn('users', data['cache'])
+        self.assertGreater(data['tracker']['memory_bytes'], 0)
+
+    def test_hot_entries_cached_longer(self):
+        with app.app_context():
+            self.assertEqual(
+                hotkeys.cache_ttl_factor('users', self.star_id), 1)
+
+        for _ in range(3):
+            self.client.get(f"/users/{self.star_id}")
+
+        with app.app_context():
+            self.assertEqual(
+                hotkeys.cache_ttl_factor('users', self.star_id),
+                hotkeys.HOT_TTL_FACTOR)
+            self.assertEqual(
+                hotkeys.cache_ttl_factor('follows', self.star_id), 1)
+
+    def test_not_stretched_without_shared_versions(self):
+        """A cache whose versions are per worker keeps the usual TTLs."""
+
+        for _ in range(3):
+            self.client.get(f"/users/{self.star_id}")
+
+        with app.app_context():
+            cache = caching.current_cache()
+            self.assertFalse(cache.shared_versions)
+            self.assertEqual(cache.ttl_factor('users', self.star_id), 1)
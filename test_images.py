@@ -0,0 +1,242 @@
+"""Image thumbnail proxy tests."""
+
+# run these tests like:
+#
+# python -m unittest test_images.py
+
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import TestCase
+
+from PIL import Image
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+import images
+from app import create_app
+
+
+def make_png(width, height):
+    """Bytes of a solid-color PNG."""
+
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 30, 30)).save(out, 'PNG')
+    return out.getvalue()
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """Local stand-in for an external image host."""
+
+    files = {}
+    hits = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+
+        if self.path.startswith('/hop?to='):
+            self.send_response(302)
+            self.send_header('Location', self.path[len('/hop?to='):])
+            self.end_headers()
+            return
+
+        data = self.files.get(self.path)
+
+        if data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageProxyTestCase(TestCase):
+    """Test fetching, resizing, caching and serving thumbnails."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), OriginHandler)
+        cls.origin = f"http://127.0.0.1:{cls.server.server_port}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        """Fresh cache dir and origin hit log for each test."""
+
+        OriginHandler.files = {'/big.png': make_png(1280, 800),
+                               '/twin.png': make_png(1280, 800),
+                               '/junk.png': b'not an image'}
+        OriginHandler.hits = []
+        images._failures.clear()
+
+        self.cache_dir = tempfile.mkdtemp()
+        # The stand-in origin is on loopback, which is otherwise refused
+        self.app = create_app({'IMAGE_CACHE_DIR': self.cache_dir,
+                               'IMAGE_FETCH_ALLOW_HOSTS': {'127.0.0.1'}})
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def thumb(self, url, size):
+        with self.app.test_request_context():
+            return images.thumb_url(url, size)
+
+    def test_local_urls_untouched(self):
+        """Static images are not proxied."""
+
+        self.assertEqual(self.thumb('/static/images/default-pic.png', 'avatar'),
+                         '/static/images/default-pic.png')
+        self.assertIsNone(self.thumb(None, 'avatar'))
+
+    def test_resize_and_cache(self):
+        """First request fetches once and renders; later ones hit disk."""
+
+        url = self.thumb(self.origin + '/big.png', 'avatar')
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/jpeg')
+        self.assertEqual(resp.headers['Cache-Control'], images.CACHE_CONTROL)
+        self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (200, 200))
+        etag = resp.headers['ETag']
+        resp.close()
+
+        # Other sizes were rendered from the same fetch
+        header = self.client.get(self.thumb(self.origin + '/big.png', 'header'))
+        self.assertEqual(Image.open(io.BytesIO(header.data)).size, (512, 320))
+        header.close()
+
+        self.assertEqual(OriginHandler.hits, ['/big.png'])
+
+        # Conditional requests are answered without a body
+        again = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(again.status_code, 304)
+
+    def test_content_addressed(self):
+        """Identical images from different URLs share one blob."""
+
+        for path in ('/big.png', '/twin.png'):
+            self.client.get(self.thumb(self.origin + path, 'avatar')).close()
+
+        blobs = os.listdir(os.path.join(self.cache_dir, 'blobs'))
+        self.assertEqual(len(blobs), len(images.SIZES))
+
+    def test_bad_signature(self):
+        """Unsigned URLs are refused, so this isn't an open proxy."""
+
+        resp = self.client.get('/images/avatar',
+                               query_string={'url': self.origin + '/big.png',
+                                             'sig': 'forged'})
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(OriginHandler.hits, [])
+
+    def test_internal_addresses_refused(self):
+        """Only public addresses are fetched, including after redirects."""
+
+        for url in ('http://localhost/big.png',
+                    'http://169.254.169.254/latest/meta-data/',
+                    'http://10.0.0.1/big.png',
+                    'http://[::1]/big.png',
+                    'file:///etc/passwd'):
+            with self.assertRaises(ValueError):
+                images.check_url(url)
+
+        port = self.server.server_port
+        hop = f"{self.origin}/hop?to=http://localhost:{port}/big.png"
+        resp = self.client.get(self.thumb(hop, 'avatar'))
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, hop)
+        self.assertEqual(OriginHandler.hits, ['/hop?to=http://localhost:'
+                                              f'{port}/big.png'])
+
+    def test_rebinding_refused(self):
+        """The address connected to is checked too, not just the one the
+        name resolved to first."""
+
+        port = self.server.server_port
+        answers = ['93.184.216.34', '127.0.0.1']
+        getaddrinfo = images.socket.getaddrinfo
+
+        def rebinding(host, *args, **kwargs):
+            return getaddrinfo(answers.pop(0) if answers else '127.0.0.1',
+                               *args, **kwargs)
+
+        images.socket.getaddrinfo = rebinding
+        try:
+            with self.assertRaises(ValueError):
+                images.fetch(f"http://rebind.example:{port}/big.png", 5,
+                             1024 * 1024)
+        finally:
+            images.socket.getaddrinfo = getaddrinfo
+
+        self.assertEqual(OriginHandler.hits, [])
+
+    def test_broken_origin_redirects(self):
+        """Undecodable images fall back to the original URL, and aren't
+        fetched again for a while."""
+
+        url = self.thumb(self.origin + '/junk.png', 'avatar')
+
+        for _ in range(2):
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, self.origin + '/junk.png')
+
+        self.assertEqual(OriginHandler.hits, ['/junk.png'])
+
+    def test_lru_eviction(self):
+        """Least recently used blobs go first once over the size limit."""
+
+        cache = images.ImageCache(os.path.join(self.cache_dir, 'lru'), 25)
+        cache.put('a', 'avatar', b'a' * 10)
+        cache.put('b', 'avatar', b'b' * 10)
+
+        # Make 'a' the older one, then use it so 'b' becomes the LRU
+        for i, key in enumerate(('a', 'b')):
+            path, _ = cache.get(key, 'avatar')
+            os.utime(path, (1000 + i, 1000 + i))
+        path, _ = cache.get('a', 'avatar')
+
+        cache.put('c', 'avatar', b'c' * 10)
+        cache.evict()
+
+        self.assertIsNotNone(cache.get('a', 'avatar'))
+        self.assertIsNone(cache.get('b', 'avatar'))
+        self.assertIsNotNone(cache.get('c', 'avatar'))
+
+    def test_evict_when_over(self):
+        """Blobs are only scanned when the running total is over."""
+
+        cache = images.ImageCache(os.path.join(self.cache_dir, 'lazy'), 25)
+        cache.put('a', 'avatar', b'a' * 10)
+        cache.maybe_evict()
+        self.assertEqual(cache._size, 10)
+
+        # Under the limit: no scan, so a blob added behind its back stays
+        with open(cache.blob_path('stray'), 'wb') as f:
+            f.write(b's' * 20)
+        cache.maybe_evict()
+        self.assertTrue(os.path.exists(cache.blob_path('stray')))
+
+        cache.put('b', 'avatar', b'b' * 20)
+        cache.maybe_evict()
+        self.assertLessEqual(
+            sum(os.path.getsize(entry.path)
+                for entry in os.scandir(cache.blob_dir)), 25)
@@ -0,0 +1,202 @@
+"""Bulk import tests."""
+
+# run these tests like:
+#
+# python -m unittest test_imports.py
+
+
+import io
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from models import (db, User, Message, FollowersFollowee, Like, MessageTag,
+                    Mention)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import imports
+import snowflake
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ImportTestCase(TestCase):
+    """Test importing follows and messages from lists and CSV."""
+
+    def setUp(self):
+        MessageTag.query.delete()
+        Mention.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        users = [User(username=name, email=f"{name}@test.com",
+                      password="HASHED_PASSWORD")
+                 for name in ["alice", "bob", "carol", "dave"]]
+        users.append(User(username="gone", email="gone@test.com",
+                          password="HASHED_PASSWORD",
+                          deleted_at=datetime.utcnow()))
+        db.session.add_all(users)
+        db.session.commit()
+        self.ids = {user.username: user.id for user in users}
+
+        db.session.add(FollowersFollowee(follower_id=self.ids['alice'],
+                                         followee_id=self.ids['bob']))
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids['alice']
+
+    def tearDown(self):
+        db.session.rollback()
+        MessageTag.query.delete()
+        Mention.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def following(self):
+        return {followee_id for (followee_id,) in
+                db.session.query(FollowersFollowee.followee_id)
+                .filter_by(follower_id=self.ids['alice'])}
+
+    def test_csv_rows(self):
+        lines = ["username", "@bob", "", "carol,extra"]
+        self.assertEqual(list(imports.csv_rows(lines, ('username',))),
+                         [(2, {'username': '@bob'}),
+                          (4, {'username': 'carol'})])
+
+        lines = ["hello, world,2020-01-01T00:00:00"]
+        self.assertEqual(list(imports.csv_rows(lines, ('text', 'timestamp'))),
+                         [(1, {'text': 'hello', 'timestamp': ' world'})])
+
+    def test_follows(self):
+        """Chunks are applied; existing follows and repeats are skipped."""
+
+        alice = User.query.get(self.ids['alice'])
+        rows = imports.json_rows(
+            ["bob", "@carol", "nobody", "alice", "gone", "carol", "dave", ""],
+            imports.FOLLOW_COLUMNS)
+
+        report = imports.import_follows(alice, rows, chunk_size=3)
+
+        self.assertEqual(self.following(), {self.ids[name] for name in
+                                            ["bob", "carol", "dave"]})
+        self.assertEqual((report.added, report.skipped, report.failed),
+                         (2, 2, 4))
+        self.assertEqual(sorted((error['line'], error['error'])
+                                for error in report.errors),
+                         [(3, "No such user"),
+                          (4, "You can't follow yourself"),
+                          (5, "No such user"),
+                          (8, "No username")])
+
+    def test_follows_page(self):
+        csv = io.BytesIO(b"username\ncarol\ndave\nnobody\n")
+        resp = self.client.post("/users/import/follows",
+                                data={'file': (csv, 'follows.csv')},
+                                content_type='multipart/form-data')
+
+        html = resp.get_data(as_text=True)
+        self.assertIn("Added 2, skipped 0 already there, 1 failed", html)
+        self.assertIn("Line 4 (nobody): No such user", html)
+
+        html = self.client.get(
+            f"/users/{self.ids['alice']}/following").get_data(as_text=True)
+        self.assertIn("@dave", html)
+
+    def test_messages(self):
+        rows = [
+            {'text': "old #news for @bob",
+             'timestamp': "2016-03-01T12:00:00Z"},
+            {'text': "no timestamp"},
+            {'text': "x" * 141},
+            {'text': "when?", 'timestamp': "yesterday"},
+            {'text': "too soon", 'timestamp': "2099-01-01T00:00:00"},
+            {'text': "old #news for @bob",
+             'timestamp': "2016-03-01T12:00:00"},
+        ]
+
+        resp = self.client.post("/users/import/messages", json=rows)
+        self.assertEqual(resp.get_json()['added'], 2)
+        self.assertEqual(resp.get_json()['failed'], 3)
+        self.assertEqual(resp.get_json()['skipped'], 1)
+
+        old = Message.query.filter_by(text="old #news for @bob").one()
+        self.assertEqual(old.timestamp, datetime(2016, 3, 1, 12))
+        self.assertEqual(old.thread_id, old.id)
+        self.assertLess(old.id, Message.query.filter_by(
+            text="no timestamp").one().id)
+
+        self.assertEqual(MessageTag.query.one().tag, "news")
+        self.assertEqual(Mention.query.one().user_id, self.ids['bob'])
+
+        # Importing the same file again adds nothing new with a timestamp
+        resp = self.client.post("/users/import/messages", json=rows[:1])
+        self.assertEqual(resp.get_json(), {'added': 0, 'skipped': 1,
+                                           'failed': 0, 'errors': []})
+
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn("no timestamp", html)
+
+    def test_message_id_taken(self):
+        """A row whose id is already used fails rather than being skipped."""
+
+        when = datetime(2017, 5, 5, 5, 5, 5)
+        taken = snowflake.id_at(when)
+        db.session.add(Message(id=taken, text="first", timestamp=when,
+                               user_id=self.ids['bob']))
+        db.session.commit()
+
+        id_at = snowflake.id_at
+        snowflake.id_at = lambda when: taken
+        try:
+            resp = self.client.post("/users/import/messages", json=[
+                {'text': "second", 'timestamp': "2017-05-05T05:05:05Z"}])
+        finally:
+            snowflake.id_at = id_at
+
+        self.assertEqual(resp.get_json()['added'], 0)
+        self.assertEqual(resp.get_json()['skipped'], 0)
+        self.assertEqual(resp.get_json()['errors'][0]['line'], 1)
+        self.assertEqual(Message.query.get(taken).text, "first")
+
+    def test_row_limit(self):
+        app.config['IMPORT_MAX_ROWS'] = 2
+        try:
+            resp = self.client.post("/users/import/follows",
+                                    json=["carol", "dave", "bob"])
+        finally:
+            del app.config['IMPORT_MAX_ROWS']
+
+        self.assertEqual(resp.get_json()['added'], 2)
+        self.assertEqual(resp.get_json()['errors'][0]['line'], 3)
+
+    def test_cli(self):
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as out:
+            out.write("text,timestamp\nfrom the cli,2020-02-02T02:02:02\n")
+        try:
+            result = app.test_cli_runner().invoke(
+                args=['import', 'messages', 'carol', path])
+        finally:
+            os.remove(path)
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Added 1, skipped 0, 0 failed", result.output)
+        self.assertEqual(Message.query.one().user_id, self.ids['carol'])
+
+        result = app.test_cli_runner().invoke(
+            args=['import', 'follows', 'carol', '-'], input="bob\nzed\n")
+        self.assertIn("line 2: No such user (zed)", result.output)
+        self.assertIn("Added 1, skipped 0, 1 failed", result.output)
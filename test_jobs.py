@@ -0,0 +1,146 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+# python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+
+# Now we can import app
+
+from app import app
+import jobs
+
+db.create_all()
+
+CALLS = []
+
+
+@jobs.task
+def record_call(value):
+    """Test task: remember that we ran."""
+
+    CALLS.append(value)
+
+
+@jobs.task
+def always_fails():
+    """Test task: blow up every time."""
+
+    raise ValueError("nope")
+
+
+@jobs.gave_up('always_fails')
+def always_fails_gave_up(**payload):
+    """Test cleanup: remember that the job gave up."""
+
+    CALLS.append('gave up')
+
+
+class JobQueueTestCase(TestCase):
+    """Test enqueueing and running jobs."""
+
+    def setUp(self):
+        """Start each test with an empty queue."""
+
+        Job.query.delete()
+        db.session.commit()
+        CALLS.clear()
+
+    def tearDown(self):
+        """Clean up jobs."""
+
+        db.session.rollback()
+        Job.query.delete()
+        db.session.commit()
+
+    def test_enqueue_and_run(self):
+        """Committed jobs are run once by a worker."""
+
+        jobs.enqueue('record_call', value=42)
+        db.session.commit()
+
+        self.assertEqual(jobs.run_batch(), 1)
+        self.assertEqual(CALLS, [42])
+        self.assertEqual(Job.query.one().status, 'done')
+
+        # Nothing left to do
+        self.assertEqual(jobs.run_batch(), 0)
+        self.assertEqual(CALLS, [42])
+
+    def test_rolled_back_job_never_runs(self):
+        """Jobs share the fate of the transaction that created them."""
+
+        jobs.enqueue('record_call', value=1)
+        db.session.rollback()
+
+        self.assertEqual(jobs.run_batch(), 0)
+        self.assertEqual(CALLS, [])
+
+    def test_unknown_task(self):
+        """Enqueueing an unregistered task is an error."""
+
+        with self.assertRaises(KeyError):
+            jobs.enqueue('no_such_task')
+
+    def test_batching(self):
+        """A batch claims at most `batch_size` jobs."""
+
+        for i in range(5):
+            jobs.enqueue('record_call', value=i)
+        db.session.commit()
+
+        self.assertEqual(jobs.run_batch(batch_size=3), 3)
+        self.assertEqual(jobs.run_batch(batch_size=3), 2)
+        self.assertEqual(CALLS, [0, 1, 2, 3, 4])
+
+    def test_retry_then_fail(self):
+        """Failing jobs are retried with backoff, then marked failed."""
+
+        jobs.enqueue('always_fails', max_attempts=2)
+        db.session.commit()
+
+        jobs.run_batch()
+        job = Job.query.one()
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('ValueError', job.last_error)
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        # Backoff not yet elapsed
+        self.assertEqual(jobs.run_batch(), 0)
+        self.assertEqual(CALLS, [])
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+
+        jobs.run_batch()
+        job = Job.query.one()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(CALLS, ['gave up'])
+
+    def test_requeue_stale(self):
+        """Jobs left running by a dead worker go back on the queue."""
+
+        job = jobs.enqueue('record_call', value=7)
+        job.status = 'running'
+        job.locked_at = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+
+        self.assertEqual(jobs.requeue_stale(), 1)
+        jobs.work(burst=True)
+        self.assertEqual(CALLS, [7])
@@ -0,0 +1,230 @@
+"""Membership filter tests."""
+
+# run these tests like:
+#
+# python -m unittest test_membership.py
+
+
+import os
+import threading
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, create_app, CURR_USER_KEY
+import caching
+import membership
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class BloomFilterTestCase(TestCase):
+    """Test the filter on its own."""
+
+    def test_no_false_negatives(self):
+        """Everything added is always found."""
+
+        bloom = membership.BloomFilter(1000)
+        for key in range(0, 3000, 3):
+            bloom.add(key)
+
+        self.assertTrue(all(key in bloom for key in range(0, 3000, 3)))
+        self.assertEqual(bloom.count, 1000)
+
+    def test_false_positive_rate(self):
+        """Keys never added are rarely reported, near the target rate."""
+
+        bloom = membership.BloomFilter(1000, fp_rate=0.01)
+        for key in range(1000):
+            bloom.add(key)
+
+        false_positives = sum(key in bloom for key in range(10000, 110000))
+        self.assertLess(false_positives / 100000, 0.02)
+
+
+class FilterBuildTestCase(TestCase):
+    """Test that filters are built outside the lock, once per key."""
+
+    def test_builds_side_by_side(self):
+        release = threading.Event()
+        loads = []
+
+        class SlowFilters(membership.MembershipFilters):
+            def _load(self, kind, user_id):
+                loads.append(user_id)
+                if user_id == 1:
+                    release.wait(5)
+                return [user_id]
+
+        filters = SlowFilters(lambda kind, user_id: 'v1')
+        results = [None, None]
+
+        def get(n):
+            results[n] = filters.get(membership.LIKES, 1)
+
+        threads = [threading.Thread(target=get, args=(n,)) for n in range(2)]
+        for thread in threads:
+            thread.start()
+
+        # Another user's filter is built while user 1's is still loading
+        self.assertIn(2, filters.get(membership.LIKES, 2))
+
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertIs(results[0], results[1])
+        self.assertEqual(loads.count(1), 1)
+        self.assertEqual(filters.builds, 2)
+
+
+class MembershipTestCase(TestCase):
+    """Test like and follow lookups go through the filters exactly."""
+
+    def setUp(self):
+        """liker likes 2 of 20 messages by poster, and follows poster."""
+
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+        app.extensions.pop('membership', None)
+        app.extensions.pop('query_cache', None)
+        # Tests run in one process, where per-process cache versions are
+        # enough
+        app.config['QUERY_CACHE'] = True
+
+        self.liker = User(username="liker", email="liker@test.com",
+                          password="HASHED_PASSWORD")
+        self.poster = User(username="poster", email="poster@test.com",
+                           password="HASHED_PASSWORD")
+        db.session.add_all([self.liker, self.poster])
+        db.session.commit()
+        self.liker_id = self.liker.id
+        self.poster_id = self.poster.id
+
+        messages = [Message(text=f"warble {n}", user_id=self.poster_id)
+                    for n in range(20)]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.message_ids = [msg.id for msg in messages]
+
+        db.session.add_all([
+            Like(user_id=self.liker_id, message_id=self.message_ids[3]),
+            Like(user_id=self.liker_id, message_id=self.message_ids[7]),
+            FollowersFollowee(follower_id=self.liker_id,
+                              followee_id=self.poster_id)])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+        app.config['ADMIN_USERS'] = []
+        app.extensions.pop('membership', None)
+        app.extensions.pop('query_cache', None)
+        app.config.pop('QUERY_CACHE', None)
+
+    def test_liked_among(self):
+        """Exactly the liked messages come back, and most skip the DB."""
+
+        with app.app_context():
+            liked = membership.liked_among(self.liker_id, self.message_ids)
+            stats = membership.current_filters().stats()
+
+        self.assertEqual(liked, {self.message_ids[3], self.message_ids[7]})
+        self.assertEqual(stats['lookups'], 20)
+        self.assertEqual(stats['builds'], 1)
+        self.assertEqual(stats['db_skipped'] + stats['false_positives'], 18)
+
+    def test_unlike_forgets(self):
+        """An unlike isn't answered by a filter that still has it."""
+
+        with app.app_context():
+            membership.liked_among(self.liker_id, self.message_ids)
+
+            Like.query.filter_by(user_id=self.liker_id,
+                                 message_id=self.message_ids[3]).delete()
+            db.session.commit()
+            caching.forget_likes(self.liker_id)
+
+            liked = membership.liked_among(self.liker_id, self.message_ids)
+
+        self.assertEqual(liked, {self.message_ids[7]})
+
+    def test_new_like_is_found(self):
+        """A like made after the filter was built is seen once forgotten,
+        by whichever worker made it."""
+
+        with app.app_context():
+            membership.liked_among(self.liker_id, self.message_ids)
+
+            db.session.add(Like(user_id=self.liker_id,
+                                message_id=self.message_ids[0]))
+            db.session.commit()
+
+            # Not yet announced: the filter still says no
+            self.assertNotIn(self.message_ids[0], membership.liked_among(
+                self.liker_id, self.message_ids))
+
+            caching.forget_likes(self.liker_id)
+            liked = membership.liked_among(self.liker_id, self.message_ids)
+            stats = membership.current_filters().stats()
+
+        self.assertIn(self.message_ids[0], liked)
+        self.assertEqual(stats['builds'], 2)
+
+    def test_admin_stats(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.liker_id
+        app.config['ADMIN_USERS'] = ['liker']
+
+        self.client.get("/")
+        data = self.client.get("/admin/membership").get_json()
+
+        self.assertEqual(data['membership']['builds'], 1)
+        self.assertGreater(data['membership']['lookups'], 0)
+
+    def test_is_following(self):
+        """Follow checks are exact both ways."""
+
+        with app.app_context():
+            self.assertTrue(membership.is_following(self.liker_id,
+                                                    self.poster_id))
+            self.assertFalse(membership.is_following(self.poster_id,
+                                                     self.liker_id))
+
+    def test_switched_off(self):
+        """With MEMBERSHIP_FILTERS off, lookups go straight to the DB."""
+
+        test_app = create_app({'MEMBERSHIP_FILTERS': False})
+
+        with test_app.app_context():
+            self.assertIsNone(membership.current_filters())
+            self.assertIsNone(membership.is_following(self.liker_id,
+                                                      self.poster_id))
+            self.assertEqual(
+                membership.liked_among(self.liker_id, self.message_ids),
+                {self.message_ids[3], self.message_ids[7]})
+
+    def test_homepage_stars(self):
+        """Liked messages show as liked on the home timeline."""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.liker_id
+
+        resp = self.client.get("/")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(html.count("fas fa-star"), 2)
@@ -0,0 +1,265 @@
+"""Message partitioning and archiving tests."""
+
+# run these tests like:
+#
+# python -m unittest test_partitions.py
+
+
+import csv
+import gzip
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, create_app
+import partitions
+
+db.create_all()
+
+PARTITIONED_DB = 'warbler_partitions_test'
+
+
+def read_archive(path):
+    with gzip.open(path, 'rt', newline='') as f:
+        return list(csv.reader(f))
+
+
+class PartitionHelpersMixin:
+    """Two users' messages spread over three months, some liked."""
+
+    def add_data(self):
+        author = User(username="author", email="author@test.com",
+                      password="HASHED_PASSWORD")
+        fan = User(username="fan", email="fan@test.com",
+                   password="HASHED_PASSWORD")
+        db.session.add_all([author, fan])
+        db.session.commit()
+        self.author_id = author.id
+        self.fan_id = fan.id
+
+        self.now = datetime.utcnow()
+        old = partitions.month_start(self.now) - timedelta(days=60)
+        self.old_month = partitions.month_start(old)
+
+        messages = [Message(text=f"old {n}", user_id=self.author_id,
+                            timestamp=old + timedelta(hours=n))
+                    for n in range(3)]
+        messages += [Message(text=f"new {n}", user_id=self.author_id,
+                             timestamp=self.now - timedelta(minutes=n))
+                     for n in range(4)]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.old_ids = [msg.id for msg in messages[:3]]
+
+        db.session.add_all([Like(user_id=self.fan_id, message_id=msg.id)
+                            for msg in messages[::2]])
+        db.session.commit()
+
+    def clear_data(self):
+        db.session.rollback()
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+
+class MonthRangeTestCase(PartitionHelpersMixin, TestCase):
+    """Test the month-range fallback used without Postgres partitions."""
+
+    def setUp(self):
+        self.clear_data()
+        self.add_data()
+        self.archive_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.clear_data()
+        shutil.rmtree(self.archive_dir)
+
+    def test_months(self):
+        """Months run from the oldest message to the newest."""
+
+        found = partitions.months()
+
+        self.assertEqual(found[0], self.old_month)
+        self.assertEqual(found[-1], partitions.month_start(self.now))
+
+    def test_recent_first(self):
+        """Newest first, reaching back past the hot window when needed."""
+
+        query = Message.query.filter(Message.user_id == self.author_id)
+
+        recent = partitions.recent_first(query, 2)
+        self.assertEqual([msg.text for msg in recent], ["new 0", "new 1"])
+
+        everything = partitions.recent_first(query, 10)
+        self.assertEqual([msg.text for msg in everything],
+                         ["new 0", "new 1", "new 2", "new 3",
+                          "old 2", "old 1", "old 0"])
+
+    def test_archive(self):
+        """A month's messages and likes go to gzipped CSV, then away."""
+
+        messages, likes = partitions.archive(self.old_month,
+                                             self.archive_dir)
+
+        self.assertEqual((messages, likes), (3, 2))
+        name = partitions.partition_name(self.old_month)
+
+        rows = read_archive(os.path.join(self.archive_dir, f"{name}.csv.gz"))
+        self.assertEqual(rows[0], ['id', 'text', 'timestamp', 'user_id',
+                                   'reply_to_id', 'thread_id', 'path',
+                                   'reply_count'])
+        self.assertEqual(sorted(int(row[0]) for row in rows[1:]),
+                         sorted(self.old_ids))
+
+        rows = read_archive(os.path.join(self.archive_dir,
+                                         f"{name}_likes.csv.gz"))
+        self.assertEqual(len(rows), 3)
+
+        self.assertEqual(Message.query.count(), 4)
+        self.assertEqual(Like.query.count(), 2)
+
+    def test_archive_older_than(self):
+        """Only months past the cutoff are archived."""
+
+        archived = partitions.archive_older_than(1,
+                                                 archive_dir=self.archive_dir)
+
+        self.assertEqual(archived, [self.old_month])
+        self.assertEqual(Message.query.count(), 4)
+
+
+class PostgresPartitionTestCase(PartitionHelpersMixin, TestCase):
+    """Test real partitioning, in a database of its own."""
+
+    @classmethod
+    def setUpClass(cls):
+        admin = create_engine("postgresql:///postgres",
+                              isolation_level='AUTOCOMMIT')
+        try:
+            with admin.connect() as conn:
+                if not conn.execute(text(
+                        "SELECT 1 FROM pg_database WHERE datname = :name"),
+                        name=PARTITIONED_DB).scalar():
+                    conn.execute(text(f"CREATE DATABASE {PARTITIONED_DB}"))
+        except Exception as e:
+            raise cls.skipTest(cls, f"Can't create test database: {e}")
+        finally:
+            admin.dispose()
+
+        cls.app = create_app({'SQLALCHEMY_DATABASE_URI':
+                              f"postgresql:///{PARTITIONED_DB}"})
+
+    def setUp(self):
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        # The session picks its engine when it's created; start a new one
+        db.session.remove()
+        db.drop_all()
+        db.session.execute(text("DROP TABLE IF EXISTS messages CASCADE"))
+        db.session.commit()
+        db.create_all()
+        self.add_data()
+        self.archive_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.session.remove()
+        self.ctx.pop()
+        shutil.rmtree(self.archive_dir)
+
+    def test_enable(self):
+        """Rows survive conversion and land in monthly partitions."""
+
+        self.assertTrue(partitions.enable())
+        self.assertTrue(partitions.is_partitioned())
+        self.assertFalse(partitions.enable())
+
+        self.assertEqual(Message.query.count(), 7)
+        self.assertIn(self.old_month, partitions.months())
+        self.assertGreaterEqual(len(partitions.months()),
+                                1 + partitions.PARTITIONS_AHEAD + 1)
+
+        count = db.session.execute(text(
+            f"SELECT count(*) FROM "
+            f"{partitions.partition_name(self.old_month)}")).scalar()
+        self.assertEqual(count, 3)
+
+        # New messages still get ids and go to this month's partition
+        db.session.add(Message(text="after", user_id=self.author_id,
+                               timestamp=self.now))
+        db.session.commit()
+        self.assertEqual(Message.query.count(), 8)
+
+    def test_recent_timeline_skips_cold_partitions(self):
+        """The hot-window query plan doesn't touch old partitions."""
+
+        partitions.enable()
+
+        cutoff = self.now - partitions.HOT_WINDOW
+        plan = "\n".join(row[0] for row in db.session.execute(text(
+            f"EXPLAIN SELECT * FROM messages "
+            f"WHERE timestamp >= '{cutoff:%Y-%m-%d %H:%M:%S}' "
+            f"ORDER BY timestamp DESC LIMIT 100")))
+
+        self.assertNotIn(partitions.partition_name(self.old_month), plan)
+        self.assertIn(partitions.partition_name(
+            partitions.month_start(self.now)), plan)
+
+    def test_archive_partition(self):
+        """Archiving detaches and drops the partition after writing it."""
+
+        partitions.enable()
+
+        messages, likes = partitions.archive(self.old_month,
+                                             self.archive_dir)
+
+        self.assertEqual((messages, likes), (3, 2))
+        self.assertNotIn(self.old_month, partitions.months())
+        self.assertEqual(Message.query.count(), 4)
+        self.assertEqual(Like.query.count(), 2)
+
+    def test_default_partition(self):
+        """Rows in the default partition are listed, moved into their
+        month's partition when it's created, and archived."""
+
+        partitions.enable()
+
+        stray_month = partitions.month_start(
+            self.old_month - timedelta(days=400))
+        db.session.add(Message(text="imported", user_id=self.author_id,
+                               timestamp=stray_month + timedelta(days=2)))
+        db.session.commit()
+
+        self.assertFalse(partitions.partition_exists(stray_month))
+        self.assertIn(stray_month, partitions.months())
+
+        partitions.create_partition(stray_month)
+        db.session.commit()
+
+        self.assertEqual(db.session.execute(text(
+            f"SELECT count(*) FROM "
+            f"{partitions.partition_name(stray_month)}")).scalar(), 1)
+        self.assertEqual(db.session.execute(text(
+            f"SELECT count(*) FROM "
+            f"{partitions.DEFAULT_PARTITION}")).scalar(), 0)
+
+        earlier = partitions.month_start(stray_month - timedelta(days=1))
+        db.session.add(Message(text="older still", user_id=self.author_id,
+                               timestamp=earlier))
+        db.session.commit()
+
+        self.assertEqual(partitions.archive(earlier, self.archive_dir),
+                         (1, 0))
+        self.assertNotIn(earlier, partitions.months())
+        self.assertEqual(Message.query.filter_by(text="imported").count(), 1)
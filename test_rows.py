@@ -0,0 +1,134 @@
+"""Plain row read path tests."""
+
+# run these tests like:
+#
+# python -m unittest test_rows.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import caching
+import rows
+
+db.create_all()
+
+
+class RowsTestCase(TestCase):
+    """Test user card and message row queries, and the pages using them."""
+
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+        app.extensions.pop('query_cache', None)
+        # Tests run in one process, where per-process cache versions are
+        # enough
+        app.config['QUERY_CACHE'] = True
+
+        alice = User(username="alice", email="alice@test.com",
+                     password="HASHED_PASSWORD", bio="Alice's bio")
+        bob = User(username="bob", email="bob@test.com",
+                   password="HASHED_PASSWORD")
+        gone = User(username="gone", email="gone@test.com",
+                    password="HASHED_PASSWORD",
+                    deleted_at=datetime.utcnow())
+        db.session.add_all([alice, bob, gone])
+        db.session.commit()
+        self.alice_id = alice.id
+        self.bob_id = bob.id
+        self.gone_id = gone.id
+
+        db.session.add_all([
+            Message(text="first", user_id=self.bob_id),
+            Message(text="second", user_id=self.bob_id),
+            Message(text="ghost", user_id=self.gone_id),
+        ])
+        db.session.add(FollowersFollowee(follower_id=self.alice_id,
+                                         followee_id=self.bob_id))
+        db.session.commit()
+        db.session.expunge_all()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.alice_id
+
+    def tearDown(self):
+        db.session.rollback()
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+        app.extensions.pop('query_cache', None)
+        app.config.pop('QUERY_CACHE', None)
+
+    def test_user_cards(self):
+        """Only card columns, only active users, nothing in the session."""
+
+        cards = list(rows.user_cards(
+            rows.user_cards_query().order_by(User.id)))
+
+        self.assertEqual(cards[0], rows.UserCard(
+            self.alice_id, "alice", "/static/images/default-pic.png",
+            "/static/images/warbler-hero.jpg", "Alice's bio"))
+        self.assertEqual([card.username for card in cards], ["alice", "bob"])
+        self.assertFalse(hasattr(cards[0], 'password'))
+        self.assertFalse(hasattr(cards[0], '__dict__'))
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_message_rows(self):
+        """Messages of deleted users are left out; authors are shared."""
+
+        found = list(rows.message_rows(
+            rows.messages_query().order_by(Message.id)))
+
+        self.assertEqual([msg.text for msg in found], ["first", "second"])
+        self.assertEqual(found[0].user, rows.Author(
+            self.bob_id, "bob", "/static/images/default-pic.png"))
+        self.assertIs(found[0].user, found[1].user)
+        self.assertEqual(found[0].reply_count, 0)
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_cached_cards(self):
+        """Follow lists come from cached cards, dropped when users change."""
+
+        with app.test_request_context():
+            self.assertEqual(caching.user_cards([self.bob_id, self.gone_id]),
+                             [rows.user_cards_by_id([self.bob_id])[
+                                 self.bob_id]])
+
+            User.query.filter_by(id=self.bob_id).update({'bio': "new bio"})
+            db.session.commit()
+            self.assertIsNone(caching.user_cards([self.bob_id])[0].bio)
+
+            caching.forget_user(self.bob_id)
+            self.assertEqual(caching.user_cards([self.bob_id])[0].bio,
+                             "new bio")
+
+    def test_pages(self):
+        html = self.client.get("/users").get_data(as_text=True)
+        self.assertIn("@bob", html)
+        self.assertIn("Alice&#39;s bio", html)
+        self.assertNotIn("@gone", html)
+
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn("second", html)
+        self.assertNotIn("ghost", html)
+
+        html = self.client.get(
+            f"/users/{self.alice_id}/following").get_data(as_text=True)
+        self.assertIn("@bob", html)
+        self.assertIn("Unfollow", html)
+
+        html = self.client.get(
+            f"/users/{self.bob_id}").get_data(as_text=True)
+        self.assertIn("first", html)
@@ -0,0 +1,109 @@
+"""Schema upgrade tests."""
+
+# run these tests like:
+#
+# python -m unittest test_schema.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, text
+
+from models import db, User, Message, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import create_app
+import schema
+
+SCHEMA_DB = 'warbler_schema_test'
+
+# The tables as the first version of Warbler created them
+OLD_TABLES = [
+    "CREATE TABLE users (id SERIAL PRIMARY KEY, email TEXT NOT NULL UNIQUE, "
+    "username TEXT NOT NULL UNIQUE, image_url TEXT, header_image_url TEXT, "
+    "bio TEXT, location TEXT, password TEXT NOT NULL)",
+    "CREATE TABLE follows (followee_id INTEGER REFERENCES users (id) "
+    "ON DELETE CASCADE, follower_id INTEGER REFERENCES users (id) "
+    "ON DELETE CASCADE, PRIMARY KEY (followee_id, follower_id))",
+    "CREATE TABLE messages (id SERIAL PRIMARY KEY, "
+    "text VARCHAR(140) NOT NULL, \"timestamp\" TIMESTAMP NOT NULL, "
+    "user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE)",
+    "CREATE TABLE likes (user_id INTEGER REFERENCES users (id) "
+    "ON DELETE CASCADE, message_id INTEGER REFERENCES messages (id) "
+    "ON DELETE CASCADE, PRIMARY KEY (user_id, message_id))",
+]
+
+
+class SchemaUpgradeTestCase(TestCase):
+    """Test upgrading a database made before the newer columns."""
+
+    @classmethod
+    def setUpClass(cls):
+        admin = create_engine("postgresql:///postgres",
+                              isolation_level='AUTOCOMMIT')
+        try:
+            with admin.connect() as conn:
+                if not conn.execute(text(
+                        "SELECT 1 FROM pg_database WHERE datname = :name"),
+                        name=SCHEMA_DB).scalar():
+                    conn.execute(text(f"CREATE DATABASE {SCHEMA_DB}"))
+        except Exception as e:
+            raise cls.skipTest(cls, f"Can't create test database: {e}")
+        finally:
+            admin.dispose()
+
+        cls.app = create_app({'SQLALCHEMY_DATABASE_URI':
+                              f"postgresql:///{SCHEMA_DB}"})
+
+    def setUp(self):
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        # The session picks its engine when it's created; start a new one
+        db.session.remove()
+        db.drop_all()
+        for statement in OLD_TABLES:
+            db.session.execute(text(statement))
+        db.session.execute(text(
+            "INSERT INTO users (email, username, password) "
+            "VALUES ('old@test.com', 'old', 'HASHED_PASSWORD')"))
+        db.session.execute(text(
+            "INSERT INTO messages (text, \"timestamp\", user_id) "
+            "VALUES ('from before', now(), "
+            "(SELECT id FROM users WHERE username = 'old'))"))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_upgrade(self):
+        """Old rows keep working and new messages get snowflake ids."""
+
+        self.assertEqual(len(schema.upgrade()), 2)
+        self.assertEqual(schema.column_type('messages', 'id'), 'bigint')
+        self.assertEqual(schema.column_type('users', 'deleted_at'),
+                         'timestamp without time zone')
+
+        user = User.active().filter_by(username='old').one()
+        old = Message.query.one()
+        self.assertEqual(old.reply_count, 0)
+
+        new = Message(text="after", user_id=user.id)
+        db.session.add(new)
+        db.session.commit()
+        db.session.add(Like(user_id=user.id, message_id=new.id))
+        db.session.commit()
+
+        self.assertGreater(new.id, 2 ** 31)
+        self.assertEqual(Like.query.one().message_id, new.id)
+
+    def test_upgrade_again(self):
+        """A second run has nothing left to do."""
+
+        schema.upgrade()
+
+        self.assertEqual(schema.upgrade(), [])
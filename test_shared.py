@@ -0,0 +1,295 @@
+"""Shared-memory table tests."""
+
+# run these tests like:
+#
+# python -m unittest test_shared.py
+
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import hotkeys
+import shared
+import timelines
+import trending
+
+db.create_all()
+
+
+def add_many(path, key, times):
+    table = shared.SharedTable(path, slots=64, stripes=4)
+    for _ in range(times):
+        table.add(key)
+
+
+def record_many(path, stats_path, key, times):
+    tracker = hotkeys.SharedHotKeys(shared.SharedTable(path, 64, 4),
+                                    shared.SharedTable(stats_path, 64, 4))
+    for _ in range(times):
+        tracker.record(key)
+
+
+def like_many(path, stats_path, message_id, times):
+    tracker = trending.SharedTrendingTracker(
+        shared.SharedTable(path, 64, 4), shared.SharedTable(stats_path, 64, 4))
+    for _ in range(times):
+        tracker.record(message_id)
+
+
+class SharedTableTestCase(TestCase):
+    """Test the table itself, within and across processes."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'table')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_processes(self, target, *args, processes=4):
+        ctx = multiprocessing.get_context('fork')
+        workers = [ctx.Process(target=target, args=args)
+                   for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+
+    def test_add_get_delete(self):
+        table = shared.SharedTable(self.path, slots=64, stripes=4)
+
+        self.assertEqual(table.add('a'), 1)
+        self.assertEqual(table.add('a', 2.5), 3.5)
+        self.assertEqual(table.get('a'), 3.5)
+        self.assertIsNone(table.get('missing', None))
+
+        table.delete('a')
+        self.assertEqual(table.get('a'), 0)
+
+    def test_seen_by_other_mappings(self):
+        first = shared.SharedTable(self.path, slots=64, stripes=4)
+        second = shared.SharedTable(self.path, slots=64, stripes=4)
+
+        first.add('hits', 5)
+        self.assertEqual(second.get('hits'), 5)
+
+    def test_atomic_across_processes(self):
+        """No increments are lost when workers add at once."""
+
+        shared.SharedTable(self.path, slots=64, stripes=4)
+        self.run_processes(add_many, self.path, 'hits', 500)
+
+        table = shared.SharedTable(self.path, slots=64, stripes=4)
+        self.assertEqual(table.get('hits'), 2000)
+
+    def test_full_stripes(self):
+        """Past capacity, adds give up, or evict the smallest entries."""
+
+        table = shared.SharedTable(self.path, slots=8, stripes=2)
+        results = [table.add(f'key{n}') for n in range(40)]
+        self.assertIn(None, results)
+        self.assertEqual(table.stats()['used'], 8)
+        # Deleting a key that never got in is fine
+        table.delete(f'key{results.index(None)}')
+
+        table.clear()
+        for n in range(200):
+            table.add('heavy', evict=True)
+            table.add(f'light{n}', evict=True)
+        self.assertGreaterEqual(table.get('heavy'), 200)
+
+    def test_delete_keeps_probe_chains(self):
+        """Removing a key doesn't hide the keys that probed past it."""
+
+        table = shared.SharedTable(self.path, slots=8, stripes=1)
+        for n in range(8):
+            table.add(f'key{n}', n + 1)
+
+        table.delete('key0')
+        self.assertEqual(sorted(value for _, value in table.items()),
+                         list(range(2, 9)))
+        for n in range(1, 8):
+            self.assertEqual(table.get(f'key{n}'), n + 1)
+
+    def test_large_stripe(self):
+        """Adds and deletes in a big stripe only probe near each key's home,
+        and every key stays findable."""
+
+        table = shared.SharedTable(self.path, slots=1024, stripes=1)
+        reads = []
+        read = table._read
+        table._read = lambda index: reads.append(index) or read(index)
+
+        expected = {}
+        for n in range(3000):
+            key = f'key{n % 700}'
+            if n % 3 == 2:
+                table.delete(key)
+                expected.pop(key, None)
+            elif table.add(key) is not None:
+                expected[key] = expected.get(key, 0) + 1
+
+        self.assertLessEqual(len(reads), 3000 * 3 * shared.MAX_PROBE)
+        self.assertEqual(dict(table.items()), expected)
+        for key, value in expected.items():
+            self.assertEqual(table.get(key), value)
+
+    def test_scale(self):
+        table = shared.SharedTable(self.path, slots=64, stripes=4)
+        table.add('hot:a', 10)
+        table.add('hot:b', 1)
+        table.add('other', 10)
+
+        table.scale(0.5, prefix='hot:', drop_below=1)
+
+        self.assertEqual(dict(table.items()), {'hot:a': 5, 'other': 10})
+
+    def test_wrong_size(self):
+        shared.SharedTable(self.path, slots=64, stripes=4)
+        with self.assertRaises(ValueError):
+            shared.SharedTable(self.path, slots=128, stripes=4)
+
+    def test_hot_keys_across_processes(self):
+        stats_path = self.path + '.stats'
+        self.run_processes(record_many, self.path, stats_path, 'user:1', 25)
+
+        tracker = hotkeys.SharedHotKeys(
+            shared.SharedTable(self.path, 64, 4),
+            shared.SharedTable(stats_path, 64, 4))
+        self.assertEqual(tracker.hottest(), [('user:1', 100)])
+        self.assertTrue(tracker.is_hot('user:1'))
+        self.assertEqual(tracker.stats()['events'], 100)
+
+    def test_hot_keys_decay(self):
+        now = [1000.0]
+        tracker = hotkeys.SharedHotKeys(
+            shared.SharedTable(self.path, 64, 4),
+            shared.SharedTable(self.path + '.stats', 64, 4),
+            decay_interval=60, clock=lambda: now[0])
+
+        for _ in range(16):
+            tracker.record('user:1')
+        now[0] += 60
+        tracker.record('user:2')
+
+        self.assertEqual(dict(tracker.hottest()), {'user:1': 8, 'user:2': 1})
+
+    def test_trending_across_processes(self):
+        stats_path = self.path + '.stats'
+        self.run_processes(like_many, self.path, stats_path, 7, 25)
+        self.run_processes(like_many, self.path, stats_path, 8, 5, processes=2)
+
+        tracker = trending.SharedTrendingTracker(
+            shared.SharedTable(self.path, 64, 4),
+            shared.SharedTable(stats_path, 64, 4))
+        self.assertEqual(tracker.top(), [7, 8])
+        self.assertAlmostEqual(tracker.score(7), 100, places=0)
+
+        tracker.record(8, -1)
+        tracker.record(9, -1)
+        self.assertAlmostEqual(tracker.score(8), 9, places=0)
+        self.assertEqual(tracker.top(), [7, 8])
+
+    def test_trending_warmed_once(self):
+        """Only the first worker to open the tables warms them up."""
+
+        trackers = [trending.SharedTrendingTracker(
+            shared.SharedTable(self.path, 64, 4),
+            shared.SharedTable(self.path + '.stats', 64, 4))
+            for _ in range(2)]
+
+        self.assertTrue(trackers[0].claim_warm())
+        self.assertFalse(trackers[1].claim_warm())
+        self.assertFalse(trackers[0].claim_warm())
+
+
+class SharedAppStateTestCase(TestCase):
+    """Test the app's counters with SHARED_STATE_PATH set."""
+
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.dir = tempfile.mkdtemp()
+        app.config['SHARED_STATE_PATH'] = os.path.join(self.dir, 'warbler')
+        for name in ['shared', 'hotkeys', 'query_cache', 'prewarm',
+                     'trending']:
+            app.extensions.pop(name, None)
+
+        admin = User(username="admin", email="admin@test.com",
+                     password="HASHED_PASSWORD")
+        db.session.add(admin)
+        db.session.commit()
+        self.admin_id = admin.id
+
+        app.config['ADMIN_USERS'] = ['admin']
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.admin_id
+
+    def tearDown(self):
+        db.session.rollback()
+        User.query.delete()
+        db.session.commit()
+        app.config['SHARED_STATE_PATH'] = None
+        app.config['ADMIN_USERS'] = []
+        for name in ['shared', 'hotkeys', 'query_cache', 'prewarm',
+                     'trending']:
+            app.extensions.pop(name, None)
+        shutil.rmtree(self.dir)
+
+    def test_counters_in_shared_table(self):
+        self.client.get(f"/users/{self.admin_id}")
+        self.client.get(f"/users/{self.admin_id}")
+
+        # Another worker's view of the same files
+        stats = shared.SharedTable(os.path.join(self.dir, 'warbler.stats'),
+                                   shared.TABLES['stats'])
+        self.assertGreater(stats.get('cache:hits:users'), 0)
+
+        data = self.client.get("/admin/hot-keys").get_json()
+        self.assertEqual(data['hot_keys'][0],
+                         {'key': f"user:{self.admin_id}", 'count': 2,
+                          'hot': False})
+        self.assertEqual(data['cache']['users']['hits'],
+                         int(stats.get('cache:hits:users')))
+
+    def test_prewarm_in_other_worker(self):
+        """A homepage waits on a prewarm running in another worker."""
+
+        with app.app_context():
+            # Pages only reach other workers through Redis, so without it
+            # the app's prewarmer doesn't wait on them
+            self.assertIsNone(timelines.current_prewarmer().table)
+
+            table = shared.current_table('stats')
+            prewarmer = timelines.Prewarmer(app, table=table)
+
+        table.update(f'prewarm:running:{self.admin_id}',
+                     lambda started: time.time())
+        threading.Timer(0.1, table.delete,
+                        [f'prewarm:running:{self.admin_id}']).start()
+
+        start = time.monotonic()
+        self.assertTrue(prewarmer.wait(self.admin_id, timeout=2))
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertLess(time.monotonic() - start, 2)
+
+        # Marks left behind by a dead worker are ignored
+        table.update(f'prewarm:running:{self.admin_id}',
+                     lambda started: time.time() - timelines.STALE_AFTER - 1)
+        self.assertFalse(prewarmer.wait(self.admin_id, timeout=2))
@@ -0,0 +1,260 @@
+"""Load shedding tests."""
+
+# run these tests like:
+#
+# python -m unittest test_shedding.py
+
+
+import os
+import threading
+import time
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, create_app, CURR_USER_KEY
+import shedding
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class AdaptiveLimitTestCase(TestCase):
+    """Test the AIMD limit and the stale page store."""
+
+    def test_rejects_over_limit(self):
+        limit = shedding.AdaptiveLimit(2, target=1)
+
+        self.assertTrue(limit.acquire())
+        self.assertTrue(limit.acquire())
+        self.assertFalse(limit.acquire())
+        # Only requests actually shed count as rejected
+        self.assertEqual(limit.stats()['rejected'], 0)
+        limit.reject()
+        self.assertEqual(limit.stats(), {'limit': 2, 'in_flight': 2,
+                                         'admitted': 2, 'rejected': 1})
+
+    def test_waits_for_slot(self):
+        limit = shedding.AdaptiveLimit(1, target=1)
+        limit.acquire()
+        threading.Timer(0.05, limit.release, [2.0]).start()
+
+        self.assertTrue(limit.acquire(wait=1))
+        self.assertFalse(limit.acquire(wait=0.05))
+
+    def test_adapts_to_latency(self):
+        """Fast busy requests raise the limit; slow ones cut it, once per
+        target interval."""
+
+        clock = FakeClock()
+        limit = shedding.AdaptiveLimit(10, target=0.5, clock=clock)
+
+        for _ in range(10):
+            limit.acquire()
+        for _ in range(10):
+            limit.release(0.01)
+        self.assertGreater(limit.limit, 10)
+
+        before = limit.limit
+        for _ in range(5):
+            limit.acquire()
+            limit.release(2.0)
+        self.assertAlmostEqual(limit.limit, before * shedding.BACKOFF)
+
+        clock.now += 0.5
+        limit.acquire()
+        limit.release(0.01, failed=True)
+        self.assertAlmostEqual(limit.limit, before * shedding.BACKOFF ** 2)
+
+    def test_stays_in_bounds(self):
+        limit = shedding.AdaptiveLimit(2, target=0, min_limit=1,
+                                       clock=FakeClock())
+        for _ in range(20):
+            limit.clock.now += 1
+            limit.acquire()
+            limit.release(1)
+        self.assertEqual(limit.limit, 1)
+
+    def test_stale_store(self):
+        clock = FakeClock()
+        store = shedding.StaleStore(max_bytes=10, max_age=60, clock=clock)
+
+        store.put('a', b'12345', 'text/html')
+        store.put('b', b'12345', 'text/html')
+        store.put('c', b'123', 'text/html')
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(store.get('b'), (0, b'12345', 'text/html'))
+
+        clock.now += 61
+        self.assertIsNone(store.get('c'))
+
+
+class SheddingViewsTestCase(TestCase):
+    """Test what overloaded requests get back."""
+
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        user = User(username="alice", email="alice@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+        db.session.add(Message(text="before the storm", user_id=self.user_id))
+        db.session.commit()
+
+        self.shedder = app.extensions['shedding']
+        app.extensions['shedding'] = shedding.Shedder()
+        self.wait, shedding.QUEUE_WAIT = shedding.QUEUE_WAIT, 0.05
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        app.extensions['shedding'] = self.shedder
+        shedding.QUEUE_WAIT = self.wait
+        db.session.rollback()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def overload(self, name):
+        """Take every slot of route class `name`."""
+
+        limit = app.extensions['shedding'].limits[name]
+        while limit.acquire():
+            pass
+
+    def test_stale_timeline(self):
+        """A shed timeline gets the last copy, marked as stale."""
+
+        fresh = self.client.get("/").get_data(as_text=True)
+        self.assertIn("before the storm", fresh)
+        # Kept once the stream has been read
+        self.client.get(f"/users/{self.user_id}").get_data()
+
+        self.overload(shedding.READ)
+
+        resp = self.client.get("/")
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Warning'], '110 - "Response is Stale"')
+        self.assertEqual(resp.headers['Age'], '0')
+        self.assertIn('id="stale-banner"', html)
+        self.assertIn("before the storm", html)
+
+        # Streamed profiles are kept too
+        resp = self.client.get(f"/users/{self.user_id}")
+        self.assertIn("before the storm", resp.get_data(as_text=True))
+        self.assertIn('Warning', resp.headers)
+
+        self.assertEqual(app.extensions['shedding'].stats()['stale_served'],
+                         2)
+
+    def test_flashes_not_kept(self):
+        """A page showing a flashed message isn't served again stale."""
+
+        with self.client.session_transaction() as sess:
+            sess['_flashes'] = [('success', "Hello, shedder!")]
+        self.assertIn("Hello, shedder!",
+                      self.client.get("/").get_data(as_text=True))
+
+        self.overload(shedding.READ)
+
+        self.assertEqual(self.client.get("/").status_code, 503)
+
+    def test_copies_are_per_user(self):
+        self.client.get("/")
+
+        other = app.test_client()
+        self.overload(shedding.READ)
+
+        resp = other.get("/")
+        self.assertEqual(resp.status_code, 503)
+
+    def test_fast_503(self):
+        """Non-critical pages are shed at once, with Retry-After."""
+
+        self.overload(shedding.READ)
+
+        start = time.monotonic()
+        resp = self.client.get("/users")
+        self.assertLess(time.monotonic() - start, shedding.QUEUE_WAIT)
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+
+    def test_critical_requests_wait(self):
+        """Writes and timelines with no copy wait for a slot first."""
+
+        self.overload(shedding.WRITE)
+        limit = app.extensions['shedding'].limits[shedding.WRITE]
+        threading.Timer(0.01, limit.release, [0.01]).start()
+        shedding.QUEUE_WAIT = 1
+
+        resp = self.client.post("/messages/new", data={"text": "got in"})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(limit.stats()['rejected'], 0)
+
+        shedding.QUEUE_WAIT = 0.05
+        self.overload(shedding.WRITE)
+        resp = self.client.post("/messages/new", data={"text": "shed"})
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(Message.query.filter_by(text="shed").count(), 0)
+        self.assertEqual(limit.stats()['rejected'], 1)
+
+    def test_static_not_limited(self):
+        self.overload(shedding.READ)
+        resp = self.client.get("/static/stylesheets/style.css")
+        self.assertNotEqual(resp.status_code, 503)
+        resp.close()
+
+    def test_switched_off(self):
+        self.overload(shedding.READ)
+        app.config['LOAD_SHEDDING'] = False
+        try:
+            resp = self.client.get("/users")
+        finally:
+            del app.config['LOAD_SHEDDING']
+        self.assertEqual(resp.status_code, 200)
+
+
+class FaultInjectionTestCase(TestCase):
+    """Test that injected DB latency drives limits down."""
+
+    def setUp(self):
+        self.app = create_app({'FAULT_DB_LATENCY_MS': 0})
+        self.client = self.app.test_client()
+
+    def test_latency_lowers_limit(self):
+        self.client.get("/users")
+        limit = self.app.extensions['shedding'].limits[shedding.READ]
+        limit.target = 0.02
+        before = limit.limit
+
+        self.app.config['FAULT_DB_LATENCY_MS'] = 30
+        start = time.monotonic()
+        self.client.get("/users")
+        self.assertGreaterEqual(time.monotonic() - start, 0.03)
+        self.assertLess(limit.limit, before)
+
+        self.app.config['FAULT_DB_LATENCY_MS'] = 0
+        start = time.monotonic()
+        self.client.get("/users")
+        self.assertLess(time.monotonic() - start, 0.03)
@@ -0,0 +1,189 @@
+"""Snowflake id tests."""
+
+# run these tests like:
+#
+# python -m unittest test_snowflake.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import snowflake
+
+db.create_all()
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class IdGeneratorTestCase(TestCase):
+    """Test id layout and ordering."""
+
+    def setUp(self):
+        self.clock = FakeClock(datetime(2026, 10, 19, 12, 0, 0))
+        self.ids = snowflake.IdGenerator(worker_id=5, clock=self.clock)
+
+    def test_layout(self):
+        """Time, worker and sequence are where they should be."""
+
+        first = self.ids.next_id()
+        second = self.ids.next_id()
+
+        self.assertEqual(snowflake.time_of(first), self.clock.now)
+        self.assertEqual((first >> snowflake.SEQUENCE_BITS) &
+                         snowflake.MAX_WORKER, 5)
+        self.assertEqual(second - first, 1)
+        self.assertTrue(snowflake.is_snowflake(first))
+        self.assertLess(first, 1 << 63)
+
+    def test_time_ordered(self):
+        """Later ids are bigger, even across workers."""
+
+        early = self.ids.next_id()
+        self.clock.now += timedelta(milliseconds=1)
+        other = snowflake.IdGenerator(worker_id=0, clock=self.clock)
+
+        self.assertGreater(other.next_id(), early)
+        self.assertGreaterEqual(other.next_id(),
+                                snowflake.first_id_at(self.clock.now))
+
+    def test_clock_goes_back(self):
+        """Ids keep increasing when the clock steps backwards."""
+
+        before = self.ids.next_id()
+        self.clock.now -= timedelta(seconds=5)
+
+        self.assertGreater(self.ids.next_id(), before)
+
+    def test_sequence_overflow(self):
+        """More than 4096 ids in a millisecond stay unique and ordered."""
+
+        made = [self.ids.next_id() for _ in range(5000)]
+
+        self.assertEqual(made, sorted(set(made)))
+        self.assertEqual(snowflake.time_of(made[-1]),
+                         self.clock.now + timedelta(milliseconds=1))
+
+    def test_id_at(self):
+        """Imported items get ids for their own time."""
+
+        when = datetime(2017, 1, 21, 11, 4, 53, 522000)
+        self.assertEqual(snowflake.time_of(self.ids.id_at(when)), when)
+
+    def test_backfill_worker_ids(self):
+        """id_at() never makes an id next_id() made for that moment."""
+
+        self.clock.now = datetime(2017, 1, 21)
+        made_then = {self.ids.next_id() for _ in range(5000)}
+
+        again = snowflake.IdGenerator(worker_id=5, clock=self.clock)
+        backfilled = {again.id_at(self.clock.now) for _ in range(4096)}
+
+        self.assertFalse(made_then & backfilled)
+        self.assertEqual({(made >> snowflake.SEQUENCE_BITS) &
+                          snowflake.MAX_WORKER for made in backfilled},
+                         {snowflake.BACKFILL_BASE | 5})
+
+
+class WorkerLeaseTestCase(TestCase):
+    """Test leasing worker ids with advisory locks."""
+
+    def test_leases_are_unique(self):
+        with app.app_context():
+            first = snowflake.WorkerLease(db.engine)
+            second = snowflake.WorkerLease(db.engine)
+            try:
+                self.assertIsNotNone(first.worker_id)
+                self.assertNotEqual(first.worker_id, second.worker_id)
+
+                # A released slot can be leased again
+                slot = first.worker_id
+                first.release()
+                third = snowflake.WorkerLease(db.engine)
+                self.assertEqual(third.worker_id, slot)
+                third.release()
+            finally:
+                first.release()
+                second.release()
+
+
+class MessageIdTestCase(TestCase):
+    """Test message ids and timestamps from the model defaults."""
+
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        user = User(username="poster", email="poster@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.rollback()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_each_message_gets_its_own_time(self):
+        """Timestamps are per insert and agree with the ids."""
+
+        first = Message(text="first", user_id=self.user_id)
+        db.session.add(first)
+        db.session.commit()
+
+        second = Message(text="second", user_id=self.user_id)
+        db.session.add(second)
+        db.session.commit()
+
+        self.assertGreater(second.id, first.id)
+        self.assertGreaterEqual(second.timestamp, first.timestamp)
+        self.assertEqual(first.timestamp, snowflake.time_of(first.id))
+
+    def test_given_timestamp_orders_id(self):
+        """A message with an explicit time sorts by that time."""
+
+        old = Message(text="old", user_id=self.user_id,
+                      timestamp=datetime(2018, 6, 1))
+        db.session.add(old)
+        db.session.commit()
+
+        new = Message(text="new", user_id=self.user_id)
+        db.session.add(new)
+        db.session.commit()
+
+        self.assertLess(old.id, new.id)
+        self.assertEqual(snowflake.time_of(old.id), datetime(2018, 6, 1))
+
+    def test_homepage_pages_by_id(self):
+        """`before` pages back through the timeline."""
+
+        db.session.add_all([Message(text=f"warble {n}", user_id=self.user_id)
+                            for n in range(3)])
+        db.session.commit()
+        ids = sorted(msg.id for msg in Message.query)
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        html = client.get(f"/?before={ids[2]}").get_data(as_text=True)
+
+        self.assertNotIn(f"/messages/{ids[2]}\"", html)
+        self.assertIn(f"/messages/{ids[1]}\"", html)
+        self.assertIn(f"/messages/{ids[0]}\"", html)
@@ -0,0 +1,161 @@
+"""Who-to-follow suggestion tests."""
+
+# run these tests like:
+#
+# python -m unittest test_suggestions.py
+
+
+import os
+from unittest import TestCase
+
+from models import (db, User, Message, FollowersFollowee, Like, Suggestion,
+                    SuggestionRefresh)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import suggestions
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SuggestionsTestCase(TestCase):
+    """Test computing, storing and serving suggestions."""
+
+    def setUp(self):
+        """Users 1..5:  1 -> 2, 2 -> 3, 2 -> 4, 5 -> 1, 5 -> 4"""
+
+        Suggestion.query.delete()
+        SuggestionRefresh.query.delete()
+        User.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        Like.query.delete()
+
+        self.users = [User(id=i, email=f"u{i}@test.com", username=f"user{i}",
+                           password="HASHED_PASSWORD")
+                      for i in range(1, 6)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+        for follower, followee in [(1, 2), (2, 3), (2, 4), (5, 1), (5, 4)]:
+            db.session.add(FollowersFollowee(follower_id=follower,
+                                             followee_id=followee))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        Suggestion.query.delete()
+        SuggestionRefresh.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def suggested_ids(self, user_id):
+        return [user.id for user in suggestions.for_user(user_id)]
+
+    def test_friends_of_friends(self):
+        """User 1 follows 2, who follows 3 and 4."""
+
+        self.assertEqual(suggestions.refresh(), 5)
+
+        # 4 is also followed by 5, who follows 1: common follower bonus
+        self.assertEqual(self.suggested_ids(1), [4, 3])
+
+    def test_excludes_self_and_followed(self):
+        """Never suggest yourself or someone you already follow."""
+
+        suggestions.refresh()
+
+        for user_id in range(1, 6):
+            followed = {f.followee_id for f in FollowersFollowee.query
+                        .filter_by(follower_id=user_id)}
+            suggested = set(self.suggested_ids(user_id))
+            self.assertNotIn(user_id, suggested)
+            self.assertFalse(suggested & followed)
+
+    def test_ranked_storage(self):
+        """Suggestions are stored ranked, best first."""
+
+        suggestions.refresh()
+
+        rows = (Suggestion.query.filter_by(user_id=1)
+                .order_by(Suggestion.rank).all())
+        self.assertEqual([row.rank for row in rows], [0, 1])
+        self.assertGreater(rows[0].score, rows[1].score)
+
+    def test_incremental_refresh(self):
+        """Following someone marks only you stale; refresh updates you."""
+
+        suggestions.refresh()
+        before_5 = self.suggested_ids(5)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            c.post("/users/follow/4")
+
+        self.assertEqual(
+            [row.user_id for row in SuggestionRefresh.query.all()], [1])
+
+        self.assertEqual(suggestions.refresh_stale_suggestions(), 1)
+        self.assertNotIn(4, self.suggested_ids(1))
+        self.assertEqual(self.suggested_ids(5), before_5)
+        self.assertEqual(SuggestionRefresh.query.count(), 0)
+
+    def test_marks_during_refresh_kept(self):
+        """A follow made while refreshing is refreshed on the next run."""
+
+        suggestions.mark_stale(1)
+        db.session.commit()
+
+        refresh = suggestions.refresh
+
+        def refresh_meanwhile(user_ids):
+            count = refresh(user_ids)
+            # As if other requests had followed someone meanwhile
+            db.session.execute(SuggestionRefresh.__table__.insert(),
+                               [{'user_id': 1}, {'user_id': 5}])
+            db.session.commit()
+            return count
+
+        suggestions.refresh = refresh_meanwhile
+        try:
+            self.assertEqual(suggestions.refresh_stale_suggestions(), 1)
+        finally:
+            suggestions.refresh = refresh
+
+        self.assertEqual(sorted(row.user_id for row in
+                                SuggestionRefresh.query.all()), [1, 5])
+
+    def test_mark_twice(self):
+        """Marking a user who is already marked leaves one mark."""
+
+        with db.engine.begin() as conn:
+            conn.execute(SuggestionRefresh.__table__.insert(), user_id=1)
+
+        suggestions.mark_stale(1)
+        suggestions.mark_stale(1)
+        db.session.commit()
+
+        self.assertEqual(
+            [row.user_id for row in SuggestionRefresh.query.all()], [1])
+
+    def test_homepage_sidebar(self):
+        """Suggestions show up on the homepage."""
+
+        suggestions.refresh()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = c.get("/")
+
+        self.assertIn(b'Who to follow', resp.data)
+        self.assertIn(b'@user4', resp.data)
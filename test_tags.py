@@ -0,0 +1,171 @@
+"""Hashtag and mention index tests."""
+
+# run these tests like:
+#
+# python -m unittest test_tags.py
+
+
+import os
+from unittest import TestCase
+
+from models import (db, User, Message, FollowersFollowee, Like, MessageTag,
+                    Mention)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import tags
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ParseTestCase(TestCase):
+    """Test pulling tags and mentions out of text."""
+
+    def test_parse(self):
+        tag_set, names = tags.parse(
+            "Lunch with @alice and @bob_2 #Food #food #nyc. email@x.com a#b")
+
+        self.assertEqual(tag_set, {'food', 'nyc'})
+        self.assertEqual(names, {'alice', 'bob_2'})
+
+    def test_linkify_escapes(self):
+        """Text is escaped before links are added."""
+
+        with app.test_request_context():
+            html = tags.linkify("<b>hi</b> #Fun it's @alice")
+
+        self.assertIn("&lt;b&gt;", html)
+        self.assertIn('<a href="/tags/fun">#Fun</a>', html)
+        self.assertIn('<a href="/users?q=alice">@alice</a>', html)
+        self.assertNotIn("/tags/39", html)
+
+
+class TagIndexTestCase(TestCase):
+    """Test indexing on post, the timelines and backfill."""
+
+    def setUp(self):
+        MessageTag.query.delete()
+        Mention.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.alice = User(username="alice", email="alice@test.com",
+                          password="HASHED_PASSWORD")
+        self.bob = User(username="bob", email="bob@test.com",
+                        password="HASHED_PASSWORD")
+        db.session.add_all([self.alice, self.bob])
+        db.session.commit()
+        self.alice_id = self.alice.id
+        self.bob_id = self.bob.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        MessageTag.query.delete()
+        Mention.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def post(self, user_id, text):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return self.client.post("/messages/new", data={"text": text})
+
+    def test_post_indexes(self):
+        """Posting records tags and mentions of known users."""
+
+        resp = self.post(self.alice_id, "Hey @bob and @nobody, #Warbler!")
+        self.assertEqual(resp.status_code, 302)
+
+        msg = Message.query.one()
+        self.assertEqual([(row.tag, row.message_id)
+                          for row in MessageTag.query],
+                         [('warbler', msg.id)])
+        self.assertEqual([(row.user_id, row.message_id)
+                          for row in Mention.query],
+                         [(self.bob_id, msg.id)])
+
+    def test_tag_timeline_pages(self):
+        """Newest first, with `before` carrying on where a page ended."""
+
+        for n in range(tags.PAGE_SIZE + 2):
+            self.post(self.alice_id, f"number {n} #count")
+        self.post(self.alice_id, "not tagged")
+
+        ids = sorted((row.message_id for row in MessageTag.query),
+                     reverse=True)
+
+        first = tags.tagged("COUNT")
+        self.assertEqual([msg.id for msg in first], ids[:tags.PAGE_SIZE])
+
+        rest = tags.tagged("count", before=first[-1].id)
+        self.assertEqual([msg.id for msg in rest], ids[tags.PAGE_SIZE:])
+
+        resp = self.client.get("/tags/count")
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(f"before={first[-1].id}", html)
+        self.assertIn("number 51", html)
+        self.assertNotIn("not tagged", html)
+
+    def test_mentions_timeline(self):
+        """Shows messages mentioning the logged-in user."""
+
+        self.post(self.alice_id, "Hi @bob")
+        self.post(self.alice_id, "Hi everyone")
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.bob_id
+        html = self.client.get("/mentions").get_data(as_text=True)
+
+        self.assertIn("Hi <a", html)
+        self.assertNotIn("Hi everyone", html)
+
+    def test_delete_message_removes_index_rows(self):
+        self.post(self.alice_id, "#gone @bob")
+        msg = Message.query.one()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.alice_id
+        self.client.post(f"/messages/{msg.id}/delete")
+
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(Mention.query.count(), 0)
+
+    def backfill_fixture(self):
+        db.session.add_all([Message(text=f"old {n} #past @bob",
+                                    user_id=self.alice_id)
+                            for n in range(25)])
+        db.session.commit()
+
+    def test_backfill(self):
+        """Existing messages are indexed chunk by chunk, repeatably."""
+
+        self.backfill_fixture()
+
+        with app.app_context():
+            self.assertEqual(len(tags.chunk_bounds(10)), 3)
+            self.assertEqual(tags.backfill(chunk_size=10), 25)
+            self.assertEqual(tags.backfill(chunk_size=7), 25)
+
+        self.assertEqual(MessageTag.query.filter_by(tag='past').count(), 25)
+        self.assertEqual(Mention.query.filter_by(user_id=self.bob_id).count(),
+                         25)
+
+    def test_backfill_in_parallel(self):
+        """Chunks can be shared out to worker processes."""
+
+        self.backfill_fixture()
+
+        with app.app_context():
+            self.assertEqual(tags.backfill(processes=2, chunk_size=5), 25)
+
+        self.assertEqual(MessageTag.query.filter_by(tag='past').count(), 25)
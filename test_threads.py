@@ -0,0 +1,167 @@
+"""Reply thread tests."""
+
+# run these tests like:
+#
+# python -m unittest test_threads.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import (db, User, Message, FollowersFollowee, Like, MessageTag,
+                    Mention)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import threads
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ThreadTestCase(TestCase):
+    """Test replying, loading conversations and reply counts."""
+
+    def setUp(self):
+        MessageTag.query.delete()
+        Mention.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        alice = User(username="alice", email="alice@test.com",
+                     password="HASHED_PASSWORD")
+        bob = User(username="bob", email="bob@test.com",
+                   password="HASHED_PASSWORD")
+        db.session.add_all([alice, bob])
+        db.session.commit()
+        self.alice_id = alice.id
+        self.bob_id = bob.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def post(self, user_id, text):
+        self.login(user_id)
+        self.client.post("/messages/new", data={"text": text})
+        return Message.query.filter_by(text=text).one().id
+
+    def reply(self, user_id, message_id, text):
+        self.login(user_id)
+        resp = self.client.post(f"/messages/{message_id}/reply",
+                                data={"text": text})
+        self.assertEqual(resp.status_code, 302)
+        return Message.query.filter_by(text=text).one().id
+
+    def test_paths_and_counts(self):
+        """Replies extend their parent's path and count up the thread."""
+
+        root = self.post(self.alice_id, "root")
+        first = self.reply(self.bob_id, root, "first")
+        deep = self.reply(self.alice_id, first, "deep")
+        second = self.reply(self.bob_id, root, "second")
+
+        msg = Message.query.get(deep)
+        self.assertEqual(msg.thread_id, root)
+        self.assertEqual(msg.reply_to_id, first)
+        self.assertEqual(threads.ancestor_ids(msg), [root, first])
+        self.assertEqual(threads.depth(msg), 2)
+
+        counts = {m.id: m.reply_count for m in Message.query}
+        self.assertEqual(counts, {root: 3, first: 1, deep: 0, second: 0})
+
+    def test_conversation_is_one_query(self):
+        """A thread comes back depth first, with its authors, from a single
+        SELECT."""
+
+        root = self.post(self.alice_id, "root")
+        first = self.reply(self.bob_id, root, "first")
+        second = self.reply(self.bob_id, root, "second")
+        deep = self.reply(self.alice_id, first, "deep")
+        other = self.post(self.alice_id, "another thread")
+
+        msg = Message.query.get(root)
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            found = [m.id for m in threads.conversation(msg)]
+            authors = [m.user.username for m in threads.conversation(msg)]
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(found, [root, first, deep, second])
+        self.assertEqual(authors, ['alice', 'bob', 'alice', 'bob'])
+        self.assertNotIn(other, found)
+
+        # A reply's page shows just the conversation under it
+        sub = [m.id for m in threads.conversation(Message.query.get(first))]
+        self.assertEqual(sub, [first, deep])
+
+    def test_show_page(self):
+        """The message page lists replies and links to the parent."""
+
+        root = self.post(self.alice_id, "root")
+        first = self.reply(self.bob_id, root, "first reply")
+        self.reply(self.alice_id, first, "deeper reply")
+
+        html = self.client.get(f"/messages/{root}").get_data(as_text=True)
+        self.assertIn("first reply", html)
+        self.assertIn("deeper reply", html)
+        self.assertIn(f'action="/messages/{root}/reply"', html)
+
+        html = self.client.get(f"/messages/{first}").get_data(as_text=True)
+        self.assertIn(f'href="/messages/{root}"', html)
+
+        # Timelines preview the count without loading the thread
+        html = self.client.get(f"/users/{self.alice_id}").get_data(
+            as_text=True)
+        self.assertIn("2 replies", html)
+
+    def test_reply_to_legacy_message(self):
+        """Messages from before threads join one when replied to."""
+
+        old = Message(text="old", user_id=self.alice_id)
+        db.session.add(old)
+        db.session.commit()
+        old_id = old.id
+        self.assertIsNone(old.path)
+        self.assertEqual(threads.conversation(old), [old])
+
+        reply = self.reply(self.bob_id, old_id, "late reply")
+
+        old = Message.query.get(old_id)
+        self.assertEqual(old.thread_id, old_id)
+        self.assertEqual(old.reply_count, 1)
+        self.assertEqual([m.id for m in threads.conversation(old)],
+                         [old_id, reply])
+
+    def test_delete_reply(self):
+        """Deleting a reply takes it out of the counts above it."""
+
+        root = self.post(self.alice_id, "root")
+        first = self.reply(self.bob_id, root, "first")
+
+        self.login(self.bob_id)
+        self.client.post(f"/messages/{first}/delete")
+
+        self.assertEqual(Message.query.get(root).reply_count, 0)
@@ -0,0 +1,204 @@
+"""Timeline prewarm tests."""
+
+# run these tests like:
+#
+# python -m unittest test_timelines.py
+
+
+import os
+import time
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import timelines
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+EXTENSIONS = ['prewarm', 'query_cache', 'membership']
+
+
+class PrewarmTestCase(TestCase):
+    """Test that logging in builds the first homepage ahead of time."""
+
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+        for name in EXTENSIONS:
+            app.extensions.pop(name, None)
+        # Tests run in one process, where per-process cache versions are
+        # enough
+        app.config['QUERY_CACHE'] = True
+
+        alice = User.signup("alice", "alice@test.com", "password", None)
+        bob = User.signup("bob", "bob@test.com", "password", None)
+        db.session.commit()
+        self.alice_id = alice.id
+        self.bob_id = bob.id
+
+        msgs = [Message(text=f"warble {n}", user_id=self.bob_id)
+                for n in range(3)]
+        db.session.add_all(msgs)
+        db.session.add(FollowersFollowee(follower_id=self.alice_id,
+                                         followee_id=self.bob_id))
+        db.session.commit()
+        db.session.add(Like(user_id=self.alice_id, message_id=msgs[0].id))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        Like.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        User.query.delete()
+        db.session.commit()
+        app.config['ADMIN_USERS'] = []
+        for name in EXTENSIONS:
+            app.extensions.pop(name, None)
+        app.config.pop('QUERY_CACHE', None)
+
+    def login(self):
+        self.client.post("/login", data={"username": "alice",
+                                         "password": "password"})
+
+    def wait_for_prewarm(self):
+        prewarmer = app.extensions['prewarm']
+        deadline = time.monotonic() + 5
+        while prewarmer.pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def count_queries(self, url):
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        with app.app_context():
+            engine = db.engine
+
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            html = self.client.get(url).get_data(as_text=True)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+
+        return html, statements
+
+    def stats(self):
+        return app.extensions['prewarm'].stats()
+
+    def test_first_homepage_is_warm(self):
+        self.login()
+        self.wait_for_prewarm()
+
+        html, warm = self.count_queries("/")
+        self.assertIn("warble 2", html)
+        self.assertEqual(html.count('class="fas fa-star"'), 1)
+        self.assertFalse([sql for sql in warm if 'FROM messages' in sql])
+
+        # Later visits build the page as before
+        html, cold = self.count_queries("/")
+        self.assertIn("warble 2", html)
+        self.assertLess(len(warm), len(cold))
+
+        self.assertEqual(self.stats()['finished'], 1)
+        self.assertEqual(self.stats()['warm_hits'], 1)
+        self.assertEqual(self.stats()['cold'], 0)
+
+    def test_homepage_waits_for_prewarm(self):
+        """A homepage that beats the prewarm waits for it."""
+
+        timelines.PREWARM_WAIT, wait = 5, timelines.PREWARM_WAIT
+        real_build = timelines.build
+
+        def slow_build(user_id):
+            time.sleep(0.2)
+            real_build(user_id)
+
+        timelines.build = slow_build
+        try:
+            self.login()
+            html = self.client.get("/").get_data(as_text=True)
+        finally:
+            timelines.build = real_build
+            timelines.PREWARM_WAIT = wait
+
+        self.assertIn("warble 2", html)
+        self.assertEqual(self.stats()['warm_hits'], 1)
+        self.assertEqual(self.stats()['waited'], 1)
+
+    def test_own_post_drops_page(self):
+        """A message posted before the first homepage shows up on it."""
+
+        self.login()
+        self.wait_for_prewarm()
+        self.client.post("/messages/new", data={"text": "just posted"})
+
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn("just posted", html)
+        self.assertEqual(self.stats()['cold'], 1)
+
+    def test_signup_prewarms(self):
+        self.client.post("/signup", data={"username": "carol",
+                                          "password": "password",
+                                          "email": "carol@test.com"})
+        self.wait_for_prewarm()
+
+        self.client.get("/")
+        self.assertEqual(self.stats()['warm_hits'], 1)
+
+    def test_failed_prewarm(self):
+        """A prewarm that fails leaves the homepage to build itself."""
+
+        real_build = timelines.build
+
+        def broken_build(user_id):
+            raise RuntimeError("DB went away")
+
+        timelines.build = broken_build
+        try:
+            self.login()
+            self.wait_for_prewarm()
+        finally:
+            timelines.build = real_build
+
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn("warble 2", html)
+        self.assertEqual(self.stats()['failed'], 1)
+        self.assertEqual(self.stats()['cold'], 1)
+
+    def test_admin_stats(self):
+        self.login()
+        self.wait_for_prewarm()
+        self.client.get("/")
+
+        resp = self.client.get("/admin/prewarm")
+        self.assertEqual(resp.status_code, 401)
+
+        app.config['ADMIN_USERS'] = ['alice']
+        data = self.client.get("/admin/prewarm").get_json()
+        self.assertEqual(data['prewarm']['warm_hits'], 1)
+        self.assertEqual(data['prewarm']['warm_hit_rate'], 1.0)
+
+    def test_switched_off(self):
+        app.config['PREWARM'] = False
+        try:
+            self.login()
+            html = self.client.get("/").get_data(as_text=True)
+        finally:
+            del app.config['PREWARM']
+
+        self.assertIn("warble 2", html)
+        self.assertNotIn('prewarm', app.extensions)
@@ -0,0 +1,195 @@
+"""Trending messages tests."""
+
+# run these tests like:
+#
+# python -m unittest test_trending.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from trending import TrendingTracker
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+HOUR = 60 * 60
+
+
+class FakeClock:
+    """Clock the tests can move forward."""
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TrendingTrackerTestCase(TestCase):
+    """Test decayed scoring and the top-K structure."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.tracker = TrendingTracker(k=3, half_life=HOUR, capacity=5,
+                                       decay_interval=60, clock=self.clock)
+
+    def test_ranked_by_likes(self):
+        """More likes at the same time rank higher."""
+
+        for message_id, likes in [(1, 1), (2, 3), (3, 2)]:
+            for _ in range(likes):
+                self.tracker.record(message_id)
+
+        self.assertEqual(self.tracker.top(), [2, 3, 1])
+        self.assertAlmostEqual(self.tracker.score(2), 3)
+
+    def test_recent_beats_old(self):
+        """Likes lose half their weight every half-life."""
+
+        for _ in range(3):
+            self.tracker.record(1)
+
+        self.clock.now += 2 * HOUR
+        self.tracker.record(2)
+        self.tracker.record(2)
+
+        self.assertEqual(self.tracker.top(), [2, 1])
+        self.assertAlmostEqual(self.tracker.score(1), 0.75)
+
+    def test_unlike(self):
+        """Unliking takes the like back out."""
+
+        self.tracker.record(1)
+        self.tracker.record(2)
+        self.tracker.record(2)
+        self.tracker.record(2, -1)
+        self.tracker.record(2, -1)
+
+        self.assertEqual(self.tracker.top(), [1])
+        self.assertNotIn(2, self.tracker.scores)
+
+    def test_bounded(self):
+        """Only K are ranked and at most `capacity` are tracked."""
+
+        for message_id in range(1, 11):
+            for _ in range(message_id):
+                self.tracker.record(message_id)
+
+        self.assertEqual(self.tracker.top(), [10, 9, 8])
+
+        # Next decay pass prunes to capacity
+        self.clock.now += 60
+        self.tracker.record(10)
+
+        self.assertEqual(sorted(self.tracker.scores), [6, 7, 8, 9, 10])
+        self.assertEqual(self.tracker.top(), [10, 9, 8])
+
+    def test_cold_messages_forgotten(self):
+        """Messages decayed to nothing are dropped."""
+
+        self.tracker.record(1)
+        self.clock.now += 10 * HOUR
+        self.tracker.record(2)
+
+        self.assertEqual(self.tracker.top(), [2])
+        self.assertNotIn(1, self.tracker.scores)
+
+
+class TrendingViewTestCase(TestCase):
+    """Test the /trending page."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        FollowersFollowee.query.delete()
+        Like.query.delete()
+        app.extensions.pop('trending', None)
+
+        self.user = User.signup(username="trender", email="trend@test.com",
+                                password="testpassword", image_url=None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        self.messages = [Message(text=f"warble {i}", user_id=self.user_id)
+                         for i in range(3)]
+        db.session.add_all(self.messages)
+        db.session.commit()
+        self.message_ids = [msg.id for msg in self.messages]
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        app.extensions.pop('trending', None)
+
+    def test_likes_drive_trending(self):
+        """Liked messages show up on /trending; unliked ones drop off."""
+
+        liked_id = self.message_ids[1]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post('/like/add', data={'message_id': liked_id})
+            resp = c.get('/trending')
+
+            self.assertIn(b'warble 1', resp.data)
+            self.assertNotIn(b'warble 0', resp.data)
+
+            c.post('/like/remove', data={'message_id': liked_id})
+            resp = c.get('/trending')
+
+            self.assertIn(b'Nothing trending right now.', resp.data)
+
+    def test_warmed_from_db(self):
+        """Existing likes count when a worker starts up."""
+
+        db.session.add(Like(user_id=self.user_id,
+                            message_id=self.message_ids[2]))
+        db.session.commit()
+
+        resp = self.client.get('/trending')
+
+        self.assertIn(b'warble 2', resp.data)
+
+    def test_warmed_from_like_times(self):
+        """Warming up counts likes when they were made, not when their
+        message was posted."""
+
+        old_post = Message(text="old warble", user_id=self.user_id,
+                           timestamp=datetime.utcnow() - timedelta(days=30))
+        db.session.add(old_post)
+        db.session.commit()
+        db.session.add_all([
+            Like(user_id=self.user_id, message_id=old_post.id),
+            Like(user_id=self.user_id, message_id=self.message_ids[0],
+                 created_at=datetime.utcnow() - timedelta(days=30)),
+        ])
+        db.session.commit()
+
+        resp = self.client.get('/trending')
+
+        self.assertIn(b'old warble', resp.data)
+        self.assertNotIn(b'warble 0', resp.data)
+
+    def test_bad_message_id(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = self.client.post('/like/add', data={'message_id': 'nope'})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(Like.query.count(), 0)
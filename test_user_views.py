@@ -6,6 +6,7 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 from flask import session
 from models import db, connect_db, Message, User, FollowersFollowee, Like
@@ -197,13 +198,15 @@ class UserShowViewTestCase(TestCase):
 
         db.session.commit()
 
+        # Pages are streamed, so read each response before the next request
         resp_all = self.client.get("/users")
+        self.assertIn(b'bob', resp_all.data)
+
         resp_search = self.client.get("/users?q=tes")
 
         # import pdb
         # pdb.set_trace()
 
-        self.assertIn(b'bob', resp_all.data)
         self.assertIn(b'tesla', resp_search.data)
         self.assertIn(b'testuser', resp_search.data)
 
@@ -216,6 +219,30 @@ class UserShowViewTestCase(TestCase):
         self.assertIn(b'0', resp.data)
         self.assertIn(b'<ul class="list-group" id="messages">', resp.data)
 
+    def test_users_show_streamed(self):
+        """Profile page is streamed, newest messages first"""
+
+        db.session.add_all([
+            Message(text="older warble", timestamp=datetime(2018, 1, 1),
+                    user_id=self.testuser.id),
+            Message(text="newer warble", timestamp=datetime(2018, 6, 1),
+                    user_id=self.testuser.id),
+        ])
+        db.session.commit()
+
+        resp = self.client.get(f"/users/{self.testuser.id}")
+
+        self.assertTrue(resp.is_streamed)
+        self.assertLess(resp.data.index(b'newer warble'),
+                        resp.data.index(b'older warble'))
+
+    def test_list_users_none_found(self):
+        """Streamed user list says so when search matches nobody"""
+
+        resp = self.client.get("/users?q=nobody-by-this-name")
+
+        self.assertIn(b'Sorry, no users found', resp.data)
+
 
 class UserFollowViewTestCase(TestCase):
     """Test user follow views."""
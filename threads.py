@@ -0,0 +1,136 @@
+"""Reply threads, stored as materialized paths.
+
+Each message in a thread has a `path`: the ids of the messages from the
+thread's first message down to it, each as 16 hex digits, joined with '/':
+
+    000a1b2c3d4e5f60                                   first message
+    000a1b2c3d4e5f60/000a1b2c3d4e9999                  a reply to it
+    000a1b2c3d4e5f60/000a1b2c3d4e9999/000a1b2c3d4f0000 a reply to the reply
+
+Sorting by path lists a thread depth first, replies under their parent in
+the order they were made (ids are time-ordered). Everything under a
+message has a path starting with that message's path, so a whole
+conversation is one range scan of the (thread_id, path) index, however
+deep it goes.
+
+Each message also counts the replies beneath it (`reply_count`), bumped
+for every ancestor as a reply is posted, so timelines can show "3 replies"
+without counting anything.
+
+Messages from before threads existed have no path; they get one when
+someone first replies to them.
+"""
+
+from collections import Counter, defaultdict
+
+from sqlalchemy.orm import contains_eager
+
+from models import Message
+
+SEPARATOR = '/'
+
+# Sorts just after SEPARATOR, so `path + END` is above every path under it
+END = chr(ord(SEPARATOR) + 1)
+
+
+def segment(message_id):
+    return f"{message_id:016x}"
+
+
+def ancestor_ids(message):
+    """Ids of the messages `message` is (indirectly) a reply to."""
+
+    return _ancestors(message.path)
+
+
+def _ancestors(path):
+    if not path:
+        return []
+    return [int(part, 16) for part in path.split(SEPARATOR)[:-1]]
+
+
+def depth(message):
+    """0 for a thread's first message, 1 for replies to it, and so on."""
+
+    return message.path.count(SEPARATOR) if message.path else 0
+
+
+def _start(message):
+    message.thread_id = message.id
+    message.path = segment(message.id)
+
+
+def place(message, parent=None):
+    """Put a new message in a thread; caller commits.
+
+    Without `parent` the message starts a thread of its own. The message
+    must have its id, i.e. be flushed.
+    """
+
+    if parent is None:
+        _start(message)
+        return
+
+    if parent.path is None:
+        _start(parent)
+
+    message.reply_to_id = parent.id
+    message.thread_id = parent.thread_id
+    message.path = f"{parent.path}{SEPARATOR}{segment(message.id)}"
+
+    _count_replies(ancestor_ids(message), 1)
+
+
+def remove(message):
+    """Take a message being deleted out of its ancestors' reply counts.
+
+    Its own replies stay where they are; they're still in the thread.
+    """
+
+    _count_replies(ancestor_ids(message), -1)
+
+
+def remove_paths(paths):
+    """`remove()` for many deleted messages at once, given their paths.
+
+    One UPDATE per distinct number of replies taken off an ancestor.
+    """
+
+    removed = Counter(message_id for path in paths
+                      for message_id in _ancestors(path))
+
+    by_count = defaultdict(list)
+    for message_id, count in removed.items():
+        by_count[count].append(message_id)
+
+    for count, message_ids in by_count.items():
+        _count_replies(message_ids, -count)
+
+
+def _count_replies(message_ids, change):
+    if message_ids:
+        (Message
+         .query
+         .filter(Message.id.in_(message_ids))
+         .update({Message.reply_count: Message.reply_count + change},
+                 synchronize_session=False))
+
+
+def conversation(message):
+    """`message` and every reply under it, depth first, in one query.
+
+    Authors come from the same query (`visible()` already joins them), so
+    showing each reply's author doesn't load them one by one.
+    """
+
+    if message.path is None:
+        return [message]
+
+    return (Message
+            .visible()
+            .filter(Message.thread_id == message.thread_id,
+                    Message.path >= message.path,
+                    Message.path < message.path + END)
+            .options(contains_eager(Message.user))
+            .order_by(Message.path)
+            .all())
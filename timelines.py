@@ -0,0 +1,297 @@
+"""Home timelines, and building a user's first one ahead of time.
+
+The first homepage after logging in is the slowest page of a session:
+nothing about the user is cached yet, so their follow list, the newest
+messages of everyone they follow, those messages' authors, the user's like
+filter and their suggestions all come from the DB. `login()` and
+`signup()` call `prewarm()`, which does that work on a background thread
+while the browser follows the redirect. The page's messages (as rows.py
+rows) and the suggested user ids are left in the query cache's
+`timelines` region, and everything else the page needs warm in its own
+cache (caching.py, membership.py).
+
+`homepage()` asks `take()` for that page. If the prewarm is still running,
+it waits up to PREWARM_WAIT seconds for it. With the in-process cache the
+page only lands in the worker that built it, so only a homepage served by
+that worker waits. With Redis (CACHE_REDIS_URL) and shared state
+(shared.py), running prewarms are marked where every worker sees them,
+and a homepage served by another worker waits too. A prewarmed page is
+used once and then dropped; later visits build the page as before.
+Posting or following before then drops it too, so it never hides the
+user's own changes.
+
+`stats()` counts prewarms started, finished and failed, and first visits
+served warm (`warm_hits`, `waited` of them after waiting) or `cold`;
+across all workers with shared state.
+
+Needs the query cache; set PREWARM to False to switch this off.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from flask import current_app, has_app_context, session
+
+import caching
+import graph
+import membership
+import partitions
+import rows
+import shared
+import suggestions
+from models import Message
+
+# Messages per page of the home timeline
+PAGE_SIZE = 100
+
+# Prewarms run at once per worker
+THREADS = 4
+
+# Longest a homepage waits on a prewarm still running (seconds)
+PREWARM_WAIT = 0.5
+
+# How often a homepage checks on a prewarm running in another worker, and
+# how old a running prewarm's mark gets before it's taken as abandoned
+POLL_INTERVAL = 0.01
+STALE_AFTER = 30
+
+# Session key marking a login whose first homepage should be prewarmed
+PREWARM_KEY = 'prewarm_user_id'
+
+
+def source_ids(user_id):
+    """Ids of the users whose messages are on `user_id`'s timeline."""
+
+    index = graph.current_graph()
+    if index is not None:
+        return index.following(user_id) + [user_id]
+    return caching.following_ids(user_id) + [user_id]
+
+
+def page(user_id, before=None, limit=PAGE_SIZE):
+    """Newest `limit` messages on `user_id`'s timeline (before `before`),
+    as rows.MessageRows."""
+
+    # Newest partitions first; older ones only if the page isn't full
+    return list(rows.message_rows(partitions.recent_first(
+        rows.messages_query().filter(
+            Message.user_id.in_(source_ids(user_id))),
+        limit,
+        before=before)))
+
+
+def build(user_id):
+    """Warm everything `user_id`'s first homepage needs, and cache it."""
+
+    cache = caching.current_cache()
+
+    # Anything left from an earlier login is out of date
+    cache.bump(('timeline', user_id))
+
+    caching.user(user_id)
+    filters = membership.current_filters()
+    if filters is not None:
+        filters.get(membership.LIKES, user_id)
+
+    messages = page(user_id)
+    suggested_ids = [user.id for user in suggestions.for_user(user_id)]
+    caching.user_cards(suggested_ids)
+
+    # The profile card's counts
+    caching.message_count(user_id)
+    caching.user_cards(caching.following_ids(user_id))
+    caching.user_cards(caching.follower_ids(user_id))
+
+    cache.get('timelines', user_id, ('timeline', user_id),
+              lambda: {'messages': messages, 'suggested': suggested_ids})
+
+
+class Prewarmer:
+    """Runs prewarms on a small thread pool, and counts how they do.
+
+    Counts go to `counters` (see shared.py). With a shared `table`, running
+    prewarms are marked in it too, so a homepage served by another worker
+    can wait for them; only pass one if that worker can read the page from
+    the cache.
+    """
+
+    def __init__(self, app, threads=THREADS, counters=None, table=None):
+        self.app = app
+        self.executor = ThreadPoolExecutor(threads,
+                                           thread_name_prefix='prewarm')
+        self.counters = counters or shared.LocalCounters()
+        self.table = table
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user_id):
+        """Start prewarming for `user_id`, unless it already is."""
+
+        with self._lock:
+            if user_id in self.pending:
+                return
+            self._mark(user_id)
+            future = self.executor.submit(self._run, user_id)
+            self.pending[user_id] = future
+
+        self.counters.add('started')
+        future.add_done_callback(lambda done: self._forget(user_id, done))
+
+    def _mark(self, user_id):
+        if self.table is not None:
+            try:
+                self.table.update(f'prewarm:running:{user_id}',
+                                  lambda started: time.time())
+            except shared.TableFull:
+                pass
+
+    def _forget(self, user_id, future):
+        with self._lock:
+            if self.pending.get(user_id) is future:
+                del self.pending[user_id]
+        if self.table is not None:
+            self.table.delete(f'prewarm:running:{user_id}')
+
+    def _run(self, user_id):
+        start = time.perf_counter()
+
+        with self.app.app_context():
+            try:
+                build(user_id)
+            except Exception:
+                self.app.logger.exception("Prewarm for user %s failed",
+                                          user_id)
+                self.counters.add('failed')
+                return
+
+        self.counters.add('finished')
+        self.counters.add('build_ms',
+                          round(1000 * (time.perf_counter() - start)))
+
+    def wait(self, user_id, timeout=None):
+        """Wait (up to PREWARM_WAIT) for a prewarm still running, here or
+        in another worker; whether there was one."""
+
+        if timeout is None:
+            timeout = PREWARM_WAIT
+
+        with self._lock:
+            future = self.pending.get(user_id)
+
+        if future is not None and not future.done():
+            try:
+                future.result(timeout)
+            except TimeoutError:
+                pass
+            return True
+
+        return self._wait_elsewhere(user_id, timeout)
+
+    def _wait_elsewhere(self, user_id, timeout):
+        if self.table is None:
+            return False
+
+        key = f'prewarm:running:{user_id}'
+        now = time.time()
+        started = self.table.get(key, None)
+        # Left behind by a worker that died mid-prewarm
+        if started is None or now - started > STALE_AFTER:
+            return False
+
+        deadline = now + timeout
+        while (self.table.get(key, None) is not None
+               and time.time() < deadline):
+            time.sleep(POLL_INTERVAL)
+        return True
+
+    def visited(self, warm, waited):
+        if warm:
+            self.counters.add('warm_hits')
+            self.counters.add('waited', waited)
+        else:
+            self.counters.add('cold')
+
+    def stats(self):
+        count = self.counters.get
+        visits = count('warm_hits') + count('cold')
+        with self._lock:
+            running = len(self.pending)
+
+        return {
+            'started': count('started'),
+            'finished': count('finished'),
+            'failed': count('failed'),
+            'running': running,
+            'avg_build_ms': (count('build_ms') / count('finished')
+                             if count('finished') else 0.0),
+            'warm_hits': count('warm_hits'),
+            'waited': count('waited'),
+            'cold': count('cold'),
+            'warm_hit_rate': count('warm_hits') / visits if visits else 0.0,
+        }
+
+
+_init_lock = threading.Lock()
+
+
+def current_prewarmer():
+    """The app's prewarmer, or None if switched off (PREWARM, or no
+    query cache to leave pages in)."""
+
+    if (not has_app_context() or not current_app.config.get('PREWARM', True)
+            or caching.current_cache() is None):
+        return None
+
+    app = current_app._get_current_object()
+    prewarmer = app.extensions.get('prewarm')
+
+    if prewarmer is None:
+        with _init_lock:
+            prewarmer = app.extensions.get('prewarm')
+            if prewarmer is None:
+                # Waiting on another worker's prewarm is only worth it if
+                # its page lands where this worker can read it
+                table = None
+                if caching.current_cache().backend.shared_entries:
+                    table = shared.current_table('stats')
+                prewarmer = Prewarmer(app,
+                                      counters=shared.counters('prewarm'),
+                                      table=table)
+                app.extensions['prewarm'] = prewarmer
+
+    return prewarmer
+
+
+def prewarm(user_id):
+    """Start building `user_id`'s first homepage; call on login."""
+
+    prewarmer = current_prewarmer()
+    if prewarmer is not None:
+        session[PREWARM_KEY] = user_id
+        prewarmer.submit(user_id)
+
+
+def take(user_id):
+    """The prewarmed first page for `user_id`, as {'messages': rows,
+    'suggested': ids}, or None.
+
+    Only the first homepage after a prewarmed login gets one.
+    """
+
+    if session.pop(PREWARM_KEY, None) != user_id:
+        return None
+
+    prewarmer = current_prewarmer()
+    if prewarmer is None:
+        return None
+
+    waited = prewarmer.wait(user_id)
+
+    cache = caching.current_cache()
+    found = cache.get('timelines', user_id, ('timeline', user_id),
+                      lambda: None)
+    cache.bump(('timeline', user_id))
+
+    prewarmer.visited(found is not None, waited)
+    return found
@@ -0,0 +1,296 @@
+"""Trending warbles: messages ranked by time-decayed like velocity.
+
+Every like adds 1 to its message's score and every unlike subtracts 1, and
+each contribution then decays exponentially with a half-life of
+`HALF_LIFE` seconds. Because every score decays at the same rate, scores
+are stored relative to a fixed epoch (a like at time t is worth
+2 ** ((t - epoch) / HALF_LIFE)). Ranking never needs the scores decayed,
+so a like is O(1) work plus an O(K) top-K update. Every `DECAY_INTERVAL`
+the epoch is moved up to now and the scores rescaled, which keeps the
+numbers small, drops messages that have gone cold and caps how many are
+tracked.
+
+Reads return the cached top-K list, so their cost doesn't depend on how
+many likes or messages there are.
+
+The tracker is fed by `handle_like()`. Without SHARED_STATE_PATH it lives
+in each worker process, which only sees the likes that worker handles;
+with it, the scores live in a shared table (shared.py) that every worker
+on the host records into and ranks from. Either way it's warmed once,
+on first use, from the likes of the last WARM_WINDOW (each counted at
+the time it was made), and kept up to date incrementally from then on;
+it's never recomputed from the likes table while serving.
+"""
+
+import heapq
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+import shared
+
+HALF_LIFE = 6 * 60 * 60
+
+DECAY_INTERVAL = 60
+
+TOP_K = 50
+
+# Most messages tracked at once; the coldest are dropped beyond this
+CAPACITY = 10000
+
+# Scores below this (in likes, after decay) are forgotten
+MIN_SCORE = 0.01
+
+# How far back to look when warming up from the DB
+WARM_WINDOW = timedelta(days=3)
+
+
+class TrendingTracker:
+    """Bounded, incrementally maintained top-K of decaying scores."""
+
+    def __init__(self, k=TOP_K, half_life=HALF_LIFE, capacity=CAPACITY,
+                 decay_interval=DECAY_INTERVAL, clock=time.time):
+        self.k = k
+        self.rate = math.log(2) / half_life
+        self.capacity = capacity
+        self.decay_interval = decay_interval
+        self.clock = clock
+
+        self.epoch = clock()
+        self.warmed = False
+        self.scores = {}
+        self._top = {}
+        self._ranked = []
+        self._lock = threading.Lock()
+
+    def weight(self, at):
+        """Value of one like at time `at`, in epoch units."""
+
+        return math.exp((at - self.epoch) * self.rate)
+
+    def record(self, message_id, delta=1, at=None):
+        """Count a like (`delta`=1) or unlike (-1) of `message_id`."""
+
+        now = self.clock()
+        at = now if at is None else at
+
+        with self._lock:
+            if now - self.epoch >= self.decay_interval:
+                self._decay(now)
+
+            score = self.scores.get(message_id, 0) + delta * self.weight(at)
+
+            if score <= MIN_SCORE * self.weight(now):
+                self.scores.pop(message_id, None)
+                score = 0
+            else:
+                self.scores[message_id] = score
+
+            self._update_top(message_id, score)
+
+    def _update_top(self, message_id, score):
+        """Keep the top-K set and its ranking current after one change."""
+
+        if message_id in self._top:
+            if score > 0:
+                self._top[message_id] = score
+            else:
+                del self._top[message_id]
+
+        elif score > 0:
+            if len(self._top) < self.k:
+                self._top[message_id] = score
+            else:
+                floor_id = min(self._top, key=self._top.get)
+                if score > self._top[floor_id]:
+                    del self._top[floor_id]
+                    self._top[message_id] = score
+            # Not in the top K: nothing visible changed
+            if message_id not in self._top:
+                return
+
+        self._ranked = sorted(self._top, key=self._top.get, reverse=True)
+
+    def _decay(self, now):
+        """Rebase scores to `now`, dropping and capping cold messages."""
+
+        factor = math.exp(-(now - self.epoch) * self.rate)
+        self.epoch = now
+
+        scores = {message_id: score * factor
+                  for message_id, score in self.scores.items()
+                  if score * factor > MIN_SCORE}
+
+        if len(scores) > self.capacity:
+            scores = dict(heapq.nlargest(self.capacity, scores.items(),
+                                         key=lambda item: item[1]))
+
+        self.scores = scores
+
+        # A full pass also repairs the top K after unlikes lowered members
+        self._top = dict(heapq.nlargest(self.k, scores.items(),
+                                        key=lambda item: item[1]))
+        self._ranked = sorted(self._top, key=self._top.get, reverse=True)
+
+    def top(self, n=None):
+        """Message ids, hottest first."""
+
+        ranked = self._ranked
+        return ranked if n is None else ranked[:n]
+
+    def score(self, message_id):
+        """Current decayed score of `message_id`, in likes."""
+
+        return (self.scores.get(message_id, 0) /
+                self.weight(self.clock()))
+
+    def claim_warm(self):
+        """Whether the caller should warm the tracker up; only the first
+        caller is told to."""
+
+        with self._lock:
+            if self.warmed:
+                return False
+            self.warmed = True
+            return True
+
+
+class SharedTrendingTracker:
+    """The same interface, with scores in a shared table (shared.py) that
+    every worker on the host records into.
+
+    Scores are keyed by message id, relative to an epoch kept in the
+    `stats` table. Whichever worker first finds DECAY_INTERVAL has passed
+    moves the epoch up and rescales every score; the table's size caps
+    how many messages are tracked (the coldest make way for new ones).
+    """
+
+    def __init__(self, table, stats, k=TOP_K, half_life=HALF_LIFE,
+                 decay_interval=DECAY_INTERVAL, clock=time.time):
+        self.table = table
+        self.stats_table = stats
+        self.k = k
+        self.rate = math.log(2) / half_life
+        self.decay_interval = decay_interval
+        self.clock = clock
+
+    def _epoch(self, now):
+        """The shared epoch, moved up to `now` (and the scores rescaled)
+        if it's due."""
+
+        moved_from = []
+
+        def claim(epoch):
+            if epoch is None:
+                return now
+            if now - epoch >= self.decay_interval:
+                moved_from.append(epoch)
+                return now
+            return epoch
+
+        # Only the worker that moves the epoch on does the rescaling
+        epoch = self.stats_table.update('trending:epoch', claim)
+        if moved_from:
+            self.table.scale(math.exp(-(epoch - moved_from[0]) * self.rate),
+                             drop_below=MIN_SCORE)
+        return epoch
+
+    def record(self, message_id, delta=1, at=None):
+        """Count a like (`delta`=1) or unlike (-1) of `message_id`."""
+
+        now = self.clock()
+        at = now if at is None else at
+        epoch = self._epoch(now)
+        weight = math.exp((at - epoch) * self.rate)
+        floor = MIN_SCORE * math.exp((now - epoch) * self.rate)
+
+        def change(score):
+            # An unlike of a message no longer tracked changes nothing
+            if score is None and delta < 0:
+                return None
+            score = (score or 0) + delta * weight
+            return score if score > floor else None
+
+        try:
+            self.table.update(str(message_id), change, evict=delta > 0)
+        except shared.TableFull:
+            pass
+
+    def top(self, n=None):
+        """Message ids, hottest first."""
+
+        ranked = [int(key) for key, _ in
+                  heapq.nlargest(self.k, self.table.items(),
+                                 key=lambda item: item[1])]
+        return ranked if n is None else ranked[:n]
+
+    def score(self, message_id):
+        """Current decayed score of `message_id`, in likes."""
+
+        now = self.clock()
+        epoch = self.stats_table.get('trending:epoch', now)
+        return (self.table.get(str(message_id)) /
+                math.exp((now - epoch) * self.rate))
+
+    def claim_warm(self):
+        """Whether the caller should warm the table up; only the first
+        worker to find it new is told to."""
+
+        due = []
+
+        def claim(warmed):
+            if warmed is None:
+                due.append(True)
+                return 1
+            return warmed
+
+        self.stats_table.update('trending:warmed', claim)
+        return bool(due)
+
+
+def warm(tracker, now=None):
+    """Seed `tracker` from the likes made in the last WARM_WINDOW."""
+
+    from models import db, Like
+
+    now = now or datetime.utcnow()
+    clock_now = tracker.clock()
+
+    rows = (db.session
+            .query(Like.message_id, Like.created_at)
+            .filter(Like.created_at >= now - WARM_WINDOW))
+
+    for message_id, created_at in rows:
+        tracker.record(message_id, 1,
+                       at=clock_now - (now - created_at).total_seconds())
+
+
+_init_lock = threading.Lock()
+
+
+def current_tracker(app):
+    """`app`'s tracker, warmed from the likes table on first use; shared
+    if there's SHARED_STATE_PATH.
+
+    Call with `app`'s context pushed.
+    """
+
+    tracker = app.extensions.get('trending')
+    if tracker is not None:
+        return tracker
+
+    with _init_lock:
+        tracker = app.extensions.get('trending')
+        if tracker is None:
+            table = shared.current_table('trending')
+            if table is not None:
+                tracker = SharedTrendingTracker(
+                    table, shared.current_table('stats'))
+            else:
+                tracker = TrendingTracker()
+            if tracker.claim_warm():
+                warm(tracker)
+            app.extensions['trending'] = tracker
+
+    return tracker